@@ -11,8 +11,8 @@ import {
   Typography,
   Chip,
 } from '@mui/material';
-import { getOrders, getMenu } from '../services/api.ts';
-import { Order, MenuItem } from '../types';
+import { getOrders, getMenu, subscribeToOrderEvents, applyOrderEvent } from '../services/api.ts';
+import { Order, MenuItem, OrderItem } from '../types';
 import { useAuth } from '../contexts/AuthContext.tsx';
 import { Navigate } from 'react-router-dom';
 import NavBar from '../components/NavBar.tsx';
@@ -25,11 +25,24 @@ const AdminOrders: React.FC = () => {
   useEffect(() => {
     loadOrders();
     loadMenu();
-    const interval = setInterval(() => {
-      loadOrders();
-      loadMenu();
-    }, 30000);
-    return () => clearInterval(interval);
+    // Apply pushed orders locally; new orders take their items off the stock
+    // shown. Only a 'reset' (missed events) reloads from the server
+    return subscribeToOrderEvents((type, order) => {
+      if (type === 'reset') {
+        loadOrders();
+        loadMenu();
+        return;
+      }
+      setOrders(current => applyOrderEvent(current, order));
+      if (type === 'order_created') {
+        setMenuItems(current => current.map(item => {
+          const ordered = order.items.find((line: OrderItem) => line.id === item.id);
+          return ordered && item.track_stock && item.stock != null
+            ? { ...item, stock: item.stock - ordered.quantity }
+            : item;
+        }));
+      }
+    });
   }, []);
 
   const loadOrders = async () => {
@@ -1,15 +1,14 @@
 import React from 'react';
 import { QRCodeSVG } from 'qrcode.react';
 import { Paper, Box, Typography } from '@mui/material';
-import { generateSecureToken } from '../utils/security.ts';
 
 interface QRCodeGeneratorProps {
   tableNumber: number;
+  token: string;
   baseUrl: string;
 }
 
-const QRCodeGenerator: React.FC<QRCodeGeneratorProps> = ({ tableNumber, baseUrl }) => {
-  const token = generateSecureToken(tableNumber);
+const QRCodeGenerator: React.FC<QRCodeGeneratorProps> = ({ tableNumber, token, baseUrl }) => {
   const qrValue = `${baseUrl}/qr-auth/${tableNumber}/${token}`;
 
   return (
@@ -130,12 +130,12 @@ const StaffOrderList: React.FC<StaffOrderListProps> = ({ orders, onOrderUpdate }
                     <Button
                       variant="contained"
                       color="primary"
-                      onClick={() => handleStatusUpdate(order.id, 'Preparing')}
+                      onClick={() => handleStatusUpdate(order.id, 'Accepted')}
                     >
                       {order.is_service ? 'Accept Request' : 'Start Preparing'}
                     </Button>
                   )}
-                  {order.status === 'Preparing' && (
+                  {['Accepted', 'Paid'].includes(order.status) && (
                     <Button
                       variant="contained"
                       color="success"
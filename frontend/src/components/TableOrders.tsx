@@ -15,7 +15,7 @@ import {
   Tab
 } from '@mui/material';
 import { Order } from '../types';
-import { updateOrderStatus } from '../services/api.ts';
+import { cancelOrder } from '../services/api.ts';
 
 interface TableOrdersProps {
   orders: Order[];
@@ -28,7 +28,7 @@ const TableOrders: React.FC<TableOrdersProps> = ({ orders, onOrderUpdate, hideTi
 
   const handleRefund = async (orderId: number) => {
     try {
-      await updateOrderStatus(orderId, 'Refunded');
+      await cancelOrder(orderId);
       onOrderUpdate();
     } catch (error) {
       console.error('Failed to refund order:', error);
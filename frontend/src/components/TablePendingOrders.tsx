@@ -11,7 +11,7 @@ import {
   Chip
 } from '@mui/material';
 import { Order } from '../types';
-import { updateOrderStatus } from '../services/api.ts';
+import { cancelOrder } from '../services/api.ts';
 
 interface TablePendingOrdersProps {
   orders: Order[];
@@ -21,7 +21,7 @@ interface TablePendingOrdersProps {
 const TablePendingOrders: React.FC<TablePendingOrdersProps> = ({ orders, onOrderUpdate }) => {
   const handleRefund = async (orderId: number) => {
     try {
-      await updateOrderStatus(orderId, 'Refunded');
+      await cancelOrder(orderId);
       onOrderUpdate();
     } catch (error) {
       console.error('Failed to refund order:', error);
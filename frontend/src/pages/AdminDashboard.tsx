@@ -4,12 +4,22 @@ import QRCodeGenerator from '../components/QRCodeGenerator.tsx';
 import { useAuth } from '../contexts/AuthContext.tsx';
 import { Navigate } from 'react-router-dom';
 import NavBar from '../components/NavBar.tsx';
+import { getTableQRTokens } from '../services/api.ts';
 
 const AdminDashboard: React.FC = () => {
   const { role } = useAuth();
-  const [tables, setTables] = useState<number[]>([1, 2, 3, 4, 5]); // Default tables
+  // Signed by the server, one per table
+  const [tables, setTables] = useState<{ table_number: number; token: string }[]>([]);
   const baseUrl = process.env.REACT_APP_API_URL?.replace(':5001', ':3000') || 'http://192.168.1.168:3000';
 
+  useEffect(() => {
+    if (role === 'admin') {
+      getTableQRTokens()
+        .then(data => setTables(data.tokens))
+        .catch(error => console.error('Error fetching QR tokens:', error));
+    }
+  }, [role]);
+
   if (role !== 'admin') {
     return <Navigate to="/login" replace />;
   }
@@ -22,10 +32,11 @@ const AdminDashboard: React.FC = () => {
           Table QR Codes
         </Typography>
         <Grid container spacing={3}>
-          {tables.map((tableNumber) => (
-            <Grid item xs={12} sm={6} md={4} key={tableNumber}>
+          {tables.map(({ table_number, token }) => (
+            <Grid item xs={12} sm={6} md={4} key={table_number}>
               <QRCodeGenerator
-                tableNumber={tableNumber}
+                tableNumber={table_number}
+                token={token}
                 baseUrl={baseUrl}
               />
             </Grid>
@@ -2,7 +2,7 @@ import React, { useState, useEffect } from 'react';
 import { Container, Typography, Alert } from '@mui/material';
 import { Navigate } from 'react-router-dom';
 import { useAuth } from '../contexts/AuthContext.tsx';
-import { getOrders } from '../services/api.ts';
+import { getOrders, subscribeToOrderEvents, applyOrderEvent } from '../services/api.ts';
 import StaffOrderList from '../components/StaffOrderList.tsx';
 import NavBar from '../components/NavBar.tsx';
 import { Order } from '../types';
@@ -15,8 +15,14 @@ const StaffDashboard: React.FC = () => {
 
   useEffect(() => {
     loadOrders();
-    const interval = setInterval(loadOrders, 30000);
-    return () => clearInterval(interval);
+    // Events carry the changed order; only a 'reset' (missed events) needs a reload
+    return subscribeToOrderEvents((type, order) => {
+      if (type === 'reset') {
+        loadOrders();
+      } else {
+        setOrders(current => applyOrderEvent(current, order));
+      }
+    });
   }, []);
 
   const loadOrders = async () => {
@@ -33,7 +39,7 @@ const StaffDashboard: React.FC = () => {
     return <Navigate to="/login" replace />;
   }
 
-  const activeOrders = orders.filter(order => ['Pending', 'Preparing'].includes(order.status));
+  const activeOrders = orders.filter(order => ['Pending', 'Accepted', 'Paid'].includes(order.status));
   const completedOrders = orders.filter(order => order.status === 'Completed');
 
   return (
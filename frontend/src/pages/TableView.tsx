@@ -3,7 +3,7 @@ import { Container, Grid, Typography, Box, Alert } from '@mui/material';
 import MenuList from '../components/MenuList.tsx';
 import OrderSummary from '../components/OrderSummary.tsx';
 import { MenuItem, OrderItem, Order } from '../types';
-import { getMenu, createOrder, getOrders } from '../services/api.ts';
+import { getMenu, createOrder, getOrders, subscribeToOrderEvents, applyOrderEvent } from '../services/api.ts';
 import { useAuth } from '../contexts/AuthContext.tsx';
 import { Navigate } from 'react-router-dom';
 import NavBar from '../components/NavBar.tsx';
@@ -23,10 +23,14 @@ const TableView: React.FC = () => {
   useEffect(() => {
     loadMenu();
     loadOrders();
-    const interval = setInterval(() => {
-      loadOrders();
-    }, 30000); // Refresh orders every 30 seconds
-    return () => clearInterval(interval);
+    // Apply the changes the server pushes for this table; reload only after a 'reset'
+    return subscribeToOrderEvents((type, order) => {
+      if (type === 'reset') {
+        loadOrders();
+      } else {
+        setOrders(current => applyOrderEvent(current, order));
+      }
+    });
   }, []);
 
   const loadMenu = async () => {
@@ -1,5 +1,5 @@
 import axios from 'axios';
-import { OrderItem } from '../types';
+import { Order, OrderItem } from '../types';
 
 const API_URL = process.env.REACT_APP_API_URL || 'http://192.168.1.168:5001';
 
@@ -16,6 +16,11 @@ api.interceptors.request.use((config) => {
   if (token) {
     config.headers.Authorization = `Bearer ${token}`;
   }
+  // Picks the venue to log in to; once logged in, the token's venue wins
+  const venue = localStorage.getItem('venue') || process.env.REACT_APP_VENUE;
+  if (venue) {
+    config.headers['X-Venue'] = venue;
+  }
   return config;
 });
 
@@ -29,13 +34,35 @@ export const getMenu = async () => {
   return response.data;
 };
 
+// POSTs with an Idempotency-Key and retries once if the request never got a
+// response; the server replays the first result instead of acting twice.
+const postIdempotent = async (url: string, body: any, key: string = crypto.randomUUID()) => {
+  const config = { headers: { 'Idempotency-Key': key } };
+  try {
+    return (await api.post(url, body, config)).data;
+  } catch (error: any) {
+    if (error.response) {
+      throw error;
+    }
+    return (await api.post(url, body, config)).data;
+  }
+};
+
 export const createOrder = async (items: OrderItem[]) => {
-  const response = await api.post('/orders', { 
+  return postIdempotent('/orders', {
     items: items.map(item => ({
       id: item.id,
       quantity: item.quantity
     }))
   });
+};
+
+// Uploads orders queued while offline in one request. Each order carries a
+// client-generated id, so re-sending the same queue never creates duplicates.
+export const submitQueuedOrders = async (
+  orders: { client_id: string; created_at: string; items: { id: number; quantity: number }[] }[]
+) => {
+  const response = await api.post('/orders/batch', { orders });
   return response.data;
 };
 
@@ -49,6 +76,14 @@ export const getOrders = async () => {
   }
 };
 
+// Archived (closed, older) orders; pass next_before_id back to page further
+export const getOrderHistory = async (params: {
+  from?: string; to?: string; table_number?: number; before_id?: number; limit?: number
+} = {}) => {
+  const response = await api.get('/orders/history', { params });
+  return response.data;
+};
+
 export const updateOrderStatus = async (
   orderId: number, 
   status: string, 
@@ -70,11 +105,88 @@ export const updateOrderStatus = async (
   return response.json();
 };
 
-export const processPayment = async (orderId: number, amount: number) => {
-  const response = await api.post('/payments', { order_id: orderId, amount });
+// Tables take back their own orders while they are still pending
+export const cancelOrder = async (orderId: number) => {
+  const response = await api.post(`/orders/${orderId}/cancel`);
+  return response.data;
+};
+
+// Changes several orders in one request; each result reports ok or its error
+export const updateOrderStatuses = async (updates: { order_id: number; status: string }[]) => {
+  const response = await api.put('/orders/status', { updates });
   return response.data;
 };
 
+// Staff shifts: service requests are only dispatched to staff on shift
+export const setOnShift = async (onShift: boolean) => {
+  const response = onShift ? await api.post('/dispatch/shift') : await api.delete('/dispatch/shift');
+  return response.data;
+};
+
+// The caller's pending service requests, next one first, plus unassigned ones
+export const getServiceQueue = async () => {
+  const response = await api.get('/dispatch/queue');
+  return response.data;
+};
+
+export const getDispatchStats = async () => {
+  const response = await api.get('/dispatch/stats');
+  return response.data;
+};
+
+const ORDER_EVENT_TYPES = ['order_created', 'order_updated', 'payment_processed', 'order_refunded', 'reset'];
+
+// Applies a pushed order to a list from GET /orders without refetching it;
+// every order event carries the whole order as it now is
+export const applyOrderEvent = (orders: Order[], order: Order) => {
+  if (!orders.some(existing => existing.id === order.id)) {
+    return [...orders, order];
+  }
+  return orders.map(existing => (existing.id === order.id ? order : existing));
+};
+
+// Subscribes to the server-sent order event stream. The browser reconnects on
+// its own and resumes from the last event id; a 'reset' event means events were
+// missed and the caller should reload. Returns an unsubscribe function.
+export const subscribeToOrderEvents = (onEvent: (type: string, data: any) => void) => {
+  const token = localStorage.getItem('token');
+  const source = new EventSource(`${API_URL}/events?jwt=${encodeURIComponent(token || '')}`, {
+    withCredentials: true
+  });
+  ORDER_EVENT_TYPES.forEach(type => {
+    source.addEventListener(type, (event) => {
+      onEvent(type, JSON.parse((event as MessageEvent).data));
+    });
+  });
+  return () => source.close();
+};
+
+// One key per order's payment, so a second tap on Pay replays the first
+// payment instead of making another. A refused payment (4xx other than 409,
+// which the server doesn't keep) gets a new key, as the next try differs.
+const paymentKeys = new Map<number, string>();
+
+export const processPayment = async (orderId: number, amount: number) => {
+  if (!paymentKeys.has(orderId)) {
+    paymentKeys.set(orderId, crypto.randomUUID());
+  }
+  try {
+    return await postIdempotent('/payments', { order_id: orderId, amount }, paymentKeys.get(orderId));
+  } catch (error: any) {
+    const status = error.response?.status;
+    if (status && status < 500 && status !== 409) {
+      paymentKeys.delete(orderId);
+    }
+    throw error;
+  }
+};
+
+// Admin only: server-signed QR tokens for every table, or the ones listed
+export const getTableQRTokens = async (tables?: number[]) => {
+  const response = await api.post('/auth/tables/qr-tokens', tables ? { tables } : {});
+  return response.data as { expires_at: string; tokens: { table_number: number; token: string }[] };
+};
+
 export const authenticateViaQR = async (tableNumber: string, token: string) => {
   try {
     const response = await api.post('/auth/qr', { tableNumber, token });
@@ -1,5 +0,0 @@
-export const generateSecureToken = (tableNumber: number) => {
-  const timestamp = Date.now();
-  const randomString = Math.random().toString(36).substring(2, 8);
-  return `${tableNumber}-${timestamp}-${randomString}`;
-}; 
\ No newline at end of file
@@ -1,29 +1,30 @@
-from flask import Flask
+import time
+STARTED_AT = time.perf_counter()
+
+from flask import Flask, current_app
+from sqlalchemy import MetaData, func, insert, inspect, literal, select, text, update
+from sqlalchemy.schema import CreateTable
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
-from models import db, MenuItem, Order, Payment, User
+from werkzeug.middleware.proxy_fix import ProxyFix
+from models import db, ArchivedOrder, ArchivedPayment, ChangeSequence, Order, Payment, User
 from routes import routes
 from auth import auth
-import os
-
-app = Flask(__name__)
-CORS(app, 
-     resources={r"/*": {
-         "origins": ["http://localhost:3000", "http://192.168.1.168:3000", "http://127.0.0.1:3000"],
-         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-         "allow_headers": ["Content-Type", "Authorization"],
-         "expose_headers": ["Content-Type", "Authorization"],
-         "supports_credentials": True,
-         "send_wildcard": False
-     }},
-     supports_credentials=True
-)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['JWT_SECRET_KEY'] = 'your-secret-key'
-
-jwt = JWTManager(app)
+from events import events
+from reports import reports
+from archive import archive
+from exports import exports
+from stock import stock, stock_engine, StockFlusher
+from dispatch import dispatch
+from venues import venues
+from sharding import init_venues
+from cache import identity_cache
+from seed import seed_users, seed_menu_items, table_accounts
+from config import DEFAULT_CONFIG, engine_profile, apply_pragmas
+from metrics import metrics, init_metrics, instrument_engine
+from encoding import init_json, init_compression
+
+jwt = JWTManager()
 
 @jwt.user_identity_loader
 def user_identity_lookup(user):
@@ -34,102 +35,214 @@ def user_lookup_callback(_jwt_header, jwt_data):
     identity = jwt_data["sub"]
     try:
         user_id = int(identity)
-        return User.query.get(user_id)
+        return identity_cache.get(user_id)
     except ValueError:
         return None
 
-db.init_app(app)
-app.register_blueprint(routes)
-app.register_blueprint(auth, url_prefix='/auth')
-
-def create_sample_data():
-    # Create admin if doesn't exist
-    if not User.query.filter_by(username='admin').first():
-        admin = User(username='admin', role='admin')
-        admin.set_password('admin123')
-        db.session.add(admin)
-        db.session.commit()
-
-    # Create two staff members if they don't exist
-    staff_members = ['staff1', 'staff2']
-    for staff_name in staff_members:
-        if not User.query.filter_by(username=staff_name).first():
-            staff = User(username=staff_name, role='staff')
-            staff.set_password('staff123')
-            db.session.add(staff)
-    db.session.commit()
+def create_app(config=None):
+    """Build the Flask app. `config` overrides DEFAULT_CONFIG, including the
+    DB_ENGINE_PROFILE that tunes the database engine."""
+    app = Flask(__name__)
+    CORS(app, 
+         resources={r"/*": {
+             "origins": ["http://localhost:3000", "http://192.168.1.168:3000", "http://127.0.0.1:3000"],
+             "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+             "allow_headers": ["Content-Type", "Authorization", "Idempotency-Key", "X-Venue"],
+             "expose_headers": ["Content-Type", "Authorization", "Idempotent-Replayed", "Retry-After"],
+             "supports_credentials": True,
+             "send_wildcard": False
+         }},
+         supports_credentials=True
+    )
 
-    # Create tables 1-5 if they don't exist
-    for table_num in range(1, 6):
-        if not User.query.filter_by(table_number=table_num).first():
-            table_user = User(
-                username=f"table{table_num}",
-                role='table',
-                table_number=table_num
-            )
-            table_user.set_password('table123')  # Same password for all tables
-            db.session.add(table_user)
-    db.session.commit()
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config or {})
+
+    engine_options, pragmas = engine_profile(app.config)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options,
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+    }
+
+    if app.config['PROXY_FIX']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX'], x_proto=app.config['PROXY_FIX'])
+
+    jwt.init_app(app)
+    db.init_app(app)
+    with app.app_context():
+        apply_pragmas(db.engine, pragmas)
+        instrument_engine(db.engine)
+    init_venues(app, db)
+    init_metrics(app)
+    init_json(app)
+    init_compression(app)
+
+    app.register_blueprint(routes)
+    app.register_blueprint(auth, url_prefix='/auth')
+    app.register_blueprint(events)
+    app.register_blueprint(reports)
+    app.register_blueprint(metrics)
+    app.register_blueprint(archive)
+    app.register_blueprint(exports)
+    app.register_blueprint(stock)
+    app.register_blueprint(dispatch)
+    app.register_blueprint(venues)
+    return app
+
+def init_database():
+    """Create missing tables, and the columns and indexes added since on
+    tables that already exist, in the current venue's database. SQLite
+    tables created before they were marked AUTOINCREMENT are rebuilt."""
+    engine = db.session.get_bind()
+    db.metadata.create_all(engine)
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    add_column(connection, table, column)
+                    if column.name == 'accepted_at':
+                        backfill_accepted_at(connection, table)
+                    if column.name == 'change_seq' and table is Order.__table__:
+                        # Before any change the feed numbers; an empty cursor still returns them
+                        connection.execute(update(Order).values(change_seq=0, updated_at=Order.updated_at))
+        if connection.scalar(select(ChangeSequence.name).where(ChangeSequence.name == 'orders')) is None:
+            connection.execute(insert(ChangeSequence).values(name='orders', value=0))
+    if engine.dialect.name == 'sqlite':
+        for table in db.metadata.sorted_tables:
+            if table.dialect_options['sqlite']['autoincrement']:
+                rebuild_with_autoincrement(engine, table)
+    # Also recreates the indexes of rebuilt tables
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+def add_column(connection, table, column):
+    # Existing rows get the column's Python default, e.g. the current venue
+    dialect = connection.dialect
+    ddl = f"ALTER TABLE {dialect.identifier_preparer.format_table(table)} " \
+          f"ADD COLUMN {dialect.identifier_preparer.format_column(column)} {column.type.compile(dialect)}"
+    if column.default is not None and (column.default.is_scalar or column.default.is_callable):
+        value = column.default.arg(None) if column.default.is_callable else column.default.arg
+        ddl += " DEFAULT " + str(literal(value, column.type).compile(
+            dialect=dialect, compile_kwargs={'literal_binds': True}))
+    if not column.nullable:
+        ddl += " NOT NULL"
+    connection.exec_driver_sql(ddl)
 
-    # Create menu items if they don't exist
-    if not MenuItem.query.first():
-        menu_items = [
-            # Drinks
-            MenuItem(
-                name='Mojito',
-                price=8.50,
-                category='drink',
-                stock=100,
-                track_stock=True,
-                description='Classic Cuban cocktail with rum, mint, and lime'
-            ),
-            MenuItem(
-                name='Vodka',
-                price=8.00,
-                category='drink',
-                stock=100,
-                track_stock=True,
-                description='Premium vodka'
-            ),
-            MenuItem(
-                name='Gin',
-                price=7.00,
-                category='drink',
-                stock=100,
-                track_stock=True,
-                description='London dry gin'
-            ),
-            # Services
-            MenuItem(
-                name='Empty Glasses',
-                price=0.00,
-                category='service',
-                track_stock=False,
-                description='Request clean empty glasses'
-            ),
-            MenuItem(
-                name='Waiter Service',
-                price=0.00,
-                category='service',
-                track_stock=False,
-                description='Call a waiter to your table'
-            ),
-            MenuItem(
-                name='Bottle Show Service',
-                price=0.00,
-                category='service',
-                track_stock=False,
-                description='Special bottle presentation service'
-            )
-        ]
-        
-        for item in menu_items:
-            db.session.add(item)
-        
-        db.session.commit()
+def rebuild_with_autoincrement(engine, table):
+    """Recreate `table` with AUTOINCREMENT if it was made without it.
+
+    Without it SQLite hands the highest id out again once its row is deleted,
+    e.g. by archiving. The sequence starts past the archived copies' ids too,
+    as the rowids may already have been reused.
+    """
+    with engine.connect() as connection:
+        sql = connection.scalar(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                                {'name': table.name})
+        if 'AUTOINCREMENT' in sql.upper():
+            return
+        # Switching foreign keys off only works outside a transaction; it
+        # keeps rows pointing at the table from being checked while it is swapped
+        foreign_keys = connection.exec_driver_sql('PRAGMA foreign_keys').scalar()
+        connection.exec_driver_sql('PRAGMA foreign_keys = OFF')
+        try:
+            connection.exec_driver_sql('BEGIN')
+            # Next to copies of the other tables, for its foreign keys to resolve
+            scratch = MetaData()
+            for other in db.metadata.sorted_tables:
+                other.to_metadata(scratch)
+            rebuilt = table.to_metadata(scratch, name=f'_rebuild_{table.name}')
+            connection.execute(CreateTable(rebuilt))
+            columns = [column.name for column in table.columns]
+            connection.execute(rebuilt.insert().from_select(columns, select(*table.columns)))
+            connection.execute(text(f'DROP TABLE {engine.dialect.identifier_preparer.format_table(table)}'))
+            connection.execute(text(f'ALTER TABLE {engine.dialect.identifier_preparer.format_table(rebuilt)} '
+                                    f'RENAME TO {engine.dialect.identifier_preparer.format_table(table)}'))
+
+            last_id = connection.scalar(select(func.max(table.c.id))) or 0
+            archived = db.metadata.tables.get(f'archived_{table.name}')
+            if archived is not None:
+                last_id = max(last_id, connection.scalar(select(func.max(archived.c.id))) or 0)
+            connection.execute(text('DELETE FROM sqlite_sequence WHERE name = :name'), {'name': table.name})
+            connection.execute(text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)'),
+                               {'name': table.name, 'seq': last_id})
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.exec_driver_sql(f'PRAGMA foreign_keys = {foreign_keys}')
+
+def backfill_accepted_at(connection, table):
+    # Only Pending orders can be paid, and accepted ones only move on to
+    # Completed, so Accepted and Completed orders without a payment were accepted
+    order, payment = (Order, Payment) if table is Order.__table__ else (ArchivedOrder, ArchivedPayment)
+    connection.execute(
+        update(order)
+        .where(order.status.in_([Order.STATUS_ACCEPTED, Order.STATUS_COMPLETED]),
+               order.id.not_in(select(payment.order_id).where(payment.status == 'Success')))
+        .values(accepted_at=order.updated_at)
+    )
+
+def create_sample_data(table_count=5, password_hashes=None):
+    """Seed the admin, staff, table accounts and menu in one transaction.
+
+    Safe to run on every start: existing rows are detected with one query per
+    table and left alone. `password_hashes` maps seed passwords to precomputed
+    hashes so a cold start doesn't pay for the key derivation.
+    """
+    password_hashes = password_hashes or current_app.config.get('SEED_PASSWORD_HASHES')
+
+    accounts = [
+        {'username': 'admin', 'role': User.ROLE_ADMIN, 'password': 'admin123'},
+        # Two staff members
+        {'username': 'staff1', 'role': User.ROLE_STAFF, 'password': 'staff123'},
+        {'username': 'staff2', 'role': User.ROLE_STAFF, 'password': 'staff123'},
+    ]
+    # Same password for all tables
+    accounts += table_accounts(range(1, table_count + 1), 'table123')
+
+    menu_items = [
+        # Drinks
+        {'name': 'Mojito', 'price': 8.50, 'category': 'drink', 'stock': 100, 'track_stock': True,
+         'description': 'Classic Cuban cocktail with rum, mint, and lime'},
+        {'name': 'Vodka', 'price': 8.00, 'category': 'drink', 'stock': 100, 'track_stock': True,
+         'description': 'Premium vodka'},
+        {'name': 'Gin', 'price': 7.00, 'category': 'drink', 'stock': 100, 'track_stock': True,
+         'description': 'London dry gin'},
+        # Services
+        {'name': 'Empty Glasses', 'price': 0.00, 'category': 'service', 'stock': None, 'track_stock': False,
+         'description': 'Request clean empty glasses'},
+        {'name': 'Waiter Service', 'price': 0.00, 'category': 'service', 'stock': None, 'track_stock': False,
+         'description': 'Call a waiter to your table'},
+        {'name': 'Bottle Show Service', 'price': 0.00, 'category': 'service', 'stock': None, 'track_stock': False,
+         'description': 'Special bottle presentation service'},
+    ]
+
+    users_added = seed_users(accounts, password_hashes)
+    items_added = seed_menu_items(menu_items)
+    db.session.commit()
+    if users_added:
+        identity_cache.clear()
+    return users_added, items_added
 
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
-        db.create_all()
-        create_sample_data()
-    app.run(host='0.0.0.0', port=5001)
+        seed_started = time.perf_counter()
+        init_database()
+        users_added, items_added = create_sample_data()
+        now = time.perf_counter()
+        print(f"Seeded {users_added} users and {items_added} menu items in "
+              f"{(now - seed_started) * 1000:.1f} ms; startup took {(now - STARTED_AT) * 1000:.1f} ms")
+        if app.config['STOCK_WRITE_BEHIND']:
+            # Apply stock sold before a crash, then start counting from there
+            stock_engine.resync()
+    flusher = StockFlusher(app)
+    flusher.start()
+    try:
+        app.run(host='0.0.0.0', port=5001)
+    finally:
+        flusher.stop()
@@ -0,0 +1,139 @@
+from flask import Blueprint, request, jsonify, current_app
+from sqlalchemy import delete, exists, insert, select, literal
+from sqlalchemy.orm import selectinload
+from datetime import datetime, timedelta
+from models import db, Order, OrderLine, Payment, User, ArchivedOrder, ArchivedOrderLine, ArchivedPayment
+from auth import role_required
+from routes import MAX_PAGE_SIZE, parse_fields, project
+from sharding import venue_router, venue_context
+import threading
+
+archive = Blueprint('archive', __name__)
+
+# Orders in these states never change again
+CLOSED_STATUSES = (Order.STATUS_COMPLETED, Order.STATUS_REFUNDED)
+# Fields /orders/history can be narrowed to with ?fields=a,b
+HISTORY_FIELDS = ('id', 'table_number', 'items', 'total_price', 'status', 'created_at', 'updated_at',
+                  'is_service', 'staff_id', 'archived_at', 'payments')
+
+def archive_closed_orders(max_age, batch_size=500):
+    """Move closed orders last changed more than `max_age` ago, with their
+    lines and payments, into the archive tables. Returns the number moved.
+
+    Each batch is copied with INSERT ... SELECT and deleted in one
+    transaction, so an order is always in exactly one of the two places.
+    Orders whose id, or a line or payment id, is already in the archive stay
+    where they are: tables made before AUTOINCREMENT handed archived ids out
+    again (see init_database).
+    """
+    cutoff = datetime.utcnow() - max_age
+    moved = 0
+    while True:
+        order_ids = db.session.scalars(
+            select(Order.id)
+            .where(Order.status.in_(CLOSED_STATUSES), Order.updated_at < cutoff,
+                   ~exists().where(ArchivedOrder.id == Order.id),
+                   ~exists().where(OrderLine.order_id == Order.id, ArchivedOrderLine.id == OrderLine.id),
+                   ~exists().where(Payment.order_id == Order.id, ArchivedPayment.id == Payment.id))
+            .order_by(Order.id)
+            .limit(batch_size)
+        ).all()
+        if not order_ids:
+            return moved
+
+        now = datetime.utcnow()
+        for live, archived, order_column, extra in (
+            (Order, ArchivedOrder, Order.id, {'archived_at': now}),
+            (OrderLine, ArchivedOrderLine, OrderLine.order_id, {}),
+            (Payment, ArchivedPayment, Payment.order_id, {}),
+        ):
+            columns = [column.name for column in live.__table__.columns]
+            db.session.execute(insert(archived).from_select(
+                columns + list(extra),
+                select(*live.__table__.columns, *(literal(value) for value in extra.values()))
+                .where(order_column.in_(order_ids))
+            ))
+        # Children first, for the foreign keys
+        db.session.execute(delete(OrderLine).where(OrderLine.order_id.in_(order_ids)))
+        db.session.execute(delete(Payment).where(Payment.order_id.in_(order_ids)))
+        db.session.execute(delete(Order).where(Order.id.in_(order_ids)))
+        db.session.commit()
+        moved += len(order_ids)
+
+class Archiver:
+    """Runs archive_closed_orders on every venue each ARCHIVE_INTERVAL_SECONDS in a background thread."""
+
+    def __init__(self, app):
+        self.app = app
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='archiver', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        with self.app.app_context():
+            max_age = timedelta(days=self.app.config['ARCHIVE_AFTER_DAYS'])
+            while True:
+                try:
+                    venues = venue_router().venues()
+                except Exception as e:
+                    venues = []
+                    print(f"Archiving failed: {str(e)}")
+                for venue in venues:
+                    with venue_context(venue):
+                        try:
+                            moved = archive_closed_orders(max_age)
+                            if moved:
+                                print(f"Archived {moved} closed orders of {venue}")
+                        except Exception as e:
+                            db.session.rollback()
+                            print(f"Archiving failed for {venue}: {str(e)}")
+                if self._stop.wait(self.app.config['ARCHIVE_INTERVAL_SECONDS']):
+                    return
+
+@archive.route('/orders/history', methods=['GET'])
+@role_required([User.ROLE_ADMIN, User.ROLE_STAFF])
+def get_order_history():
+    """Archived orders with their payments, newest first, filtered by
+    created_at (`from`, `to`) and `table_number`, paged with `before_id`."""
+    try:
+        fields = parse_fields(HISTORY_FIELDS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    query = ArchivedOrder.query.options(selectinload(ArchivedOrder.payments))
+    try:
+        if request.args.get('from'):
+            query = query.filter(ArchivedOrder.created_at >= datetime.fromisoformat(request.args['from']))
+        if request.args.get('to'):
+            query = query.filter(ArchivedOrder.created_at < datetime.fromisoformat(request.args['to']))
+    except ValueError:
+        return jsonify({"error": "from and to must be ISO dates"}), 400
+    table_number = request.args.get('table_number', type=int)
+    if table_number is not None:
+        query = query.filter(ArchivedOrder.table_number == table_number)
+    before_id = request.args.get('before_id', type=int)
+    if before_id is not None:
+        query = query.filter(ArchivedOrder.id < before_id)
+
+    limit = max(1, min(request.args.get('limit', MAX_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    orders = query.order_by(ArchivedOrder.id.desc()).limit(limit).all()
+    return jsonify({
+        'orders': project([order.to_dict() for order in orders], fields),
+        'next_before_id': orders[-1].id if len(orders) == limit else None
+    })
+
+@archive.route('/archive/run', methods=['POST'])
+@role_required([User.ROLE_ADMIN])
+def run_archive():
+    days = (request.get_json(silent=True) or {}).get('older_than_days', current_app.config['ARCHIVE_AFTER_DAYS'])
+    if not isinstance(days, (int, float)) or days < 0:
+        return jsonify({"error": "older_than_days must be a non-negative number"}), 400
+    return jsonify({"archived": archive_closed_orders(timedelta(days=days))})
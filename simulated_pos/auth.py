@@ -1,8 +1,15 @@
-from flask import Blueprint, request, jsonify, make_response
+from flask import Blueprint, current_app, request, jsonify, make_response
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, get_jwt
 from models import db, User
+from cache import identity_cache, table_cache, CachedUser
+from qr import sign_table_token, MAX_BULK_TOKENS
+from limits import limited
+from sharding import current_venue
+from seed import seed_users, table_accounts
 from functools import wraps
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
+import time
 
 auth = Blueprint('auth', __name__)
 
@@ -18,6 +25,32 @@ def role_required(roles):
         return wrapper
     return decorator
 
+def current_identity():
+    """Return the requesting user as a CachedUser.
+
+    Role and table number are taken from the JWT claims when present, so most
+    requests never touch the database; otherwise the identity cache is used.
+    """
+    user_id = int(get_jwt_identity())
+    claims = get_jwt()
+    role = claims.get("role")
+    if role and (role != User.ROLE_TABLE or claims.get("table_number") is not None):
+        table_number = claims.get("table_number")
+        return CachedUser(user_id, None, role, int(table_number) if table_number is not None else None)
+    return identity_cache.get(user_id)
+
+def permission_required(permission):
+    def decorator(fn):
+        @wraps(fn)
+        @jwt_required()
+        def wrapper(*args, **kwargs):
+            jwt = get_jwt()
+            if permission not in User.ROLE_PERMISSIONS.get(jwt.get("role"), []):
+                return jsonify({"error": "Unauthorized"}), 403
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
 @auth.route('/register', methods=['POST'])
 def register():
     data = request.json
@@ -33,10 +66,11 @@ def register():
     
     db.session.add(user)
     db.session.commit()
+    identity_cache.invalidate(user.id)
     
     access_token = create_access_token(
         identity=str(user.id),
-        additional_claims={"role": user.role, "permissions": user.permissions}
+        additional_claims={"role": user.role, "permissions": user.permissions, "venue": current_venue()}
     )
     
     return jsonify({
@@ -46,6 +80,8 @@ def register():
     }), 201
 
 @auth.route('/login', methods=['POST'])
+# Password checks are slow on purpose, so only a few run at once
+@limited('login', shed='login')
 def login():
     data = request.json
     user = User.query.filter_by(username=data['username']).first()
@@ -55,13 +91,14 @@ def login():
     
     access_token = create_access_token(
         identity=user.id,
-        additional_claims={"role": user.role, "table_number": user.table_number}
+        additional_claims={"role": user.role, "table_number": user.table_number, "venue": current_venue()}
     )
     
     response = make_response(jsonify({
         "access_token": access_token,
         "role": user.role,
-        "table_number": user.table_number
+        "table_number": user.table_number,
+        "venue": current_venue()
     }))
     
     origin = request.headers.get('Origin')
@@ -92,6 +129,7 @@ def create_staff():
     
     db.session.add(user)
     db.session.commit()
+    identity_cache.invalidate(user.id)
     
     return jsonify({"message": "Staff account created successfully"}), 201
 
@@ -116,6 +154,8 @@ def create_table():
     
     db.session.add(table_user)
     db.session.commit()
+    identity_cache.invalidate(table_user.id)
+    table_cache.invalidate()
     
     return jsonify({
         "message": f"Table {table_number} created successfully",
@@ -131,20 +171,47 @@ def delete_table(table_number):
         return jsonify({"error": f"Table {table_number} not found"}), 404
     
     db.session.delete(table_user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Foreign keys are enforced, so a table with order history can't be removed
+        db.session.rollback()
+        return jsonify({"error": f"Table {table_number} has orders and cannot be deleted"}), 409
+    identity_cache.invalidate(table_user.id)
+    table_cache.invalidate()
     
     return jsonify({"message": f"Table {table_number} deleted successfully"})
 
+@auth.route('/tables/qr-tokens', methods=['POST'])
+@role_required([User.ROLE_ADMIN])
+def create_table_qr_tokens():
+    """Sign QR tokens for every table, or the `tables` listed, valid for
+    `ttl_hours`; e.g. to print the whole floor plan at once."""
+    data = request.get_json(silent=True) or {}
+    tables = table_cache.all()
+    table_numbers = data.get('tables', sorted(tables))
+    if not isinstance(table_numbers, list) or not all(isinstance(number, int) for number in table_numbers):
+        return jsonify({"error": "tables must be a list of table numbers"}), 400
+    if len(table_numbers) > MAX_BULK_TOKENS:
+        return jsonify({"error": f"At most {MAX_BULK_TOKENS} tables per request"}), 400
+    missing = [number for number in table_numbers if number not in tables]
+    if missing:
+        return jsonify({"error": f"Tables not found: {', '.join(map(str, missing))}"}), 404
+    ttl_hours = data.get('ttl_hours', current_app.config['QR_TOKEN_TTL_HOURS'])
+    if not isinstance(ttl_hours, (int, float)) or ttl_hours <= 0:
+        return jsonify({"error": "ttl_hours must be a positive number"}), 400
+
+    expires_at = time.time() + ttl_hours * 3600
+    return jsonify({
+        "expires_at": datetime.utcfromtimestamp(expires_at).isoformat(),
+        "tokens": [
+            {"table_number": number, "token": sign_table_token(current_venue(), tables[number], number, expires_at)}
+            for number in table_numbers
+        ]
+    })
+
 # Add initialization of tables to app.py
 def create_initial_tables():
     # Create tables 1 through 5 if they don't exist
-    for table_num in range(1, 6):
-        if not User.query.filter_by(table_number=table_num).first():
-            table_user = User(
-                username=f"table{table_num}",
-                role=User.ROLE_TABLE,
-                table_number=table_num
-            )
-            table_user.set_password(f"table{table_num}pass")
-            db.session.add(table_user)
-    db.session.commit()
\ No newline at end of file
+    seed_users(table_accounts(range(1, 6), lambda table_num: f"table{table_num}pass"))
+    db.session.commit()
@@ -0,0 +1,370 @@
+"""End-to-end load test that simulates a full venue against a running server.
+
+Tables scan their QR code (/auth/qr), browse /menu, place orders and pay;
+staff follow the order feed and accept/complete orders; an admin refunds a
+share of the paid orders. Per-route throughput, latency percentiles and
+error rates are written as JSON so runs can be compared between commits.
+
+Start a throwaway server on a temporary database and run for 60 seconds:
+
+    python benchmarks/loadtest.py --spawn --tables 50 --staff 4 --duration 60 \
+        --output results.json
+
+Run against a server that is already up, and compare with an earlier run:
+
+    python benchmarks/loadtest.py --url http://127.0.0.1:5001 --compare results.json
+
+Only the standard library is used, so it runs anywhere the backend does.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from queue import Queue, Empty
+from urllib.parse import urlsplit, urlencode
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Starts the app on a fresh database with every table seeded and stock high
+# enough that the run measures the server rather than the menu running out.
+# Every simulated device shares one address, so per-client rate limits are off
+# for logins and QR scans; signed-in requests are limited per token as usual.
+SERVER_SCRIPT = """
+import sys
+from app import create_app, init_database, create_sample_data
+from config import DEFAULT_CONFIG
+from models import db, MenuItem
+rate_limits = {name: {scope: rate for scope, rate in limits.items() if scope == 'table' or name not in ('login', 'qr')}
+               for name, limits in DEFAULT_CONFIG['RATE_LIMITS'].items()}
+app = create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1], 'RATE_LIMITS': rate_limits})
+with app.app_context():
+    init_database()
+    create_sample_data(table_count=int(sys.argv[2]))
+    MenuItem.query.filter_by(track_stock=True).update({MenuItem.stock: 10 ** 9})
+    db.session.commit()
+app.run(host='127.0.0.1', port=int(sys.argv[3]), threaded=True)
+"""
+
+# Collapse ids in paths so each route is reported once
+ROUTE_PATTERNS = [(re.compile(r'/\d+(?=/|$)'), '/<id>')]
+
+def route_name(method, path):
+    path = path.split('?', 1)[0]
+    for pattern, replacement in ROUTE_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return f"{method} {path}"
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+class Recorder:
+    """Thread-safe collection of (route, status, latency) samples."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, route, status, latency):
+        with self._lock:
+            self.latencies[route].append(latency)
+            self.statuses[route][status] += 1
+
+    def summary(self, elapsed):
+        routes = {}
+        total = errors = 0
+        for route, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            statuses = self.statuses[route]
+            # Server errors and transport failures count as errors; 4xx are
+            # reported per status code since some (409, 429) are expected.
+            route_errors = sum(count for status, count in statuses.items() if status == 0 or status >= 500)
+            routes[route] = {
+                'count': len(samples),
+                'throughput_rps': round(len(samples) / elapsed, 2),
+                'p50_ms': round(percentile(samples, 0.50) * 1000, 2),
+                'p95_ms': round(percentile(samples, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(samples, 0.99) * 1000, 2),
+                'max_ms': round(samples[-1] * 1000, 2),
+                'errors': route_errors,
+                'error_rate': round(route_errors / len(samples), 4),
+                'status_codes': {str(status): count for status, count in sorted(statuses.items())}
+            }
+            total += len(samples)
+            errors += route_errors
+        return {
+            'total_requests': total,
+            'throughput_rps': round(total / elapsed, 2) if elapsed else 0,
+            'error_rate': round(errors / total, 4) if total else 0,
+            'routes': routes
+        }
+
+class Client:
+    """One simulated device: a persistent HTTP connection plus its token."""
+
+    def __init__(self, base_url, recorder, timeout=30):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.recorder = recorder
+        self.timeout = timeout
+        self.token = None
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        started = time.perf_counter()
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self.connection.request(method, path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            raw = response.read()
+            status = response.status
+            response_headers = dict(response.getheaders())
+        except (OSError, http.client.HTTPException):
+            self.connection = None
+            self.recorder.record(route_name(method, path), 0, time.perf_counter() - started)
+            return 0, None, {}
+        self.recorder.record(route_name(method, path), status, time.perf_counter() - started)
+
+        try:
+            data = json.loads(raw) if raw else None
+        except ValueError:
+            data = None
+        return status, data, response_headers
+
+def think(mean):
+    if mean > 0:
+        time.sleep(random.expovariate(1 / mean))
+
+def table_user(args, table_number, recorder, deadline, paid_orders):
+    client = Client(args.url, recorder)
+    qr_token = args.qr_tokens.get(table_number)
+    status, data, _ = client.request('POST', '/auth/qr', {'tableNumber': table_number, 'token': qr_token})
+    if status != 200:
+        return
+    client.token = data['access_token']
+
+    etag = None
+    while time.monotonic() < deadline:
+        status, data, headers = client.request('GET', '/menu', headers={'If-None-Match': etag} if etag else None)
+        if status == 200:
+            etag = headers.get('ETag')
+            menu = data
+        elif status != 304:
+            think(args.think_time)
+            continue
+
+        drinks = [item for item in menu if item['category'] != 'service']
+        if random.random() < args.service_ratio or not drinks:
+            choices = [item for item in menu if item['category'] == 'service']
+        else:
+            choices = drinks
+        lines = [
+            {'id': item['id'], 'quantity': random.randint(1, 2)}
+            for item in random.sample(choices, min(len(choices), random.randint(1, args.max_lines)))
+        ]
+        status, data, _ = client.request('POST', '/orders', {'items': lines})
+        if status == 201 and random.random() < args.pay_ratio:
+            order_id = data['order_id']
+            total = sum(item['price'] * line['quantity'] for line in lines for item in menu if item['id'] == line['id'])
+            status, _, _ = client.request('POST', '/payments', {'order_id': order_id, 'amount': round(total, 2)})
+            if status == 200:
+                paid_orders.put(order_id)
+        think(args.think_time)
+
+def login(client, username, password):
+    status, data, _ = client.request('POST', '/auth/login', {'username': username, 'password': password})
+    if status == 200:
+        client.token = data['access_token']
+    return status == 200
+
+def staff_user(args, username, recorder, deadline):
+    client = Client(args.url, recorder)
+    if not login(client, username, args.staff_password):
+        return
+    cursor = ''
+    while time.monotonic() < deadline:
+        status, data, _ = client.request('GET', '/orders?' + urlencode({'since': cursor, 'limit': 100}))
+        if status == 200:
+            cursor = data['next_cursor'] or cursor
+            for order in data['orders']:
+                if order['status'] == 'Pending':
+                    client.request('PUT', f"/orders/{order['id']}/status", {'status': 'Accepted'})
+                elif order['status'] in ('Accepted', 'Paid') and random.random() < args.complete_ratio:
+                    client.request('PUT', f"/orders/{order['id']}/status", {'status': 'Completed'})
+        think(args.staff_poll)
+
+def admin_user(args, recorder, deadline, paid_orders):
+    client = Client(args.url, recorder)
+    if not login(client, args.admin_username, args.admin_password):
+        return
+    while time.monotonic() < deadline:
+        try:
+            order_id = paid_orders.get(timeout=0.5)
+        except Empty:
+            continue
+        if random.random() < args.refund_ratio:
+            client.request('POST', '/refunds', {'order_id': order_id})
+
+def prepare_accounts(args):
+    """Make sure the simulated tables and staff exist (ignores 'already exists'),
+    and return the signed QR token of every table."""
+    setup = Recorder()
+    client = Client(args.url, setup)
+    if not login(client, args.admin_username, args.admin_password):
+        sys.exit(f"Could not log in as {args.admin_username} to prepare accounts")
+    for table_number in range(1, args.tables + 1):
+        client.request('POST', '/auth/tables', {'table_number': table_number})
+    for index in range(1, args.staff + 1):
+        client.request('POST', '/auth/create-staff', {'username': f"staff{index}", 'password': args.staff_password})
+    status, data, _ = client.request('POST', '/auth/tables/qr-tokens', {'tables': list(range(1, args.tables + 1))})
+    if status != 200:
+        sys.exit(f"Could not get QR tokens for the tables ({status})")
+    return {entry['table_number']: entry['token'] for entry in data['tokens']}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def spawn_server(args):
+    database = os.path.join(tempfile.mkdtemp(prefix='loadtest-'), 'bench.db')
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-c', SERVER_SCRIPT, f"sqlite:///{database}", str(args.tables), str(port)],
+        cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    args.url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.1):
+                return process
+        except OSError:
+            if process.poll() is not None:
+                sys.exit("Benchmark server exited during startup")
+            time.sleep(0.1)
+    process.terminate()
+    sys.exit("Benchmark server did not start")
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    recorder = Recorder()
+    paid_orders = Queue()
+    started = time.monotonic()
+    deadline = started + args.ramp_up + args.duration
+
+    threads = []
+    users = [(table_user, (args, table_number, recorder, deadline, paid_orders))
+             for table_number in range(1, args.tables + 1)]
+    users += [(staff_user, (args, f"staff{index}", recorder, deadline)) for index in range(1, args.staff + 1)]
+    if args.refund_ratio > 0:
+        users.append((admin_user, (args, recorder, deadline, paid_orders)))
+
+    # Spread arrivals over the ramp-up so logins don't all land at once
+    for index, (target, target_args) in enumerate(users):
+        thread = threading.Thread(target=target, args=target_args, daemon=True)
+        threads.append(thread)
+        thread.start()
+        if args.ramp_up > 0:
+            time.sleep(args.ramp_up / len(users))
+    for thread in threads:
+        thread.join(timeout=max(0, deadline - time.monotonic()) + 30)
+
+    elapsed = time.monotonic() - started
+    return {
+        'commit': git_commit(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - elapsed)),
+        'elapsed_s': round(elapsed, 2),
+        'parameters': {
+            key: value for key, value in vars(args).items()
+            if key not in ('output', 'compare', 'admin_password', 'staff_password', 'qr_tokens')
+        },
+        **recorder.summary(elapsed)
+    }
+
+def print_report(results, previous=None):
+    print(f"{results['total_requests']} requests, {results['throughput_rps']} req/s, "
+          f"error rate {results['error_rate']:.2%}")
+    header = f"{'route':32} {'count':>7} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err%':>6}"
+    if previous:
+        header += f" {'p95 vs prev':>12}"
+    print(header)
+    for route, stats in results['routes'].items():
+        line = (f"{route:32} {stats['count']:>7} {stats['throughput_rps']:>8} {stats['p50_ms']:>8} "
+                f"{stats['p95_ms']:>8} {stats['p99_ms']:>8} {stats['error_rate'] * 100:>6.2f}")
+        before = (previous or {}).get('routes', {}).get(route)
+        if before and before['p95_ms']:
+            line += f" {(stats['p95_ms'] - before['p95_ms']) / before['p95_ms']:>+12.1%}"
+        print(line)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5001', help='server to test')
+    parser.add_argument('--spawn', action='store_true', help='start a local server on a temporary database')
+    parser.add_argument('--tables', type=int, default=20, help='number of simulated tables')
+    parser.add_argument('--staff', type=int, default=2, help='number of simulated staff members')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of steady load after ramp-up')
+    parser.add_argument('--ramp-up', type=float, default=5, help='seconds over which users arrive')
+    parser.add_argument('--think-time', type=float, default=2.0, help='mean seconds a table waits between orders')
+    parser.add_argument('--staff-poll', type=float, default=1.0, help='mean seconds between staff feed polls')
+    parser.add_argument('--max-lines', type=int, default=3, help='maximum line items per order')
+    parser.add_argument('--service-ratio', type=float, default=0.1, help='share of orders that are service requests')
+    parser.add_argument('--pay-ratio', type=float, default=0.5, help='share of orders paid straight away')
+    parser.add_argument('--refund-ratio', type=float, default=0.05, help='share of paid orders refunded')
+    parser.add_argument('--complete-ratio', type=float, default=0.8, help='chance staff complete an accepted order per poll')
+    parser.add_argument('--admin-username', default='admin')
+    parser.add_argument('--admin-password', default='admin123')
+    parser.add_argument('--staff-password', default='staff123')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--compare', help='earlier JSON results to compare p95 latency against')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = spawn_server(args) if args.spawn else None
+    try:
+        args.qr_tokens = prepare_accounts(args)
+        results = run(args)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(results, previous)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Micro-benchmark of what it costs to send 1,000 orders as JSON.
+
+Times Order.to_dict(), encoding with each JSON provider, ?fields= projection
+and compression, and reports the bytes that would go over the wire:
+
+    python benchmarks/serialization.py --orders 1000 --repeat 50
+
+No database or server is needed; the orders are built in memory.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask.json.provider import DefaultJSONProvider
+from app import create_app
+from encoding import OrjsonProvider, compress, orjson, brotli
+from models import Order
+from routes import project
+
+MENU = [('Mojito', 8.5), ('Vodka', 8.0), ('Gin', 7.0), ('Waiter Service', 0.0)]
+# What the staff order list actually renders
+LIST_FIELDS = ('id', 'table_number', 'status', 'items', 'staff_name')
+
+def make_orders(count):
+    started = datetime(2024, 1, 1, 18)
+    orders = []
+    for order_id in range(1, count + 1):
+        items = [
+            {'id': index + 1, 'name': name, 'price': price, 'quantity': random.randint(1, 3)}
+            for index, (name, price) in enumerate(random.sample(MENU, random.randint(1, 3)))
+        ]
+        created_at = started + timedelta(seconds=order_id * 7)
+        orders.append(Order(
+            id=order_id,
+            user_id=4 + order_id % 5,
+            table_number=1 + order_id % 5,
+            items=items,
+            total_price=sum(item['price'] * item['quantity'] for item in items),
+            status=random.choice([Order.STATUS_PENDING, Order.STATUS_ACCEPTED, Order.STATUS_COMPLETED]),
+            is_service=False,
+            created_at=created_at,
+            updated_at=created_at,
+        ))
+    return orders
+
+def timed(function, repeat):
+    """Best of `repeat` runs, in milliseconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--orders', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    random.seed(1)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+    providers = {'default': DefaultJSONProvider(app)}
+    if orjson is not None:
+        providers['orjson'] = OrjsonProvider(app)
+    encodings = ['gzip'] + (['br'] if brotli is not None else [])
+
+    with app.app_context():
+        orders = make_orders(args.orders)
+        rows = [order.to_dict() for order in orders]
+        narrow = project(rows, LIST_FIELDS)
+
+        print(f"{args.orders} orders, best of {args.repeat}")
+        print(f"{'step':38} {'ms':>8} {'bytes':>10}")
+        print(f"{'to_dict':38} {timed(lambda: [order.to_dict() for order in orders], args.repeat):>8.2f}")
+        print(f"{'project to ' + str(len(LIST_FIELDS)) + ' fields':38} "
+              f"{timed(lambda: project(rows, LIST_FIELDS), args.repeat):>8.2f}")
+        for name, provider in providers.items():
+            for label, data in (('all fields', rows), ('projected', narrow)):
+                ms = timed(lambda: provider.response(data).get_data(), args.repeat)
+                body = provider.response(data).get_data()
+                print(f"{name + ' encode, ' + label:38} {ms:>8.2f} {len(body):>10}")
+        body = providers.get('orjson', providers['default']).response(rows).get_data()
+        for encoding in encodings:
+            level = app.config['COMPRESS_LEVEL']
+            ms = timed(lambda: compress(body, encoding, level), args.repeat)
+            print(f"{encoding + ' level ' + str(level) + ', all fields':38} {ms:>8.2f} "
+                  f"{len(compress(body, encoding, level)):>10}")
+
+if __name__ == '__main__':
+    main()
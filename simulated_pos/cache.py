@@ -0,0 +1,226 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from collections import OrderedDict, namedtuple
+from models import db, MenuItem, User
+from sharding import VenueLocal
+import multiprocessing
+import threading
+import time
+import uuid
+
+class MenuCache:
+    """Process-wide copy of the serialized menu.
+
+    Every change to a MenuItem row bumps `version` and drops the cached list,
+    so the version doubles as the ETag for conditional GETs of /menu.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = None
+        self._epoch = uuid.uuid4().hex[:8]  # keeps ETags unique across restarts
+        self._shared_version = None
+        self.version = 0
+
+    @property
+    def etag(self):
+        return f"menu-{self._epoch}-{self.version}"
+
+    def share_across_processes(self):
+        """Keep the version in shared memory so forked workers see each other's
+        invalidations. Call before forking."""
+        self._shared_version = multiprocessing.Value('q', self.version)
+
+    def invalidate(self):
+        with self._lock:
+            if self._shared_version is not None:
+                with self._shared_version.get_lock():
+                    self._shared_version.value += 1
+                    self.version = self._shared_version.value
+            else:
+                self.version += 1
+            self._items = None
+
+    def _sync(self):
+        # Another process changed the menu since we cached it
+        if self._shared_version is not None and self._shared_version.value != self.version:
+            self.version = self._shared_version.value
+            self._items = None
+
+    def get(self):
+        """Return `(etag, items)`, loading the menu from the database on a miss."""
+        with self._lock:
+            self._sync()
+            if self._items is not None:
+                return self.etag, self._items
+            version = self.version
+
+        items = [item.to_dict() for item in MenuItem.query.order_by(MenuItem.id)]
+
+        with self._lock:
+            self._sync()
+            # Don't cache a list that was invalidated while it was being loaded
+            if self.version == version:
+                self._items = items
+            return f"menu-{self._epoch}-{version}", items
+
+# Each venue has its own caches; these names stand for the current venue's
+menu_caches = VenueLocal(MenuCache)
+menu_cache = menu_caches.proxy
+
+# Detached, read-only view of a user that is safe to share between requests
+CachedUser = namedtuple('CachedUser', ['id', 'username', 'role', 'table_number'])
+
+class IdentityCache:
+    """Bounded LRU of user identities with a time-to-live.
+
+    Misses are cached too, so tokens for deleted users don't hit the
+    database either; callers invalidate ids whenever accounts change.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared_generation = None
+        self._generation = 0
+
+    def share_across_processes(self):
+        """Share an invalidation counter between forked workers; any invalidation
+        clears every worker's cache. Call before forking."""
+        self._shared_generation = multiprocessing.Value('q', self._generation)
+
+    def _sync(self):
+        if self._shared_generation is not None and self._shared_generation.value != self._generation:
+            self._generation = self._shared_generation.value
+            self._entries.clear()
+
+    def get(self, user_id):
+        """Return a CachedUser for `user_id`, or None if there is no such user."""
+        now = time.monotonic()
+        with self._lock:
+            self._sync()
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+
+        user = db.session.get(User, user_id)
+        cached = CachedUser(user.id, user.username, user.role, user.table_number) if user else None
+
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl, cached)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return cached
+
+    def warm(self, users):
+        """Preload entries for `users` (User rows), e.g. before workers start."""
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for user in users:
+                self._entries[user.id] = (expires, CachedUser(user.id, user.username, user.role, user.table_number))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            if self._shared_generation is not None:
+                with self._shared_generation.get_lock():
+                    self._shared_generation.value += 1
+                    self._generation = self._shared_generation.value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+identity_caches = VenueLocal(IdentityCache)
+identity_cache = identity_caches.proxy
+
+class TableCache:
+    """Table number -> table user id for every table, loaded with one query.
+
+    Callers invalidate it whenever table accounts are created or deleted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = None
+        self._shared_generation = None
+        self._generation = 0
+
+    def share_across_processes(self):
+        """Share an invalidation counter between forked workers. Call before forking."""
+        self._shared_generation = multiprocessing.Value('q', self._generation)
+
+    def _sync(self):
+        if self._shared_generation is not None and self._shared_generation.value != self._generation:
+            self._generation = self._shared_generation.value
+            self._users = None
+
+    def all(self):
+        """Return `{table_number: user_id}`, loading it from the database on a miss."""
+        with self._lock:
+            self._sync()
+            if self._users is not None:
+                return self._users
+            generation = self._generation
+
+        users = dict(db.session.query(User.table_number, User.id).filter(
+            User.role == User.ROLE_TABLE, User.table_number.isnot(None)
+        ))
+
+        with self._lock:
+            self._sync()
+            if self._generation == generation:
+                self._users = users
+            return users
+
+    def get(self, table_number):
+        return self.all().get(table_number)
+
+    def invalidate(self):
+        with self._lock:
+            self._users = None
+            if self._shared_generation is not None:
+                with self._shared_generation.get_lock():
+                    self._shared_generation.value += 1
+                    self._generation = self._shared_generation.value
+            else:
+                self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._users = None
+
+table_caches = VenueLocal(TableCache)
+table_cache = table_caches.proxy
+
+# Invalidate the menu after any commit that wrote MenuItem rows, whether
+# through the unit of work or a bulk UPDATE such as the stock reservation.
+@event.listens_for(Session, 'after_flush')
+def track_menu_flush(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, MenuItem):
+            session.info['menu_changed'] = True
+            return
+
+@event.listens_for(Session, 'do_orm_execute')
+def track_menu_statement(orm_execute_state):
+    if orm_execute_state.is_select:
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and mapper.class_ is MenuItem:
+        orm_execute_state.session.info['menu_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_menu_on_commit(session):
+    if session.info.pop('menu_changed', False):
+        menu_cache.invalidate()
+
+@event.listens_for(Session, 'after_rollback')
+def discard_menu_changes(session):
+    session.info.pop('menu_changed', None)
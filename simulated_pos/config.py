@@ -0,0 +1,100 @@
+from sqlalchemy import event
+import os
+
+# Defaults for create_app; anything passed to create_app(config) overrides them
+DEFAULT_CONFIG = {
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL', 'sqlite:///database.db'),
+    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    # Database of each venue added with POST /venues (see sharding.py);
+    # {instance} is the app's instance folder
+    'VENUE_DATABASE_URL': os.environ.get('VENUE_DATABASE_URL', 'sqlite:///{instance}/venue-{venue}.db'),
+    'JWT_SECRET_KEY': os.environ.get('JWT_SECRET_KEY', 'your-secret-key'),
+    'DB_ENGINE_PROFILE': os.environ.get('DB_ENGINE_PROFILE', 'sqlite'),
+    # sqlite profile
+    'DB_BUSY_TIMEOUT_MS': 5000,
+    'DB_FOREIGN_KEYS': True,
+    # pooled profile
+    'DB_POOL_SIZE': 10,
+    'DB_MAX_OVERFLOW': 20,
+    'DB_POOL_RECYCLE': 1800,
+    # Reserve tracked stock against in-memory counters, flushed to the
+    # database every STOCK_FLUSH_INTERVAL_SECONDS (see stock.py)
+    'STOCK_WRITE_BEHIND': True,
+    'STOCK_FLUSH_INTERVAL_SECONDS': 1.0,
+    # Closed orders older than this move to the archive tables (see archive.py)
+    'ARCHIVE_AFTER_DAYS': int(os.environ.get('ARCHIVE_AFTER_DAYS', 7)),
+    'ARCHIVE_INTERVAL_SECONDS': 3600,
+    # Table QR tokens (see qr.py); signed with JWT_SECRET_KEY unless QR_TOKEN_SECRET is set
+    'QR_TOKEN_SECRET': os.environ.get('QR_TOKEN_SECRET'),
+    'QR_TOKEN_TTL_HOURS': 24,
+    # Scans allowed per token and worker process; 1 makes every code single-use
+    'QR_TOKEN_MAX_SCANS': int(os.environ.get('QR_TOKEN_MAX_SCANS', 200)),
+    # Token buckets per client (token subject, else address) and per table,
+    # as (requests per second, burst); requests over them get 429 (see limits.py)
+    'RATE_LIMITS': {
+        'login': {'client': (1, 10)},
+        'qr': {'client': (1, 10), 'table': (0.5, 10)},
+        'orders': {'client': (5, 30), 'table': (2, 10)},
+        'payments': {'client': (5, 30), 'table': (2, 10)},
+    },
+    # Proxies in front of the app whose X-Forwarded-For/-Proto are trusted;
+    # 0 uses the connecting address as is
+    'PROXY_FIX': int(os.environ.get('PROXY_FIX', 0)),
+    # 'auto' uses orjson when it's installed, 'default' Flask's own (see encoding.py)
+    'JSON_PROVIDER': os.environ.get('JSON_PROVIDER', 'auto'),
+    # Responses at least this big are sent gzip or br compressed if the client accepts it
+    'COMPRESS_MIN_SIZE': 1024,
+    'COMPRESS_LEVEL': 6,
+    # Open /events streams per worker. Each holds a thread while it is open, so
+    # keep this below serve.py's --threads; clients past it get long polls that
+    # end after EVENTS_LONG_POLL_SECONDS, or at the first event (see events.py)
+    'EVENTS_MAX_STREAMS': 16,
+    'EVENTS_LONG_POLL_SECONDS': 5,
+    # Requests of each kind allowed to run at once per worker; the rest get 503
+    'CONCURRENCY_LIMITS': {
+        'login': 4,
+        'writes': 16,
+    },
+}
+
+# Named engine profiles. Each returns the SQLAlchemy engine options and the
+# PRAGMAs to run on every new connection for the given app config.
+ENGINE_PROFILES = {
+    # No tuning at all; SQLAlchemy defaults
+    'default': lambda config: ({}, {}),
+    # Local SQLite file. WAL lets the polling readers keep reading while one
+    # writer commits, and busy_timeout makes a blocked writer wait for the
+    # lock instead of failing the request with "database is locked".
+    'sqlite': lambda config: ({}, {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': config['DB_BUSY_TIMEOUT_MS'],
+        'foreign_keys': 'ON' if config['DB_FOREIGN_KEYS'] else 'OFF',
+    }),
+    # Client/server database (e.g. PostgreSQL) behind a connection pool
+    'pooled': lambda config: ({
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }, {}),
+}
+
+def engine_profile(config):
+    """Return `(engine_options, pragmas)` for the profile named in `config`."""
+    name = config['DB_ENGINE_PROFILE']
+    if name not in ENGINE_PROFILES:
+        raise ValueError(f"Unknown DB_ENGINE_PROFILE: {name}")
+    return ENGINE_PROFILES[name](config)
+
+def apply_pragmas(engine, pragmas):
+    """Run `pragmas` on every new SQLite connection made by `engine`."""
+    if not pragmas or engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
@@ -0,0 +1,302 @@
+from flask import Blueprint, request, jsonify
+from sqlalchemy import event, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from bisect import bisect_left, insort
+from collections import Counter, deque
+from datetime import datetime
+from models import db, Order, StaffShift, User
+from auth import role_required, current_identity
+from cache import identity_cache
+from events import broker, broker_listeners
+from sharding import VenueLocal
+import threading
+
+dispatch = Blueprint('dispatch', __name__)
+
+# Seconds of head start each kind of request gets in the queue, so urgent
+# requests go first without older ones waiting forever behind them
+SERVICE_PRIORITY = {
+    'Waiter Service': 120,
+    'Bottle Show Service': 60,
+    'Empty Glasses': 0,
+}
+# Most recent acknowledge times kept for the statistics
+ACK_SAMPLES = 1000
+# Events carrying an order; any that finds a request no longer Pending takes it off the queue
+ORDER_EVENTS = ('order_created', 'order_updated', 'payment_processed', 'order_refunded')
+
+EPOCH = datetime(1970, 1, 1)
+
+def request_rank(order_id, items, created_at):
+    """Sort key for a service request: its age, less its priority head start."""
+    head_start = max((SERVICE_PRIORITY.get(item.get('name'), 0) for item in items), default=0)
+    return (created_at - EPOCH).total_seconds() - head_start, order_id
+
+class Dispatcher:
+    """Pending service requests queued per staff member, by age and type.
+
+    assign() picks the on-shift staff member with the fewest pending requests,
+    and new_order() stores the choice in order.staff_id. After loading once
+    from the database, the queues follow the broker's order events, so every
+    worker process keeps the same picture without reading the order table.
+    With several workers that picture can trail the database by one relay poll.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+        self._entries = {}          # order id -> (rank, staff id, summary)
+        self._queues = {}           # staff id, None if unassigned -> sorted ranks
+        self._on_shift = {}         # staff id -> username
+        self._held = Counter()      # staff id -> assignments not committed yet
+        self._last_assigned = {}    # staff id -> assignment number, to break ties
+        self._assignments = 0
+        self._acks = deque(maxlen=ACK_SAMPLES)
+        self._acks_by_staff = {}    # staff id -> [count, total seconds]
+
+    def reset(self):
+        with self._lock:
+            self.loaded = False
+            self._entries.clear()
+            self._queues.clear()
+            self._on_shift.clear()
+            self._held.clear()
+            self._last_assigned.clear()
+            self._acks.clear()
+            self._acks_by_staff.clear()
+
+    def load(self):
+        """Rebuild the queues and the shift roster from the database."""
+        shifts = db.session.execute(
+            select(User.id, User.username).join(StaffShift, StaffShift.staff_id == User.id)
+        ).all()
+        pending = db.session.execute(
+            select(Order.id, Order.table_number, Order.items, Order.created_at, Order.staff_id)
+            .where(Order.status == Order.STATUS_PENDING, Order.is_service.is_(True))
+        ).all()
+        with self._lock:
+            self._entries.clear()
+            self._queues.clear()
+            self._on_shift = dict(shifts)
+            for row in pending:
+                self._track(row.id, row.table_number, row.items or [], row.created_at, row.staff_id)
+            self.loaded = True
+
+    def _ensure_loaded(self):
+        # Caller holds the lock
+        if not self.loaded:
+            self.load()
+
+    def _track(self, order_id, table_number, items, created_at, staff_id):
+        self._untrack(order_id)
+        rank = request_rank(order_id, items, created_at)
+        self._entries[order_id] = (rank, staff_id, {
+            'order_id': order_id,
+            'table_number': table_number,
+            'items': [item.get('name') for item in items],
+            'created_at': created_at.isoformat(),
+            'staff_id': staff_id
+        })
+        insort(self._queues.setdefault(staff_id, []), rank)
+
+    def _untrack(self, order_id):
+        entry = self._entries.pop(order_id, None)
+        if entry is not None:
+            rank, staff_id, _ = entry
+            queue = self._queues[staff_id]
+            del queue[bisect_left(queue, rank)]
+        return entry
+
+    def ingest(self, event):
+        """Broker listener: follow service requests and shifts through their events."""
+        data = event['data']
+        with self._lock:
+            if not self.loaded:
+                return
+            if event['type'] == 'staff_shift':
+                self.set_on_shift(data['staff_id'], data['staff_name'], data['on_shift'])
+                return
+            if event['type'] not in ORDER_EVENTS or not data.get('is_service'):
+                return
+            if data['status'] == Order.STATUS_PENDING:
+                self._track(data['id'], data['table_number'], data['items'],
+                            datetime.fromisoformat(data['created_at']), data['staff_id'])
+                return
+            # Replayed events find no entry, so each acknowledgement counts once
+            if self._untrack(data['id']) is not None and data['status'] == Order.STATUS_ACCEPTED:
+                waited = datetime.fromisoformat(data['updated_at']) - datetime.fromisoformat(data['created_at'])
+                self._record_ack(data['staff_id'], max(waited.total_seconds(), 0.0))
+
+    def _record_ack(self, staff_id, seconds):
+        self._acks.append(seconds)
+        totals = self._acks_by_staff.setdefault(staff_id, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+    def set_on_shift(self, staff_id, staff_name, on_shift):
+        with self._lock:
+            self._ensure_loaded()
+            if on_shift:
+                self._on_shift[staff_id] = staff_name
+            else:
+                self._on_shift.pop(staff_id, None)
+
+    def assign(self):
+        """Return the on-shift staff member with the fewest pending requests,
+        or None if nobody is on shift. The pick counts towards their load
+        until the current transaction ends."""
+        with self._lock:
+            self._ensure_loaded()
+            if not self._on_shift:
+                return None
+            staff_id = min(self._on_shift, key=lambda candidate: (
+                len(self._queues.get(candidate, ())) + self._held[candidate],
+                self._last_assigned.get(candidate, 0)
+            ))
+            self._held[staff_id] += 1
+            self._assignments += 1
+            self._last_assigned[staff_id] = self._assignments
+        db.session.info.setdefault('dispatch_held', []).append(staff_id)
+        return staff_id
+
+    def release(self, staff_ids):
+        with self._lock:
+            for staff_id in staff_ids:
+                self._held[staff_id] -= 1
+
+    def queue(self, staff_id):
+        """Pending requests for `staff_id` (None: unassigned), next one first."""
+        with self._lock:
+            self._ensure_loaded()
+            return [self._entries[order_id][2] for _, order_id in self._queues.get(staff_id, ())]
+
+    def is_on_shift(self, staff_id):
+        with self._lock:
+            self._ensure_loaded()
+            return staff_id in self._on_shift
+
+    def stats(self):
+        with self._lock:
+            self._ensure_loaded()
+            samples = sorted(self._acks)
+            staff = []
+            for staff_id, staff_name in sorted(self._on_shift.items()):
+                count, total = self._acks_by_staff.get(staff_id, (0, 0.0))
+                staff.append({
+                    'staff_id': staff_id,
+                    'staff_name': staff_name,
+                    'pending': len(self._queues.get(staff_id, ())),
+                    'acknowledged': count,
+                    'mean_ack_seconds': round(total / count, 1) if count else None
+                })
+            return {
+                'pending': len(self._entries),
+                'unassigned': len(self._queues.get(None, ())),
+                'staff': staff,
+                'ack_seconds': {
+                    'count': len(samples),
+                    'mean': round(sum(samples) / len(samples), 1) if samples else None,
+                    'p50': percentile(samples, 0.5),
+                    'p90': percentile(samples, 0.9),
+                    'max': round(samples[-1], 1) if samples else None
+                }
+            }
+
+def percentile(samples, fraction):
+    # Nearest rank on already sorted samples
+    if not samples:
+        return None
+    return round(samples[min(len(samples) - 1, int(fraction * len(samples)))], 1)
+
+# Each venue dispatches its own requests, following its own venue's events
+dispatchers = VenueLocal(Dispatcher)
+dispatcher = dispatchers.proxy
+broker_listeners.append(lambda event: dispatcher.ingest(event))
+
+# Assignments stop counting as held once the order is committed (its event
+# puts it in the queue) or rolled back
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def release_assignments(session):
+    held = session.info.pop('dispatch_held', None)
+    if held:
+        dispatcher.release(held)
+
+def redistribute(order_ids, from_staff_id):
+    """Hand pending requests of `from_staff_id` (None: unassigned) to the
+    least-loaded staff on shift, with one conditional UPDATE per recipient.
+    Requests acknowledged or reassigned meanwhile are left alone."""
+    recipients = {}
+    for order_id in order_ids:
+        recipients.setdefault(dispatcher.assign(), []).append(order_id)
+    recipients.pop(from_staff_id, None)
+
+    now = datetime.utcnow()
+    events = []
+    for staff_id, ids in recipients.items():
+        staff = identity_cache.get(staff_id) if staff_id else None
+        orders = db.session.execute(
+            update(Order)
+            .where(Order.id.in_(ids), Order.status == Order.STATUS_PENDING, Order.staff_id == from_staff_id)
+            .values(staff_id=staff_id, updated_at=now)
+            .returning(Order),
+            execution_options={"synchronize_session": False}
+        ).scalars().all()
+        events += [
+            ('order_updated', {**order.to_dict(), 'staff_name': staff.username if staff else None}, order.table_number)
+            for order in orders
+        ]
+    db.session.commit()
+    broker.publish_many(events)
+    return len(events)
+
+@dispatch.route('/dispatch/shift', methods=['POST', 'DELETE'])
+@role_required([User.ROLE_STAFF])
+def change_shift():
+    """Start (POST) or end (DELETE) the caller's shift. Unassigned requests go
+    to staff coming on shift; the requests of staff going off shift go to the
+    others, or back to unassigned if nobody else is on."""
+    user = current_identity()
+    on_shift = request.method == 'POST'
+    try:
+        if on_shift:
+            if db.session.get(StaffShift, user.id) is None:
+                db.session.add(StaffShift(staff_id=user.id))
+        else:
+            db.session.query(StaffShift).filter_by(staff_id=user.id).delete()
+        db.session.commit()
+    except IntegrityError:
+        # Started concurrently from another device
+        db.session.rollback()
+
+    # Identities built from token claims have no username
+    staff = identity_cache.get(user.id)
+    staff_name = staff.username if staff else None
+    # Updated here at once, for the redistribution below; other workers follow the event
+    dispatcher.set_on_shift(user.id, staff_name, on_shift)
+    broker.publish('staff_shift', {'staff_id': user.id, 'staff_name': staff_name, 'on_shift': on_shift})
+
+    if on_shift:
+        moved = redistribute([entry['order_id'] for entry in dispatcher.queue(None)], None)
+    else:
+        moved = redistribute([entry['order_id'] for entry in dispatcher.queue(user.id)], user.id)
+    return jsonify({'on_shift': on_shift, 'reassigned': moved, 'requests': dispatcher.queue(user.id)})
+
+@dispatch.route('/dispatch/queue', methods=['GET'])
+@role_required([User.ROLE_STAFF])
+def get_queue():
+    """The caller's pending service requests, next one first, without
+    touching the order table."""
+    user = current_identity()
+    return jsonify({
+        'on_shift': dispatcher.is_on_shift(user.id),
+        'requests': dispatcher.queue(user.id),
+        'unassigned': dispatcher.queue(None)
+    })
+
+@dispatch.route('/dispatch/stats', methods=['GET'])
+@role_required([User.ROLE_ADMIN, User.ROLE_STAFF])
+def get_dispatch_stats():
+    """Queue sizes, load per on-shift staff member and time-to-acknowledge."""
+    return jsonify(dispatcher.stats())
@@ -0,0 +1,92 @@
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+import gzip
+
+# Optional speedups; the standard library is used when they aren't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response types worth compressing; streamed responses (exports, events) never are
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/html'}
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson.
+
+    Output matches the default provider except that keys keep their order
+    instead of being sorted; dates and anything else orjson can't encode
+    natively go through the default provider's conversions.
+    """
+
+    sort_keys = False
+
+    def _encode(self, obj, indent=False, sort_keys=None):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if self.sort_keys if sort_keys is None else sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def dumps(self, obj, **kwargs):
+        return self._encode(obj, indent=kwargs.get('indent'), sort_keys=kwargs.get('sort_keys')).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(self._encode(obj, indent=indent) + b"\n", mimetype=self.mimetype)
+
+JSON_PROVIDERS = {
+    'default': DefaultJSONProvider,
+    'orjson': OrjsonProvider,
+}
+
+def init_json(app):
+    """Install the JSON_PROVIDER named in the config; 'auto' picks orjson when it's installed."""
+    name = app.config['JSON_PROVIDER']
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'default'
+    if name not in JSON_PROVIDERS:
+        raise ValueError(f"Unknown JSON_PROVIDER: {name}")
+    if name == 'orjson' and orjson is None:
+        raise RuntimeError("JSON_PROVIDER is orjson but orjson is not installed")
+    app.json = JSON_PROVIDERS[name](app)
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        # Brotli quality runs 0-11; scale the gzip-style level to it
+        return brotli.compress(data, quality=min(11, level + 1))
+    return gzip.compress(data, compresslevel=level)
+
+def init_compression(app):
+    """Compress responses of COMPRESS_MIN_SIZE bytes or more with br or gzip,
+    whichever the client prefers (br only when brotli is installed)."""
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    @app.after_request
+    def compress_response(response):
+        if (response.mimetype not in COMPRESSIBLE_MIMETYPES or response.is_streamed
+                or response.direct_passthrough or response.status_code in (204, 206, 304)
+                or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(encodings)
+        data = response.get_data()
+        if encoding is None or len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+
+        response.set_data(compress(data, encoding, app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = encoding
+        # The bytes differ per encoding, so a strong validator would be wrong
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
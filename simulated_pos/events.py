@@ -0,0 +1,262 @@
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
+from flask_jwt_extended import jwt_required, get_jwt
+from sqlalchemy import delete, insert, select
+from collections import deque
+from datetime import datetime
+from models import OrderEvent
+from sharding import DEFAULT_VENUE, VenueLocal, venue_context, venue_engine
+from limits import concurrency_limiter
+import json
+import threading
+
+events = Blueprint('events', __name__)
+
+class EventBroker:
+    """In-process publish/subscribe for order events.
+
+    Keeps the most recent events in a ring buffer so a reconnecting client
+    can resume from its Last-Event-ID instead of reloading everything.
+    """
+
+    def __init__(self, history=1000, listeners=None):
+        self.history = history
+        self.relay = None
+        self.closed = False
+        # Called with every event as it enters the buffer, under the broker's
+        # lock; they must be quick and must not publish
+        self.listeners = [] if listeners is None else listeners
+        self._events = deque(maxlen=history)
+        self._last_id = 0
+        self._condition = threading.Condition()
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def publish(self, event_type, data, table_number=None):
+        # With several worker processes, events go through the relay's shared
+        # log and come back to every worker's broker (this one too) via deliver()
+        if self.relay is not None:
+            return self.relay.publish(event_type, data, table_number)
+        with self._condition:
+            return self._append(self._last_id + 1, event_type, data, table_number)
+
+    def publish_many(self, events):
+        """Publish `(event_type, data, table_number)` tuples together; waiting
+        streams are woken once for the whole batch."""
+        if self.relay is not None:
+            return self.relay.publish_many(events)
+        with self._condition:
+            for event_type, data, table_number in events:
+                self._append(self._last_id + 1, event_type, data, table_number, notify=False)
+            self._condition.notify_all()
+
+    def deliver(self, event_id, event_type, data, table_number=None):
+        """Add an event that already has an id, e.g. one read from the relay log."""
+        with self._condition:
+            if event_id > self._last_id:
+                self._append(event_id, event_type, data, table_number)
+
+    def _append(self, event_id, event_type, data, table_number, notify=True):
+        self._last_id = event_id
+        event = {
+            'id': event_id,
+            'type': event_type,
+            'table_number': table_number,
+            'data': data
+        }
+        self._events.append(event)
+        for listener in self.listeners:
+            listener(event)
+        if notify:
+            self._condition.notify_all()
+        return event_id
+
+    def close(self):
+        """Wake every waiting stream so it can finish, e.g. on graceful shutdown."""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def wait(self, last_id, timeout):
+        """Block until there are events after `last_id` or `timeout` expires.
+
+        Returns `(events, complete)`; `complete` is False when the client is
+        too far behind (or ahead, after a restart) to be resumed from the buffer.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._last_id != last_id or self.closed, timeout)
+            if last_id > self._last_id:
+                return [], False
+            if last_id == self._last_id:
+                return [], True
+            if not self._events or last_id < self._events[0]['id'] - 1:
+                return list(self._events), False
+            pending = []
+            for event in reversed(self._events):
+                if event['id'] <= last_id:
+                    break
+                pending.append(event)
+            pending.reverse()
+            return pending, True
+
+class EventRelay:
+    """Shares events between worker processes through the order_event table.
+
+    publish() appends a row; a background thread in every worker tails the
+    table and hands new rows to that worker's broker. One small indexed query
+    per worker per poll, however many streams are connected. Each venue has
+    its own relay, reading its own database.
+    """
+
+    def __init__(self, broker, app, venue=DEFAULT_VENUE, poll_interval=0.25, retain=10000):
+        self.broker = broker
+        self.app = app
+        self.venue = venue
+        self.poll_interval = poll_interval
+        self.retain = retain
+        self._stop = threading.Event()
+        self._thread = None
+
+    def publish(self, event_type, data, table_number=None):
+        with venue_engine(self.venue).begin() as connection:
+            result = connection.execute(insert(OrderEvent).values(
+                event_type=event_type,
+                table_number=table_number,
+                data=data,
+                created_at=datetime.utcnow()
+            ))
+            return result.inserted_primary_key[0]
+
+    def publish_many(self, events):
+        if not events:
+            return
+        now = datetime.utcnow()
+        with venue_engine(self.venue).begin() as connection:
+            connection.execute(insert(OrderEvent), [{
+                'event_type': event_type,
+                'table_number': table_number,
+                'data': data,
+                'created_at': now
+            } for event_type, data, table_number in events])
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f'event-relay-{self.venue}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        with self.app.app_context(), venue_context(self.venue):
+            # Refill the buffer from the log so Last-Event-ID resumes across workers
+            cursor = self._poll(None)
+            polls = 0
+            while not self._stop.wait(self.poll_interval):
+                try:
+                    cursor = self._poll(cursor)
+                    polls += 1
+                    if polls % 1000 == 0:
+                        with venue_engine(self.venue).begin() as connection:
+                            connection.execute(delete(OrderEvent).where(OrderEvent.id <= cursor - self.retain))
+                except Exception as e:
+                    print(f"Event relay poll failed: {str(e)}")
+
+    def _poll(self, cursor):
+        query = select(OrderEvent.id, OrderEvent.event_type, OrderEvent.data, OrderEvent.table_number)
+        if cursor is None:
+            query = query.order_by(OrderEvent.id.desc()).limit(self.broker.history)
+        else:
+            query = query.where(OrderEvent.id > cursor).order_by(OrderEvent.id).limit(500)
+        with venue_engine(self.venue).connect() as connection:
+            rows = connection.execute(query).all()
+        if cursor is None:
+            rows.reverse()
+        for row in rows:
+            self.broker.deliver(row.id, row.event_type, row.data, row.table_number)
+        return rows[-1].id if rows else (cursor or 0)
+
+# Called with the events of every venue's broker, in that venue's context
+broker_listeners = []
+# Each venue has its own broker; broker is the current venue's
+brokers = VenueLocal(lambda: EventBroker(listeners=broker_listeners))
+broker = brokers.proxy
+
+def format_event(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, default=str)}\n\n"
+
+# Server-Sent Events stream of order changes. EventSource cannot set headers,
+# so the token may also be passed as ?jwt=<token>.
+#
+# A stream holds a worker thread for as long as it is open, so only
+# EVENTS_MAX_STREAMS are kept open per worker. Past that the response ends
+# after the first events or EVENTS_LONG_POLL_SECONDS, and EventSource comes
+# back at once with its Last-Event-ID: a long poll, with no change to the client.
+@events.route('/events', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+def stream_events():
+    claims = get_jwt()
+
+    # Tables only see their own orders, staff and admin see everything
+    table_number = None
+    if claims.get('role') == 'table':
+        table_number = claims.get('table_number')
+        if table_number is None:
+            return jsonify({"error": "Table number missing from token"}), 403
+        table_number = int(table_number)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        cursor = int(last_event_id) if last_event_id else broker.last_id
+    except ValueError:
+        return jsonify({"error": "Invalid event id"}), 400
+
+    heartbeat = current_app.config.get('EVENTS_HEARTBEAT_SECONDS', 15)
+    retry_ms = current_app.config.get('EVENTS_RETRY_MS', 3000)
+    streaming = concurrency_limiter.acquire('events', current_app.config['EVENTS_MAX_STREAMS'])
+    if not streaming:
+        heartbeat = current_app.config['EVENTS_LONG_POLL_SECONDS']
+        retry_ms = 0
+
+    def generate():
+        nonlocal cursor
+        yield f"retry: {retry_ms}\n\n"
+        while not broker.closed:
+            pending, complete = broker.wait(cursor, heartbeat)
+            if not streaming:
+                yield from poll_result(pending, complete)
+                return
+            if not complete:
+                # Events were missed; the client has to reload with GET /orders
+                cursor = pending[-1]['id'] if pending else broker.last_id
+                yield format_event(cursor, 'reset', {})
+                continue
+            if not pending:
+                yield ": heartbeat\n\n"
+                continue
+            for event in pending:
+                cursor = event['id']
+                if table_number is None or event['table_number'] == table_number:
+                    yield format_event(event['id'], event['type'], event['data'])
+
+    def poll_result(pending, complete):
+        if not complete:
+            yield format_event(pending[-1]['id'] if pending else broker.last_id, 'reset', {})
+            return
+        for event in pending:
+            if table_number is None or event['table_number'] == table_number:
+                yield format_event(event['id'], event['type'], event['data'])
+        # Other tables' events: the client resumes after them next time
+        if pending:
+            yield f"id: {pending[-1]['id']}\n\n"
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    if streaming:
+        # Runs however the stream ends, even if the client left before it started
+        response.call_on_close(lambda: concurrency_limiter.release('events'))
+    return response
@@ -0,0 +1,99 @@
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from sqlalchemy import select
+from datetime import datetime
+from models import db, Order, OrderLine, Payment, User, ArchivedOrder, ArchivedOrderLine, ArchivedPayment
+from auth import role_required
+import csv
+import io
+import json
+
+exports = Blueprint('exports', __name__)
+
+# Rows fetched from the cursor, and written to the response, at a time
+EXPORT_CHUNK_SIZE = 1000
+
+# Export name -> (live model, archive model, columns)
+EXPORTS = {
+    'orders': (Order, ArchivedOrder, (
+        'id', 'table_number', 'user_id', 'staff_id', 'status', 'is_service',
+        'total_price', 'created_at', 'updated_at'
+    )),
+    'order-lines': (OrderLine, ArchivedOrderLine, (
+        'id', 'order_id', 'menu_item_id', 'name', 'category', 'price', 'quantity', 'created_at'
+    )),
+    'payments': (Payment, ArchivedPayment, (
+        'id', 'order_id', 'amount', 'status', 'created_at', 'updated_at'
+    )),
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+def export_rows(live, archived, columns, start, end):
+    """Yield rows as tuples, archived rows first, fetching EXPORT_CHUNK_SIZE at a time."""
+    for model in (archived, live):
+        query = select(*(getattr(model, column) for column in columns)).order_by(model.id)
+        if start:
+            query = query.where(model.created_at >= start)
+        if end:
+            query = query.where(model.created_at < end)
+        # yield_per streams from a server-side cursor where the driver has one
+        result = db.session.execute(query.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+        for partition in result.partitions():
+            yield partition
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def csv_chunks(columns, partitions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    # The header goes out before the first query runs
+    yield buffer.getvalue()
+    for rows in partitions:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([export_value(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+
+def ndjson_chunks(columns, partitions):
+    # Zero-length first chunk so headers go out before the first query runs
+    yield ''
+    for rows in partitions:
+        yield ''.join(
+            json.dumps(dict(zip(columns, (export_value(value) for value in row)))) + '\n'
+            for row in rows
+        )
+
+@exports.route('/exports/<name>', methods=['GET'])
+@role_required([User.ROLE_ADMIN])
+def export(name):
+    """Stream orders, order lines or payments (live and archived) created in
+    [`from`, `to`) as CSV or NDJSON (`format`). Memory use does not grow with
+    the range."""
+    if name not in EXPORTS:
+        return jsonify({"error": f"Unknown export: {name}"}), 404
+    export_format = request.args.get('format', 'csv')
+    if export_format not in FORMATS:
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+    try:
+        start = datetime.fromisoformat(request.args['from']) if request.args.get('from') else None
+        end = datetime.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        return jsonify({"error": "from and to must be ISO dates"}), 400
+
+    live, archived, columns = EXPORTS[name]
+    partitions = export_rows(live, archived, columns, start, end)
+    chunks = csv_chunks(columns, partitions) if export_format == 'csv' else ndjson_chunks(columns, partitions)
+
+    filename = '-'.join(filter(None, (
+        name, start and start.date().isoformat(), end and end.date().isoformat()
+    ))) + f'.{export_format}'
+    response = Response(stream_with_context(chunks), mimetype=FORMATS[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    # Keep proxies from buffering the whole export before passing it on
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
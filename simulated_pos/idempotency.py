@@ -0,0 +1,194 @@
+from flask import request, jsonify, make_response
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from models import db, IdempotencyKey
+from sharding import VenueLocal
+import hashlib
+import itertools
+import threading
+
+# Keys older than this may be reused as if they had never been seen
+KEY_TTL = timedelta(hours=24)
+# A claim with no response after this long was abandoned, e.g. by a worker
+# that died mid-request, and may be taken over. Longer than any request runs.
+CLAIM_TIMEOUT = timedelta(seconds=60)
+# Expired keys are deleted on every Nth new key
+PRUNE_EVERY = 100
+
+class ResponseCache:
+    """Bounded LRU of completed responses by `(scope, key)`.
+
+    Stored responses never change, so entries only expire with their key; a
+    retry that lands on the same worker is answered without touching the
+    database.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, scope, key, now):
+        with self._lock:
+            cached = self._entries.get((scope, key))
+            if cached is None:
+                return None
+            entry, expires_at = cached
+            if expires_at <= now:
+                del self._entries[(scope, key)]
+                return None
+            self._entries.move_to_end((scope, key))
+            return entry
+
+    def put(self, scope, key, entry, expires_at):
+        with self._lock:
+            self._entries[(scope, key)] = (entry, expires_at)
+            self._entries.move_to_end((scope, key))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# Stored responses are per venue, like the keys in its database
+response_caches = VenueLocal(ResponseCache)
+response_cache = response_caches.proxy
+_claims = itertools.count(1)
+
+def idempotent(view):
+    """Replay the stored response when a request repeats its Idempotency-Key.
+
+    The first request with a key claims it by inserting a row (unique on
+    scope and key), runs the view and stores the response. Retries get that
+    response back; a retry that arrives while the first is still running gets
+    409, unless the claim is older than CLAIM_TIMEOUT and so was abandoned.
+    Server errors and conflicts release the key so the request can be
+    retried.
+    """
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({"error": "Idempotency-Key is too long"}), 400
+
+        scope = request_scope()
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        now = datetime.utcnow()
+
+        stored = response_cache.get(scope, key, now)
+        if stored is None:
+            stored = claim_key(scope, key, fingerprint, now)
+        if stored is not None:
+            return replay(stored, fingerprint)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            release_key(scope, key)
+            raise
+        # Conflicts and server errors are worth retrying, so don't pin them to the key
+        if response.status_code >= 500 or response.status_code == 409:
+            release_key(scope, key)
+            return response
+
+        stored = (fingerprint, response.status_code, response.get_data(as_text=True), response.mimetype)
+        db.session.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.scope == scope, IdempotencyKey.key == key)
+            .values(status_code=stored[1], response_body=stored[2], mimetype=stored[3])
+        )
+        db.session.commit()
+        response_cache.put(scope, key, stored, now + KEY_TTL)
+        return response
+    return decorated
+
+def request_scope():
+    # Keys are per endpoint and per caller, so clients can't collide with each other
+    try:
+        caller = get_jwt_identity()
+    except RuntimeError:
+        caller = None
+    return f"{request.endpoint}:{caller or '-'}"
+
+def claim_key(scope, key, fingerprint, now):
+    """Return the stored entry for the key, or insert it and return None.
+
+    Retries are answered by a plain read, without taking the write lock. The
+    claim is committed before the view runs so concurrent retries see it; an
+    entry whose status code is None is still running. Expired and abandoned
+    entries are replaced by the new claim.
+    """
+    stored, created_at = lookup_key(scope, key, now)
+    if stored is not None:
+        return stored
+
+    # Finish any read the identity lookup started, so the claim commits on its own
+    db.session.rollback()
+    try:
+        if next(_claims) % PRUNE_EVERY == 0:
+            db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < now - KEY_TTL))
+        if created_at is not None:
+            # Only the entry that was read: a concurrent takeover's fresh claim stays
+            db.session.execute(
+                delete(IdempotencyKey)
+                .where(IdempotencyKey.scope == scope, IdempotencyKey.key == key,
+                       IdempotencyKey.created_at == created_at)
+            )
+        db.session.execute(insert(IdempotencyKey).values(
+            scope=scope, key=key, fingerprint=fingerprint, created_at=now
+        ))
+        db.session.commit()
+        return None
+    except IntegrityError:
+        db.session.rollback()
+    # Lost the race to a concurrent request with the same key
+    return lookup_key(scope, key, now)[0] or (fingerprint, None, None, None)
+
+def lookup_key(scope, key, now):
+    """Return the key's entry and when it was claimed. The entry is None if
+    there is none, or if it expired or was abandoned; `created_at` is then
+    set so the caller can replace it."""
+    row = db.session.execute(
+        select(IdempotencyKey.fingerprint, IdempotencyKey.status_code,
+               IdempotencyKey.response_body, IdempotencyKey.mimetype,
+               IdempotencyKey.created_at)
+        .where(IdempotencyKey.scope == scope, IdempotencyKey.key == key)
+    ).first()
+    if row is None:
+        return None, None
+    *stored, created_at = row
+    stored = tuple(stored)
+    if created_at <= now - KEY_TTL:
+        return None, created_at
+    if stored[1] is None:
+        if created_at <= now - CLAIM_TIMEOUT:
+            return None, created_at
+        return stored, created_at
+    response_cache.put(scope, key, stored, created_at + KEY_TTL)
+    return stored, created_at
+
+def release_key(scope, key):
+    db.session.rollback()
+    db.session.execute(
+        delete(IdempotencyKey)
+        .where(IdempotencyKey.scope == scope, IdempotencyKey.key == key)
+    )
+    db.session.commit()
+
+def replay(stored, fingerprint):
+    stored_fingerprint, status_code, body, mimetype = stored
+    if stored_fingerprint != fingerprint:
+        return jsonify({"error": "Idempotency-Key was already used for a different request"}), 422
+    if status_code is None:
+        return jsonify({"error": "A request with this Idempotency-Key is still being processed"}), 409
+    response = make_response(body, status_code)
+    response.mimetype = mimetype
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
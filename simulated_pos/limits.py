@@ -0,0 +1,144 @@
+from flask import current_app, request, jsonify
+from flask_jwt_extended import get_jwt, verify_jwt_in_request
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import PyJWTError
+from collections import Counter, OrderedDict
+from functools import wraps
+from metrics import registry
+from sharding import current_venue
+import math
+import threading
+import time
+
+registry.counter('http_requests_rejected_total', 'Requests refused by rate limits or load shedding.')
+
+class RateLimiter:
+    """Token buckets by key, in a bounded LRU.
+
+    Buckets live in this process only, so with several workers a client can
+    get up to one allowance per worker.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token from `key`'s bucket, which refills at `rate` per second
+        up to `burst`. Returns 0 if there was one, else the seconds until there is."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+class ConcurrencyLimiter:
+    """Requests in progress per kind. acquire() never waits: past the limit
+    the caller is turned away instead of queueing for a thread or the writer."""
+
+    def __init__(self):
+        self._running = Counter()
+        self._lock = threading.Lock()
+
+    def acquire(self, kind, limit):
+        with self._lock:
+            if self._running[kind] >= limit:
+                return False
+            self._running[kind] += 1
+            return True
+
+    def release(self, kind):
+        with self._lock:
+            self._running[kind] -= 1
+
+rate_limiter = RateLimiter()
+concurrency_limiter = ConcurrencyLimiter()
+
+def request_claims():
+    """The claims of the request's token, or {} if it has no valid one."""
+    try:
+        return get_jwt()
+    except RuntimeError:
+        try:
+            verify_jwt_in_request(optional=True)
+            return get_jwt()
+        except (JWTExtendedException, PyJWTError):
+            return {}
+
+def request_client():
+    """Who is making the request: the token's subject, else the client address.
+
+    Behind a proxy or a venue's NAT every device has the same address, so
+    signed-in callers get a bucket each.
+    """
+    subject = request_claims().get('sub')
+    if subject is not None:
+        # User ids repeat across venues
+        return f"{current_venue()}/user:{subject}"
+    return request.remote_addr
+
+def request_table():
+    """The table a request is made for: from its token, or named in the body for QR scans."""
+    table_number = request_claims().get('table_number')
+    if table_number is None:
+        table_number = (request.get_json(silent=True) or {}).get('tableNumber')
+    return table_number
+
+def reject(status_code, reason, retry_after):
+    registry.increment('http_requests_rejected_total', {'endpoint': request.endpoint, 'reason': reason})
+    message = "Too many requests, please slow down" if status_code == 429 else "Server busy, please retry"
+    response = jsonify({"error": message})
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def limited(name, shed=None):
+    """Admission control for a view.
+
+    Applies the RATE_LIMITS of `name` per client and per table (429
+    when a bucket is empty) and, if `shed` is given, the CONCURRENCY_LIMITS
+    cap of that kind (503 when it is full). Both answer at once, with a
+    Retry-After header.
+    """
+    def decorator(view):
+        @wraps(view)
+        def decorated(*args, **kwargs):
+            limits = current_app.config['RATE_LIMITS'].get(name, {})
+            for scope in ('client', 'table'):
+                if scope not in limits:
+                    continue
+                key = request_client() if scope == 'client' else request_table()
+                if key is None:
+                    continue
+                if scope == 'table':
+                    # Table numbers repeat across venues
+                    key = f"{current_venue()}/{key}"
+                wait = rate_limiter.take(f"{name}:{scope}:{key}", *limits[scope])
+                if wait:
+                    return reject(429, f"rate_{scope}", wait)
+
+            limit = current_app.config['CONCURRENCY_LIMITS'].get(shed) if shed else None
+            if limit is None:
+                return view(*args, **kwargs)
+            if not concurrency_limiter.acquire(shed, limit):
+                return reject(503, f"overloaded_{shed}", 1)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                concurrency_limiter.release(shed)
+        return decorated
+    return decorator
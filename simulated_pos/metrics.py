@@ -0,0 +1,228 @@
+from flask import Blueprint, Response, g, request, has_request_context
+from sqlalchemy import event
+from collections import defaultdict
+import json
+import multiprocessing
+import threading
+import time
+
+metrics = Blueprint('metrics', __name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+class SharedSamples:
+    """Sample values in shared memory, so forked workers add to the same numbers.
+
+    Slots are handed out first come, first served, and each process caches
+    which slot holds which key. Samples past `capacity`, or with keys longer
+    than `key_size` bytes, are dropped.
+    """
+
+    def __init__(self, capacity=4096, key_size=512):
+        self.capacity = capacity
+        self.key_size = key_size
+        self._keys = multiprocessing.Array('c', capacity * key_size, lock=False)
+        self._values = multiprocessing.Array('d', capacity, lock=False)
+        self._used = multiprocessing.Value('q', 0, lock=False)
+        self._lock = multiprocessing.Lock()
+        self._slots = {}
+
+    def _refresh(self):
+        # Pick up the slots other processes added; call with the lock held
+        for slot in range(len(self._slots), self._used.value):
+            raw = self._keys[slot * self.key_size:(slot + 1) * self.key_size].rstrip(b'\0')
+            self._slots[raw.decode()] = slot
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            return slot
+        self._refresh()
+        slot = self._slots.get(key)
+        encoded = key.encode()
+        if slot is None and self._used.value < self.capacity and len(encoded) <= self.key_size:
+            slot = self._used.value
+            self._keys[slot * self.key_size:slot * self.key_size + len(encoded)] = encoded
+            self._used.value = slot + 1
+            self._slots[key] = slot
+        return slot
+
+    def add(self, changes):
+        """Add each `(key, amount)` of `changes`, together."""
+        with self._lock:
+            for key, amount in changes:
+                slot = self._slot(key)
+                if slot is not None:
+                    self._values[slot] += amount
+
+    def items(self):
+        with self._lock:
+            self._refresh()
+            return [(key, self._values[slot]) for key, slot in self._slots.items()]
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms rendered in the Prometheus text format.
+
+    Every number is a sample keyed by `(name, suffix, labels)`: a counter has
+    one, a histogram one per bucket plus its sum and count.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._buckets = {}
+        self._samples = defaultdict(float)
+        self._shared = None
+
+    def share_across_processes(self):
+        """Keep the samples in shared memory so /metrics on any worker reports
+        the whole server, not just the worker that answers. Call before forking."""
+        with self._lock:
+            shared = SharedSamples()
+            shared.add((encode_sample(key), value) for key, value in self._samples.items())
+            self._shared = shared
+
+    def counter(self, name, help_text):
+        self._help[name] = ('counter', help_text)
+
+    def histogram(self, name, help_text, buckets):
+        self._help[name] = ('histogram', help_text)
+        self._buckets[name] = buckets
+
+    def increment(self, name, labels, amount=1):
+        key = tuple(sorted(labels.items()))
+        self._add([((name, '', key), amount)])
+
+    def observe(self, name, labels, value):
+        key = tuple(sorted(labels.items()))
+        changes = [((name, f'_bucket:{bound:g}', key), 1) for bound in self._buckets[name] if value <= bound]
+        changes += [((name, '_sum', key), value), ((name, '_count', key), 1)]
+        self._add(changes)
+
+    def _add(self, changes):
+        if self._shared is not None:
+            return self._shared.add((encode_sample(key), amount) for key, amount in changes)
+        with self._lock:
+            for key, amount in changes:
+                self._samples[key] += amount
+
+    def _snapshot(self):
+        if self._shared is not None:
+            return {decode_sample(key): value for key, value in self._shared.items()}
+        with self._lock:
+            return dict(self._samples)
+
+    def render(self):
+        samples = self._snapshot()
+        series = defaultdict(set)
+        for name, _, key in samples:
+            series[name].add(key)
+        lines = []
+        for name, (kind, help_text) in self._help.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for key in sorted(series[name]):
+                    lines.append(f"{name}{format_labels(key)} {samples[(name, '', key)]:g}")
+                continue
+            for key in sorted(series[name]):
+                for bound in self._buckets[name]:
+                    count = samples.get((name, f'_bucket:{bound:g}', key), 0)
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', f'{bound:g}'),))} {count:g}")
+                count = samples[(name, '_count', key)]
+                lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {count:g}")
+                lines.append(f"{name}_sum{format_labels(key)} {samples[(name, '_sum', key)]:.6f}")
+                lines.append(f"{name}_count{format_labels(key)} {count:g}")
+        return "\n".join(lines) + "\n"
+
+def encode_sample(key):
+    name, suffix, labels = key
+    return json.dumps([name, suffix, labels], separators=(',', ':'))
+
+def decode_sample(encoded):
+    name, suffix, labels = json.loads(encoded)
+    return name, suffix, tuple(tuple(label) for label in labels)
+
+def format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in key) + '}'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+registry = MetricsRegistry()
+registry.histogram('http_request_duration_seconds', 'Request latency by endpoint and status.', LATENCY_BUCKETS)
+registry.histogram('http_request_sql_statements', 'SQL statements executed per request.', SQL_COUNT_BUCKETS)
+registry.histogram('http_request_db_seconds', 'Time spent in the database per request.', LATENCY_BUCKETS)
+
+def instrument_engine(engine):
+    """Count statements and database time for the request that runs them."""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'sql_count' in g:
+            conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('statement_started')
+        if started and has_request_context() and 'sql_count' in g:
+            g.sql_count += 1
+            g.sql_seconds += time.perf_counter() - started.pop()
+
+class QueryCounter:
+    """Context manager that records every SQL statement `engine` runs inside it."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+        return False
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+def init_metrics(app):
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.sql_count = 0
+        g.sql_seconds = 0.0
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'request_started' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        endpoint = request.endpoint or 'unmatched'
+
+        registry.observe('http_request_duration_seconds',
+                         {'endpoint': endpoint, 'method': request.method, 'status': response.status_code},
+                         elapsed)
+        registry.observe('http_request_sql_statements', {'endpoint': endpoint}, g.sql_count)
+        registry.observe('http_request_db_seconds', {'endpoint': endpoint}, g.sql_seconds)
+
+        # Lets browser devtools break the request down, cross-origin included
+        response.headers['Server-Timing'] = (
+            f'db;dur={g.sql_seconds * 1000:.1f};desc="{g.sql_count} queries", '
+            f'app;dur={(elapsed - g.sql_seconds) * 1000:.1f}, '
+            f'total;dur={elapsed * 1000:.1f}'
+        )
+        response.headers['Timing-Allow-Origin'] = '*'
+        return response
+
+@metrics.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
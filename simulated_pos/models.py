@@ -1,12 +1,31 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from sqlalchemy import null
 from werkzeug.security import generate_password_hash, check_password_hash
+from sharding import VenueSession, current_venue
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': VenueSession})
+
+# Venue Model - catalog of the venues, kept in the default venue's database;
+# each venue's own rows live in the database at `database_url` (see sharding.py)
+class Venue(db.Model):
+    slug = db.Column(db.String(40), primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    database_url = db.Column(db.String(500), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'slug': self.slug,
+            'name': self.name,
+            'database_url': self.database_url,
+            'created_at': self.created_at.isoformat()
+        }
 
 # Menu Item Model
 class MenuItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    venue = db.Column(db.String(40), nullable=False, default=current_venue)
     name = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)
     category = db.Column(db.String(20), nullable=False)
@@ -28,18 +47,27 @@ class MenuItem(db.Model):
 # Order Model
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    venue = db.Column(db.String(40), nullable=False, default=current_venue)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    table_number = db.Column(db.Integer, nullable=False)
-    status = db.Column(db.String(50), default='Pending')
+    table_number = db.Column(db.Integer, nullable=False, index=True)
+    status = db.Column(db.String(50), default='Pending', index=True)
     total_price = db.Column(db.Float, default=0.0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     is_service = db.Column(db.Boolean, default=False)
     staff_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    # Set when staff accept the order; service requests get a staff_id before that
+    accepted_at = db.Column(db.DateTime, nullable=True)
+    # Position in the order change feed. Every write clears it and the commit
+    # numbers it (see routes.py), so it follows commit order, not updated_at
+    change_seq = db.Column(db.Integer, nullable=True, onupdate=null(), index=True)
     staff = db.relationship('User', foreign_keys=[staff_id], backref='assigned_orders')
     user = db.relationship('User', foreign_keys=[user_id], backref='placed_orders')
     items = db.Column(db.JSON, default=list)
 
+    # Ids of archived rows must never be handed out again (see archive.py)
+    __table_args__ = {'sqlite_autoincrement': True}
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -57,6 +85,7 @@ class Order(db.Model):
     # Status constants
     STATUS_PENDING = "Pending"      # Initial state when order is created
     STATUS_ACCEPTED = "Accepted"    # Waiter acknowledged the order
+    STATUS_PAID = "Paid"            # Table paid, not yet fulfilled
     STATUS_COMPLETED = "Completed"  # Order fulfilled
     STATUS_REFUNDED = "Refunded"    # Order refunded
     
@@ -64,6 +93,7 @@ class Order(db.Model):
     VALID_STATUS_TRANSITIONS = {
         STATUS_PENDING: [STATUS_ACCEPTED, STATUS_REFUNDED],  # Can be accepted by waiter or refunded by customer
         STATUS_ACCEPTED: [STATUS_COMPLETED],                 # Once accepted, can only be completed
+        STATUS_PAID: [STATUS_COMPLETED],                     # Paid orders are fulfilled; refunds go through /refunds
         STATUS_COMPLETED: [],                               # Final state
         STATUS_REFUNDED: []                                 # Final state
     }
@@ -73,24 +103,192 @@ class Order(db.Model):
     # Relationships
     payments = db.relationship('Payment', backref='order', lazy=True)
 
+# Order Line Model - one row per ordered item, written alongside Order.items
+class OrderLine(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    menu_item_id = db.Column(db.Integer, db.ForeignKey('menu_item.id'), nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=False)
+    category = db.Column(db.String(20), nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    order = db.relationship('Order', backref=db.backref('lines', lazy=True))
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'order_id': self.order_id,
+            'menu_item_id': self.menu_item_id,
+            'name': self.name,
+            'category': self.category,
+            'price': self.price,
+            'quantity': self.quantity,
+            'created_at': self.created_at.isoformat()
+        }
+
+# Archive tables - closed orders, their lines and payments are moved here
+# once they stop changing, so the live tables only hold current business.
+# Columns mirror the live tables, keeping the original ids.
+class ArchivedOrder(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    venue = db.Column(db.String(40), nullable=False, default=current_venue)
+    user_id = db.Column(db.Integer, nullable=False)
+    table_number = db.Column(db.Integer, nullable=False, index=True)
+    status = db.Column(db.String(50), nullable=False)
+    total_price = db.Column(db.Float, default=0.0)
+    created_at = db.Column(db.DateTime, index=True)
+    updated_at = db.Column(db.DateTime)
+    is_service = db.Column(db.Boolean, default=False)
+    staff_id = db.Column(db.Integer, nullable=True)
+    accepted_at = db.Column(db.DateTime, nullable=True)
+    change_seq = db.Column(db.Integer, nullable=True)
+    items = db.Column(db.JSON, default=list)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    lines = db.relationship('ArchivedOrderLine', lazy=True,
+                            primaryjoin='ArchivedOrder.id == foreign(ArchivedOrderLine.order_id)')
+    payments = db.relationship('ArchivedPayment', lazy=True,
+                               primaryjoin='ArchivedOrder.id == foreign(ArchivedPayment.order_id)')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'table_number': self.table_number,
+            'items': self.items or [],
+            'total_price': self.total_price,
+            'status': self.status,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat(),
+            'is_service': self.is_service,
+            'staff_id': self.staff_id,
+            'archived_at': self.archived_at.isoformat(),
+            'payments': [payment.to_dict() for payment in self.payments]
+        }
+
+class ArchivedOrderLine(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    order_id = db.Column(db.Integer, nullable=False, index=True)
+    menu_item_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    category = db.Column(db.String(20), nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime)
+
+class ArchivedPayment(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    venue = db.Column(db.String(40), nullable=False, default=current_venue)
+    order_id = db.Column(db.Integer, nullable=False, index=True)
+    amount = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(20))
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'order_id': self.order_id,
+            'amount': self.amount,
+            'status': self.status,
+            'created_at': self.created_at.isoformat()
+        }
+
+# Sales Rollup Model - running sales totals per report dimension (item,
+# category, hour or staff), updated in the same transaction as the order
+class SalesRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    dimension = db.Column(db.String(20), nullable=False)
+    key = db.Column(db.String(50), nullable=False)
+    label = db.Column(db.String(100))
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+    refunded = db.Column(db.Float, nullable=False, default=0.0)
+    completed_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.UniqueConstraint('dimension', 'key'),)
+
+    def to_dict(self):
+        return {
+            'key': self.key,
+            'label': self.label,
+            'order_count': self.order_count,
+            'quantity': self.quantity,
+            'revenue': round(self.revenue, 2),
+            'refunded': round(self.refunded, 2),
+            'completed_count': self.completed_count
+        }
+
+# Order Event Model - event log that relays SSE events between server processes
+class OrderEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False)
+    table_number = db.Column(db.Integer, nullable=True)
+    data = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Stock Reservation Model - journal of stock taken by committed orders, or
+# given back (negative) by cancelled ones, that has not been folded into
+# menu_item.stock yet (see stock.py)
+class StockReservation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    menu_item_id = db.Column(db.Integer, db.ForeignKey('menu_item.id'), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Change Sequence Model - the last number handed out per change feed, bumped
+# by the committing transaction so numbers are taken in commit order
+class ChangeSequence(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+# Staff Shift Model - one row per staff member currently on shift; service
+# requests are only dispatched to them (see dispatch.py)
+class StaffShift(db.Model):
+    staff_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Stored response for a request sent with an Idempotency-Key header.
+# `status_code` stays NULL while the first request is still running.
+class IdempotencyKey(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(120), nullable=False)  # endpoint and caller
+    key = db.Column(db.String(255), nullable=False)
+    fingerprint = db.Column(db.String(64), nullable=False)  # hash of the request body
+    status_code = db.Column(db.Integer, nullable=True)
+    response_body = db.Column(db.Text, nullable=True)
+    mimetype = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (db.UniqueConstraint('scope', 'key'),)
+
 # Payment Model
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    venue = db.Column(db.String(40), nullable=False, default=current_venue)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), default="Pending")
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = {'sqlite_autoincrement': True}
+
 # User Model
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    venue = db.Column(db.String(40), nullable=False, default=current_venue)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(128))
     role = db.Column(db.String(20), nullable=False)  # admin, staff, or table
-    table_number = db.Column(db.Integer, unique=True, nullable=True)
+    table_number = db.Column(db.Integer, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Table numbers repeat across venues
+    __table_args__ = (db.UniqueConstraint('venue', 'table_number'),)
     
     # Role constants
     ROLE_ADMIN = "admin"
@@ -112,11 +310,12 @@ class User(db.Model):
         }
 
     # Role-based permissions
+    ROLE_PERMISSIONS = {
+        ROLE_ADMIN: ['read:all', 'write:all', 'manage:users', 'view:reports'],
+        ROLE_STAFF: ['read:orders', 'write:orders', 'update:status'],
+        ROLE_TABLE: ['read:menu', 'create:orders', 'read:own_orders']
+    }
+
     @property
     def permissions(self):
-        if self.role == self.ROLE_ADMIN:
-            return ['read:all', 'write:all', 'manage:users', 'view:reports']
-        elif self.role == self.ROLE_STAFF:
-            return ['read:orders', 'write:orders', 'update:status']
-        else:  # customer
-            return ['read:menu', 'create:orders', 'read:own_orders']
+        return self.ROLE_PERMISSIONS.get(self.role, self.ROLE_PERMISSIONS[self.ROLE_TABLE])
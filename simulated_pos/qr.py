@@ -0,0 +1,67 @@
+from flask import current_app
+from collections import OrderedDict
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+
+# Hex characters of HMAC-SHA256 kept in a token (128 bits)
+SIGNATURE_LENGTH = 32
+# Most tokens signed in one request
+MAX_BULK_TOKENS = 1000
+
+class ReplayCache:
+    """Bounded LRU of how many times each QR token nonce has been scanned.
+
+    Evicting a nonce forgets its scans, so size it for the tokens that can be
+    live at once. Counts are per process.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._scans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, nonce):
+        """Count a scan of `nonce` and return its scans so far, this one included."""
+        with self._lock:
+            scans = self._scans.get(nonce, 0) + 1
+            self._scans[nonce] = scans
+            self._scans.move_to_end(nonce)
+            while len(self._scans) > self.maxsize:
+                self._scans.popitem(last=False)
+            return scans
+
+    def clear(self):
+        with self._lock:
+            self._scans.clear()
+
+replay_cache = ReplayCache()
+
+def qr_secret():
+    secret = current_app.config.get('QR_TOKEN_SECRET') or current_app.config['JWT_SECRET_KEY']
+    return secret.encode()
+
+def signature(payload):
+    # Prefixed so a QR signature can never pass for any other HMAC made with the same secret
+    return hmac.new(qr_secret(), b'qr-table-v1:' + payload.encode(), hashlib.sha256).hexdigest()[:SIGNATURE_LENGTH]
+
+def sign_table_token(venue, user_id, table_number, expires_at):
+    """Return a URL-safe token for table `table_number` (user `user_id`) of
+    `venue` that is valid until `expires_at` (Unix seconds)."""
+    payload = f"{venue}.{user_id}.{table_number}.{int(expires_at)}.{secrets.token_hex(6)}"
+    return f"{payload}.{signature(payload)}"
+
+def verify_table_token(token):
+    """Return `(venue, user_id, table_number, nonce)` from a token made by
+    sign_table_token, or raise ValueError. Needs no database."""
+    if not isinstance(token, str) or token.count('.') != 5:
+        raise ValueError("Invalid token format")
+    payload, token_signature = token.rsplit('.', 1)
+    if not hmac.compare_digest(token_signature, signature(payload)):
+        raise ValueError("Invalid token")
+    venue, user_id, table_number, expires_at, nonce = payload.split('.')
+    if int(expires_at) < time.time():
+        raise ValueError("Token expired")
+    return venue, int(user_id), int(table_number), nonce
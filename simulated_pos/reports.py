@@ -0,0 +1,182 @@
+from flask import Blueprint, request, jsonify
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
+from models import db, ArchivedOrder, MenuItem, Order, OrderLine, SalesRollup, User
+from auth import permission_required
+from collections import defaultdict
+from itertools import chain
+
+reports = Blueprint('reports', __name__)
+
+DIMENSIONS = ('item', 'category', 'hour', 'staff')
+ROLLUP_FIELDS = ('order_count', 'quantity', 'revenue', 'refunded', 'completed_count')
+
+def hour_key(moment):
+    return moment.strftime('%Y-%m-%dT%H:00')
+
+def build_order_lines(order, menu_items):
+    """Create OrderLine rows for `order` from its items JSON."""
+    return [
+        OrderLine(
+            order_id=order.id,
+            menu_item_id=item['id'],
+            name=item['name'],
+            category=menu_items[item['id']].category if item['id'] in menu_items else 'unknown',
+            price=item['price'],
+            quantity=item['quantity'],
+            created_at=order.created_at
+        )
+        for item in order.items or []
+    ]
+
+# Rollup deltas are (dimension, key, label, {field: change}) tuples so the
+# same bookkeeping drives both the live upserts and a full rebuild.
+
+def order_deltas(order, lines, sign=1):
+    """Deltas for an order being placed (sign=1) or taken back (sign=-1)."""
+    deltas = []
+    for dimension, attr in (('item', 'menu_item_id'), ('category', 'category')):
+        grouped = defaultdict(lambda: {'quantity': 0, 'revenue': 0.0})
+        labels = {}
+        for line in lines:
+            key = getattr(line, attr)
+            grouped[key]['quantity'] += line.quantity
+            grouped[key]['revenue'] += line.price * line.quantity
+            labels[key] = line.name if dimension == 'item' else line.category
+        for key, totals in grouped.items():
+            deltas.append((dimension, key, labels[key], sale_change(totals['quantity'], totals['revenue'], sign)))
+
+    hour = hour_key(order.created_at)
+    quantity = sum(line.quantity for line in lines)
+    deltas.append(('hour', hour, hour, sale_change(quantity, order.total_price, sign)))
+    return deltas
+
+def sale_change(quantity, revenue, sign):
+    if sign > 0:
+        return {'order_count': 1, 'quantity': quantity, 'revenue': revenue}
+    return {'order_count': -1, 'quantity': -quantity, 'revenue': -revenue, 'refunded': revenue}
+
+def status_deltas(order, new_status, staff_name=None, lines=None):
+    """Deltas for `order` moving into `new_status`.
+
+    Staff are only credited with orders they accepted: a service request is
+    assigned to someone when it is placed, but may be paid or cancelled
+    without ever being accepted.
+    """
+    accepted = order.staff_id and order.accepted_at is not None
+    if new_status == Order.STATUS_ACCEPTED and accepted:
+        return [('staff', order.staff_id, staff_name, {'order_count': 1, 'revenue': order.total_price})]
+    if new_status == Order.STATUS_COMPLETED and accepted:
+        return [('staff', order.staff_id, staff_name, {'completed_count': 1})]
+    if new_status == Order.STATUS_REFUNDED:
+        deltas = order_deltas(order, order.lines if lines is None else lines, sign=-1)
+        if accepted:
+            deltas.append(('staff', order.staff_id, staff_name,
+                           {'revenue': -order.total_price, 'refunded': order.total_price}))
+        return deltas
+    return []
+
+def apply_deltas(deltas):
+    """Upsert deltas into the rollup table with one executemany, within the current transaction."""
+    if not deltas:
+        return
+    bind = db.session.get_bind()
+    insert = postgresql.insert if bind.dialect.name == 'postgresql' else sqlite.insert
+    columns = SalesRollup.__table__.c
+    stmt = insert(SalesRollup)
+    updates = {field: columns[field] + stmt.excluded[field] for field in ROLLUP_FIELDS}
+    updates['label'] = func.coalesce(stmt.excluded.label, columns.label)
+    stmt = stmt.on_conflict_do_update(index_elements=['dimension', 'key'], set_=updates)
+
+    # Merge deltas for the same row, e.g. from a batch of orders, so each
+    # rollup row is upserted once
+    rows = {}
+    for dimension, key, label, changes in deltas:
+        row = rows.get((dimension, str(key)))
+        if row is None:
+            row = rows[(dimension, str(key))] = {
+                'dimension': dimension, 'key': str(key), 'label': label,
+                **{field: 0 for field in ROLLUP_FIELDS}
+            }
+        row['label'] = label if label is not None else row['label']
+        for field, change in changes.items():
+            row[field] += change
+    db.session.execute(stmt, list(rows.values()))
+
+def record_order(order, lines):
+    apply_deltas(order_deltas(order, lines))
+
+def record_status_change(order, old_status, new_status, staff_name=None):
+    if old_status != new_status:
+        apply_deltas(status_deltas(order, new_status, staff_name))
+
+def rebuild_sales_rollups():
+    """Recompute every rollup from the live and archived orders, backfilling missing order lines."""
+    menu_items = {item.id: item for item in MenuItem.query.all()}
+    staff_names = dict(db.session.query(User.id, User.username).filter(User.role != User.ROLE_TABLE))
+    totals = defaultdict(lambda: dict.fromkeys(ROLLUP_FIELDS, 0))
+    labels = {}
+
+    # Archived orders count too; they have the same columns as live ones
+    orders = chain(
+        ArchivedOrder.query.options(selectinload(ArchivedOrder.lines)).order_by(ArchivedOrder.id).yield_per(500),
+        Order.query.options(selectinload(Order.lines)).order_by(Order.id).yield_per(500)
+    )
+    for order in orders:
+        lines = order.lines
+        if not lines and order.items:
+            lines = build_order_lines(order, menu_items)
+            if isinstance(order, Order):
+                db.session.add_all(lines)
+
+        deltas = order_deltas(order, lines)
+        staff_name = staff_names.get(order.staff_id)
+        deltas += status_deltas(order, Order.STATUS_ACCEPTED, staff_name)
+        if order.status == Order.STATUS_COMPLETED:
+            deltas += status_deltas(order, Order.STATUS_COMPLETED, staff_name)
+        elif order.status == Order.STATUS_REFUNDED:
+            deltas += status_deltas(order, Order.STATUS_REFUNDED, staff_name, lines)
+
+        for dimension, key, label, changes in deltas:
+            row = totals[(dimension, str(key))]
+            for field, change in changes.items():
+                row[field] += change
+            labels[(dimension, str(key))] = label
+
+    SalesRollup.query.delete()
+    db.session.add_all(
+        SalesRollup(dimension=dimension, key=key, label=labels[(dimension, key)], **row)
+        for (dimension, key), row in totals.items()
+    )
+    db.session.commit()
+    return len(totals)
+
+@reports.route('/reports/sales', methods=['GET'])
+@permission_required('view:reports')
+def get_sales_report():
+    dimension = request.args.get('by', 'item')
+    if dimension not in DIMENSIONS:
+        return jsonify({"error": f"Unknown report dimension: {dimension}"}), 400
+
+    query = SalesRollup.query.filter_by(dimension=dimension)
+    if dimension == 'hour':
+        # Hour keys sort chronologically as strings
+        if request.args.get('from'):
+            query = query.filter(SalesRollup.key >= request.args['from'])
+        if request.args.get('to'):
+            query = query.filter(SalesRollup.key <= request.args['to'])
+        query = query.order_by(SalesRollup.key)
+    else:
+        query = query.order_by(SalesRollup.revenue.desc())
+
+    return jsonify({
+        "by": dimension,
+        "rows": [row.to_dict() for row in query]
+    })
+
+@reports.route('/reports/rebuild', methods=['POST'])
+@permission_required('view:reports')
+def rebuild_reports():
+    rows = rebuild_sales_rollups()
+    return jsonify({"message": "Sales rollups rebuilt", "rows": rows})
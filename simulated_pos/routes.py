@@ -1,61 +1,235 @@
-from flask import Blueprint, request, jsonify, make_response
-from flask_jwt_extended import jwt_required, get_jwt_identity, get_jwt
-from models import db, MenuItem, Order, Payment, User
-from auth import role_required
-from datetime import datetime
-import time
+from flask import Blueprint, current_app, request, jsonify, make_response
+from flask_jwt_extended import jwt_required
+from models import db, ChangeSequence, IdempotencyKey, MenuItem, Order, Payment, User
+from auth import role_required, current_identity
+from events import broker
+from cache import menu_cache, identity_cache, table_cache
+from stock import stock_engine
+from dispatch import dispatcher
+from idempotency import idempotent
+from limits import limited
+from qr import verify_table_token, replay_cache
+from sharding import UnknownVenue, current_venue, switch_venue
+from reports import build_order_lines, order_deltas, record_order, record_status_change, status_deltas, apply_deltas
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import and_, case, event, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload
+import hashlib
+import json
 from flask_jwt_extended import create_access_token
 
 routes = Blueprint('routes', __name__)
 
+# Upper bound on rows returned by a paginated list request
+MAX_PAGE_SIZE = 500
+# Upper bound on orders in one offline batch, and how old a queued order may be
+MAX_BATCH_ORDERS = 50
+MAX_QUEUED_AGE = timedelta(hours=24)
+# Fields list endpoints can be narrowed to with ?fields=a,b
+MENU_FIELDS = ('id', 'name', 'price', 'category', 'description', 'stock', 'track_stock')
+ORDER_FIELDS = ('id', 'table_number', 'items', 'total_price', 'status', 'created_at', 'updated_at',
+                'is_service', 'staff_id', 'staff_name')
+PAYMENT_FIELDS = ('id', 'order_id', 'amount', 'status')
+
+def parse_fields(allowed):
+    """Return the fields named in ?fields= (comma-separated), or None for all.
+
+    Raises ValueError for fields not in `allowed`.
+    """
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    fields = tuple(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def project(rows, fields):
+    """Narrow serialized rows to `fields` (None keeps everything)."""
+    if fields is None:
+        return rows
+    return [{field: row[field] for field in fields} for row in rows]
+
 @routes.route('/menu', methods=['GET'])
 def get_menu():
-    menu_items = MenuItem.query.all()
-    return jsonify([{
-        'id': item.id,
-        'name': item.name,
-        'price': item.price,
-        'category': item.category,
-        'description': item.description,
-        'stock': item.stock if item.track_stock else None,
-        'track_stock': item.track_stock
-    } for item in menu_items])
+    # Served from the in-process menu cache; clients revalidate with If-None-Match
+    etag, menu_items = menu_cache.get()
+    # Live counts for tracked stock come from the stock engine once it's running
+    stock = stock_engine.snapshot() if current_app.config['STOCK_WRITE_BEHIND'] else None
+    if stock is not None:
+        etag = f"{etag}-{stock[0]}"
+    try:
+        fields = parse_fields(MENU_FIELDS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # Weak match, since compressed responses carry a weak ETag
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        category = request.args.get('category')
+        in_stock = request.args.get('in_stock', '').lower() in ('1', 'true', 'yes')
+        if stock is not None:
+            menu_items = [
+                {**item, 'stock': stock[1][item['id']]} if item['id'] in stock[1] else item
+                for item in menu_items
+            ]
+        if category:
+            menu_items = [item for item in menu_items if item['category'] == category]
+        if in_stock:
+            menu_items = [
+                item for item in menu_items
+                if not item['track_stock'] or item['stock'] is None or item['stock'] > 0
+            ]
+        response = jsonify(project(menu_items, fields))
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @routes.route('/orders', methods=['POST'])
 @jwt_required()
+@limited('orders', shed='writes')
+@idempotent
 def create_order():
-    current_user = get_jwt_identity()
-    user = User.query.get(current_user)
+    user = current_identity()
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
     data = request.json
-    
-    items = []
-    total_price = 0
-    is_service = False
-    
+
+    quantities, error = order_quantities(data.get('items'))
+    if error:
+        return jsonify({"error": error}), 400
+
+    # Load every requested item in a single query
+    menu_items = {
+        item.id: item
+        for item in MenuItem.query.filter(MenuItem.id.in_(quantities.keys()))
+    }
+
+    missing = next((item_id for item_id in quantities if item_id not in menu_items), None)
+    if missing is not None:
+        return jsonify({"error": f"Item not found: {missing}"}), 404
+
     # First check if we have enough stock for all items
-    for item_data in data['items']:
-        menu_item = MenuItem.query.get(item_data['id'])
-        if not menu_item:
-            return jsonify({"error": f"Item not found: {item_data['id']}"}), 404
-            
-        if menu_item.track_stock and menu_item.stock is not None:
-            if menu_item.stock < item_data['quantity']:
-                return jsonify({
-                    "error": f"Not enough stock for {menu_item.name}. Available: {menu_item.stock}"
-                }), 400
+    tracked = {
+        item_id: quantity for item_id, quantity in quantities.items()
+        if menu_items[item_id].track_stock and menu_items[item_id].stock is not None
+    }
+    available = current_stock(menu_items, tracked)
+    for item_id, quantity in tracked.items():
+        if available[item_id] < quantity:
+            return jsonify({
+                "error": f"Not enough stock for {menu_items[item_id].name}. Available: {available[item_id]}"
+            }), 400
+
+    # Reserve all of it at once, so concurrent orders cannot oversell; if any
+    # item ran out since the check above, the whole order fails.
+    if tracked and not reserve_stock(tracked):
+        db.session.rollback()
+        available = current_stock(menu_items, tracked)
+        short = next((item_id for item_id in tracked if available[item_id] < tracked[item_id]), None)
+        if short is None:
+            return jsonify({"error": "Stock changed while ordering, please retry"}), 409
+        return jsonify({
+            "error": f"Not enough stock for {menu_items[short].name}. Available: {available[short]}"
+        }), 400
+
+    order = new_order(user, data['items'], menu_items)
+    db.session.add(order)
     
-    # If we have enough stock, process the order
+    try:
+        # Flush for the order id and timestamp, then write its lines and rollups
+        db.session.flush()
+        lines = build_order_lines(order, menu_items)
+        # One executemany; the line ids aren't needed here
+        db.session.bulk_save_objects(lines)
+        record_order(order, lines)
+        db.session.commit()
+        broker.publish('order_created', order.to_dict(), table_number=order.table_number)
+        return jsonify({"message": "Order created successfully", "order_id": order.id}), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+def order_quantities(items):
+    """Return `({item_id: total quantity}, None)` for an order's items, or `(None, error)`.
+
+    Repeated lines are summed so they are checked against stock together.
+    """
+    if not isinstance(items, list) or not items:
+        return None, "Order has no items"
+    quantities = {}
+    for item_data in items:
+        item_id = item_data.get('id') if isinstance(item_data, dict) else None
+        quantity = item_data.get('quantity') if isinstance(item_data, dict) else None
+        if not isinstance(item_id, int):
+            return None, "Invalid item id"
+        if not isinstance(quantity, int) or quantity < 1:
+            return None, f"Invalid quantity for item {item_id}"
+        quantities[item_id] = quantities.get(item_id, 0) + quantity
+    return quantities, None
+
+def current_stock(menu_items, item_ids):
+    """Return `{item_id: available}` for tracked items in `menu_items`."""
+    if current_app.config['STOCK_WRITE_BEHIND']:
+        return stock_engine.available(item_ids)
+    return {item_id: menu_items[item_id].stock for item_id in item_ids}
+
+def reserve_stock(tracked):
+    """Take `tracked` ({item_id: quantity}) off stock, all or nothing.
+
+    Returns False if any item is short, and the caller must roll back. With
+    STOCK_WRITE_BEHIND this reserves against the in-memory counters; otherwise
+    with one conditional UPDATE, where rows without enough stock don't match.
+    """
+    if current_app.config['STOCK_WRITE_BEHIND']:
+        return stock_engine.reserve(tracked)
+    needed = case(tracked, value=MenuItem.id)
+    result = db.session.execute(
+        update(MenuItem)
+        .where(MenuItem.id.in_(tracked.keys()), MenuItem.stock >= needed)
+        .values(stock=MenuItem.stock - needed),
+        execution_options={"synchronize_session": False}
+    )
+    return result.rowcount == len(tracked)
+
+def return_stock(items):
+    """Put the tracked stock of an order's `items` back, in the current
+    transaction: the inverse of reserve_stock()."""
+    quantities, _ = order_quantities(items)
+    tracked = {
+        item_id: quantities[item_id] for item_id in db.session.scalars(
+            select(MenuItem.id).where(
+                MenuItem.id.in_(quantities.keys()), MenuItem.track_stock.is_(True), MenuItem.stock.isnot(None)
+            )
+        )
+    }
+    if not tracked:
+        return
+    if current_app.config['STOCK_WRITE_BEHIND']:
+        stock_engine.restock(tracked)
+        return
+    returned = case(tracked, value=MenuItem.id)
+    db.session.execute(
+        update(MenuItem)
+        .where(MenuItem.id.in_(tracked.keys()))
+        .values(stock=MenuItem.stock + returned),
+        execution_options={"synchronize_session": False}
+    )
+
+def new_order(user, items, menu_items, **columns):
+    """Build a pending Order for `user` from validated request items."""
     order_items = []
-    for item_data in data['items']:
-        menu_item = MenuItem.query.get(item_data['id'])
-        
+    total_price = 0
+    is_service = False
+    for item_data in items:
+        menu_item = menu_items[item_data['id']]
+
         if menu_item.category == 'service':
             is_service = True
-        
-        # Update stock if needed
-        if menu_item.track_stock and menu_item.stock is not None:
-            menu_item.stock -= item_data['quantity']
-        
+
         order_items.append({
             'id': menu_item.id,
             'name': menu_item.name,
@@ -63,44 +237,281 @@ def create_order():
             'quantity': item_data['quantity']
         })
         total_price += menu_item.price * item_data['quantity']
-    
-    order = Order(
+
+    return Order(
         user_id=user.id,
         table_number=user.table_number,
         items=order_items,
         total_price=total_price,
-        status='Pending',
-        is_service=is_service
+        status=Order.STATUS_PENDING,
+        is_service=is_service,
+        # Service requests go straight to the least-loaded staff member on shift
+        staff_id=dispatcher.assign() if is_service else None,
+        **columns
     )
-    
-    db.session.add(order)
-    
+
+# Upload of orders a table queued while offline: one round-trip, one transaction
+@routes.route('/orders/batch', methods=['POST'])
+@jwt_required()
+@limited('orders', shed='writes')
+def create_orders_batch():
+    user = current_identity()
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+
+    queued = (request.get_json(silent=True) or {}).get('orders')
+    if not isinstance(queued, list) or not queued:
+        return jsonify({'error': 'orders must be a non-empty list'}), 400
+    if len(queued) > MAX_BATCH_ORDERS:
+        return jsonify({'error': f'At most {MAX_BATCH_ORDERS} orders per request'}), 400
+
+    now = datetime.utcnow()
+    results = [
+        {'client_id': entry.get('client_id') if isinstance(entry, dict) else None}
+        for entry in queued
+    ]
+
+    # Client ids are kept as idempotency keys, so re-uploading a queue after a
+    # dropped response returns the orders that were already created
+    scope = f"offline_order:{user.id}"
+    client_ids = [result['client_id'] for result in results if isinstance(result['client_id'], str)]
+    submitted = {
+        key: json.loads(body)['order_id']
+        for key, body in db.session.query(IdempotencyKey.key, IdempotencyKey.response_body)
+        .filter(IdempotencyKey.scope == scope, IdempotencyKey.key.in_(client_ids))
+    }
+
+    pending = []
+    seen = set()
+    for entry, result in zip(queued, results):
+        client_id = result['client_id']
+        if not isinstance(client_id, str) or not client_id or len(client_id) > 255:
+            result['error'] = 'client_id is required'
+        elif client_id in seen:
+            result['error'] = 'Duplicate client_id'
+        elif client_id in submitted:
+            result['order_id'] = submitted[client_id]
+            result['duplicate'] = True
+        else:
+            quantities, result['error'] = order_quantities(entry.get('items'))
+            if quantities:
+                pending.append((entry, result, quantities, queued_at(entry.get('created_at'), now)))
+        if isinstance(client_id, str):
+            seen.add(client_id)
+
+    # Check stock for every order in one pass, oldest first so stock goes to
+    # the orders that were placed first
+    menu_items = {
+        item.id: item
+        for item in MenuItem.query.filter(MenuItem.id.in_({
+            item_id for _, _, quantities, _ in pending for item_id in quantities
+        }))
+    }
+    available = current_stock(menu_items, [
+        item.id for item in menu_items.values() if item.track_stock and item.stock is not None
+    ])
+    remaining = dict(available)
+    accepted = []
+    for entry, result, quantities, created_at in sorted(pending, key=lambda queued_order: queued_order[3]):
+        missing = next((item_id for item_id in quantities if item_id not in menu_items), None)
+        short = next((
+            menu_items[item_id] for item_id, quantity in quantities.items()
+            if item_id in remaining and remaining[item_id] < quantity
+        ), None)
+        if missing is not None:
+            result['error'] = f"Item not found: {missing}"
+        elif short is not None:
+            result['error'] = f"Not enough stock for {short.name}. Available: {remaining[short.id]}"
+        else:
+            for item_id, quantity in quantities.items():
+                if item_id in remaining:
+                    remaining[item_id] -= quantity
+            accepted.append((entry, result, created_at))
+
+    tracked = {
+        item_id: available[item_id] - left
+        for item_id, left in remaining.items() if left != available[item_id]
+    }
+    if tracked and not reserve_stock(tracked):
+        db.session.rollback()
+        return jsonify({"error": "Stock changed while submitting, please retry"}), 409
+
+    # The client's timestamp becomes created_at; updated_at stays the server
+    # time so incremental feeds still pick the orders up
+    orders = [new_order(user, entry['items'], menu_items, created_at=created_at, updated_at=now)
+              for entry, _, created_at in accepted]
     try:
+        db.session.add_all(orders)
+        db.session.flush()
+        lines = []
+        deltas = []
+        for order in orders:
+            order_lines = build_order_lines(order, menu_items)
+            lines += order_lines
+            deltas += order_deltas(order, order_lines)
+        db.session.bulk_save_objects(lines)
+        apply_deltas(deltas)
+        events = [('order_created', order.to_dict(), order.table_number) for order in orders]
+        order_ids = [order.id for order in orders]
+        if orders:
+            db.session.execute(insert(IdempotencyKey), [{
+                'scope': scope,
+                'key': result['client_id'],
+                'fingerprint': hashlib.sha256(json.dumps(entry, sort_keys=True).encode()).hexdigest(),
+                'status_code': 201,
+                'response_body': json.dumps({'order_id': order.id}),
+                'mimetype': 'application/json',
+                'created_at': now
+            } for (entry, result, _), order in zip(accepted, orders)])
         db.session.commit()
-        return jsonify({"message": "Order created successfully", "order_id": order.id}), 201
+    except IntegrityError:
+        # The same queue is being uploaded concurrently
+        db.session.rollback()
+        return jsonify({"error": "Orders were submitted concurrently, please retry"}), 409
     except Exception as e:
+        # Rolling back also hands the stock reservations back
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+    for (_, result, _), order_id in zip(accepted, order_ids):
+        result['order_id'] = order_id
+    broker.publish_many(events)
+
+    for result in results:
+        result.setdefault('error', None)
+        result['ok'] = result['error'] is None
+    return jsonify({'results': results, 'created': len(orders)})
+
+def queued_at(value, now):
+    """Parse a client timestamp, falling back to `now` if it's missing or implausible."""
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return now
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    if moment > now or now - moment > MAX_QUEUED_AGE:
+        return now
+    return moment
+
 @routes.route('/orders', methods=['GET'])
 @jwt_required()
 def get_orders():
-    current_user = get_jwt_identity()
-    user = User.query.get(int(current_user))
+    user = current_identity()
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
-    # Filter orders based on user role
+    # Filter orders based on user role. Staff names are joined in up front
+    # so serializing the list does not lazy-load one user per order.
+    query = Order.query.options(joinedload(Order.staff))
     if user.role == 'table':
-        orders = Order.query.filter_by(table_number=user.table_number).all()
-    else:
-        orders = Order.query.all()
+        query = query.filter_by(table_number=user.table_number)
 
-    return jsonify([order.to_dict() for order in orders])
+    try:
+        fields = parse_fields(ORDER_FIELDS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    since = request.args.get('since')
+    page = parse_page_args()
+    if since is None and page is None:
+        return jsonify(project([order.to_dict() for order in query.all()], fields))
+
+    if since is None:
+        limit, after_id = page
+        orders = query.filter(Order.id > after_id).order_by(Order.id).limit(limit).all()
+        return jsonify({
+            'orders': project([order.to_dict() for order in orders], fields),
+            'next_after_id': orders[-1].id if len(orders) == limit else None
+        })
+
+    # Incremental feed: only orders changed after the cursor, in commit order.
+    # An empty `since` starts from the beginning and returns the first cursor.
+    if since:
+        try:
+            change_seq, order_id = decode_order_cursor(since)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        query = query.filter(or_(
+            Order.change_seq > change_seq,
+            and_(Order.change_seq == change_seq, Order.id > order_id)
+        ))
+
+    query = query.order_by(Order.change_seq, Order.id)
+    if page is not None:
+        query = query.limit(page[0])
+    orders = query.all()
+    return jsonify({
+        'orders': project([order.to_dict() for order in orders], fields),
+        'next_cursor': encode_order_cursor(orders[-1]) if orders else since
+    })
+
+def encode_order_cursor(order):
+    return f"{order.change_seq},{order.id}"
+
+def decode_order_cursor(cursor):
+    change_seq, order_id = cursor.split(',')
+    return int(change_seq), int(order_id)
+
+# Number the orders a transaction changed as it commits. updated_at is taken
+# before the write lock, so a later commit can carry an earlier time than a
+# cursor already handed out; the sequence row is bumped by the committing
+# transaction and held until it ends, so numbers follow commit order.
+@event.listens_for(Session, 'after_flush')
+def track_order_flush(session, flush_context):
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, Order):
+            session.info['orders_changed'] = True
+            return
+
+@event.listens_for(Session, 'do_orm_execute')
+def track_order_statement(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and mapper.class_ is Order:
+        orm_execute_state.session.info['orders_changed'] = True
+
+@event.listens_for(Session, 'before_commit')
+def number_order_changes(session):
+    session.flush()
+    if not session.info.get('orders_changed'):
+        return
+    change_seq = session.execute(
+        update(ChangeSequence)
+        .where(ChangeSequence.name == 'orders')
+        .values(value=ChangeSequence.value + 1)
+        .returning(ChangeSequence.value)
+    ).scalar()
+    if change_seq is None:
+        change_seq = 1
+        session.execute(insert(ChangeSequence).values(name='orders', value=change_seq))
+    # Every write to an order cleared its number, leaving this transaction's
+    session.execute(
+        update(Order)
+        .where(Order.change_seq.is_(None))
+        .values(change_seq=change_seq, updated_at=Order.updated_at),
+        execution_options={"synchronize_session": False}
+    )
+    session.info.pop('orders_changed', None)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_order_changes(session):
+    session.info.pop('orders_changed', None)
+
+def parse_page_args():
+    """Return `(limit, after_id)` for keyset pagination, or None if not requested."""
+    if 'limit' not in request.args and 'after_id' not in request.args:
+        return None
+    limit = request.args.get('limit', MAX_PAGE_SIZE, type=int)
+    after_id = request.args.get('after_id', 0, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE)), after_id
 
 # 3. Simulate Payment
 @routes.route('/payments', methods=['POST'])
+@limited('payments', shed='writes')
+@idempotent
 def process_payment():
     data = request.json
     order_id = data['order_id']
@@ -130,10 +541,25 @@ def process_payment():
     if amount < order.total_price:
         return jsonify({"error": "Insufficient payment"}), 400
 
+    # Compare-and-swap, as for status changes: of two payments, or a payment
+    # and a staff member accepting, racing past the checks above only one wins
+    paid = db.session.execute(
+        update(Order)
+        .where(Order.id == order_id, Order.status == Order.STATUS_PENDING)
+        .values(status=Order.STATUS_PAID)  # Order is paid but not yet completed
+    )
+    if paid.rowcount == 0:
+        db.session.rollback()
+        current = db.session.query(Order.status).filter_by(id=order_id).scalar()
+        return jsonify({
+            "error": f"Order is {current}. Only pending orders can be paid.",
+            "status": current
+        }), 409
+
     payment = Payment(order_id=order_id, amount=amount, status="Success")
     db.session.add(payment)
-    order.status = Order.STATUS_PAID  # Order is paid but not yet completed
     db.session.commit()
+    broker.publish('payment_processed', order.to_dict(), table_number=order.table_number)
 
     return jsonify({
         "order_id": order_id,
@@ -145,43 +571,197 @@ def process_payment():
         "next_steps": ["Mark as completed when order is fulfilled"]
     })
 
+def previous_statuses(new_status):
+    """Statuses an order may be in to move to `new_status`."""
+    return [
+        status for status, targets in Order.VALID_STATUS_TRANSITIONS.items()
+        if new_status in targets
+    ]
+
 # 4. Update Order Status
 @routes.route('/orders/<int:order_id>/status', methods=['PUT'])
-@jwt_required()
+@role_required([User.ROLE_STAFF, User.ROLE_ADMIN])
 def update_order_status(order_id):
+    # Resolve the current user from the JWT claims or the identity cache
+    user = current_identity()
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+
+    new_status = (request.get_json(silent=True) or {}).get('status')
+    # A refund also has to write the refund payment
+    if new_status == Order.STATUS_REFUNDED:
+        return jsonify({'error': 'Refunds go through POST /refunds'}), 400
+    allowed_from = previous_statuses(new_status)
+    if not allowed_from:
+        return jsonify({'error': f'Invalid status: {new_status}'}), 400
+
+    values = {'status': new_status, 'updated_at': datetime.utcnow()}
+    if new_status == Order.STATUS_ACCEPTED:
+        values['accepted_at'] = values['updated_at']
+    # Assign staff when accepting order
+    if user.role == User.ROLE_STAFF and new_status == Order.STATUS_ACCEPTED:
+        values['staff_id'] = user.id
+
     try:
-        # Get the current user's ID from JWT
-        current_user_id = get_jwt_identity()
-        claims = get_jwt()
-        user_role = claims.get('role', None)
-        
-        user = User.query.get(int(current_user_id))
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-            
-        data = request.get_json()
-        order = Order.query.get_or_404(order_id)
-        
-        order.status = data['status']
-        
-        # Assign staff when accepting order
-        if user_role == 'staff' and data['status'] == 'Accepted':
-            order.staff_id = user.id
-            order.updated_at = datetime.utcnow()
-        
+        # Compare-and-swap: the row only changes if it is still in a state that
+        # may move to `new_status`, so of two staff accepting the same order
+        # exactly one wins, without locking anything
+        order = db.session.execute(
+            update(Order)
+            .where(Order.id == order_id, Order.status.in_(allowed_from))
+            .values(**values)
+            .returning(Order),
+            execution_options={"synchronize_session": False}
+        ).scalar_one_or_none()
+        if order is None:
+            db.session.rollback()
+            current = db.session.query(Order.status).filter_by(id=order_id).scalar()
+            if current is None:
+                return jsonify({'error': 'Order not found'}), 404
+            return jsonify({
+                'error': f'Cannot change order from {current} to {new_status}',
+                'status': current
+            }), 409
+
+        staff = identity_cache.get(order.staff_id) if order.staff_id else None
+        staff_name = staff.username if staff else None
+        apply_deltas(status_deltas(order, new_status, staff_name))
+        data = {**order.to_dict(), 'staff_name': staff_name}
         db.session.commit()
-        
+        broker.publish('order_updated', data, table_number=order.table_number)
+
         return jsonify({
-            'id': order.id,
-            'status': order.status,
-            'staff_id': order.staff_id,
-            'staff_name': order.staff.username if order.staff else None
+            'id': order_id,
+            'status': new_status,
+            'staff_id': data['staff_id'],
+            'staff_name': staff_name
         })
     except Exception as e:
         db.session.rollback()
         print(f"Error updating order status: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+# A table takes back its own order before staff have accepted it; nothing
+# was paid, so there is no refund payment to write, and its stock goes back
+@routes.route('/orders/<int:order_id>/cancel', methods=['POST'])
+@role_required([User.ROLE_TABLE])
+def cancel_order(order_id):
+    user = current_identity()
+    if not user or user.table_number is None:
+        return jsonify({'error': 'Table number missing from token'}), 403
+
+    try:
+        order = db.session.execute(
+            update(Order)
+            .where(Order.id == order_id, Order.user_id == user.id, Order.status == Order.STATUS_PENDING)
+            .values(status=Order.STATUS_REFUNDED, updated_at=datetime.utcnow())
+            .returning(Order),
+            execution_options={"synchronize_session": False}
+        ).scalar_one_or_none()
+        if order is None:
+            db.session.rollback()
+            current = db.session.query(Order.status).filter_by(id=order_id, user_id=user.id).scalar()
+            if current is None:
+                return jsonify({'error': 'Order not found'}), 404
+            return jsonify({'error': f'Cannot cancel an order that is {current}', 'status': current}), 409
+
+        staff = identity_cache.get(order.staff_id) if order.staff_id else None
+        staff_name = staff.username if staff else None
+        apply_deltas(status_deltas(order, Order.STATUS_REFUNDED, staff_name))
+        return_stock(order.items)
+        data = {**order.to_dict(), 'staff_name': staff_name}
+        db.session.commit()
+        broker.publish('order_updated', data, table_number=order.table_number)
+        return jsonify({'id': order_id, 'status': Order.STATUS_REFUNDED})
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error cancelling order: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Batch status update: one transaction and one UPDATE per target status
+@routes.route('/orders/status', methods=['PUT'])
+@role_required([User.ROLE_STAFF, User.ROLE_ADMIN])
+def update_order_statuses():
+    user = current_identity()
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+
+    updates = (request.get_json(silent=True) or {}).get('updates')
+    if not isinstance(updates, list) or not updates:
+        return jsonify({'error': 'updates must be a non-empty list'}), 400
+    if len(updates) > MAX_PAGE_SIZE:
+        return jsonify({'error': f'At most {MAX_PAGE_SIZE} updates per request'}), 400
+
+    order_ids = [item.get('order_id') for item in updates if isinstance(item, dict)]
+    orders = {
+        order.id: order
+        for order in Order.query.options(joinedload(Order.staff))
+        .filter(Order.id.in_([i for i in order_ids if isinstance(i, int)]))
+    }
+
+    # Validate every item first; valid ones are grouped by their new status
+    results = []
+    by_status = {}
+    for item in updates:
+        order_id = item.get('order_id') if isinstance(item, dict) else None
+        new_status = item.get('status') if isinstance(item, dict) else None
+        order = orders.get(order_id)
+        if order is None:
+            error = 'Order not found'
+        elif new_status == Order.STATUS_REFUNDED:
+            error = 'Refunds go through POST /refunds'
+        elif any(order_id in ids for ids in by_status.values()):
+            error = 'Duplicate order id'
+        elif not order.can_transition_to(new_status):
+            error = f'Cannot change order from {order.status} to {new_status}'
+        else:
+            error = None
+            by_status.setdefault(new_status, []).append(order_id)
+        results.append({'order_id': order_id, 'status': new_status, 'error': error})
+
+    now = datetime.utcnow()
+    updated = set()
+    for new_status, ids in by_status.items():
+        # Only rows still in a state that may move to `new_status` are changed,
+        # so an order another request changed meanwhile is reported, not clobbered
+        allowed_from = previous_statuses(new_status)
+        values = {'status': new_status, 'updated_at': now}
+        if new_status == Order.STATUS_ACCEPTED:
+            values['accepted_at'] = now
+        if user.role == User.ROLE_STAFF and new_status == Order.STATUS_ACCEPTED:
+            values['staff_id'] = user.id
+        result = db.session.execute(
+            update(Order)
+            .where(Order.id.in_(ids), Order.status.in_(allowed_from))
+            .values(**values)
+            .returning(Order.id)
+        )
+        updated.update(result.scalars())
+
+    staff_names = {}
+    for order_id in updated:
+        staff_id = orders[order_id].staff_id
+        if staff_id and staff_id not in staff_names:
+            staff = identity_cache.get(staff_id)
+            staff_names[staff_id] = staff.username if staff else None
+
+    deltas = []
+    events = []
+    for order_id in updated:
+        order = orders[order_id]
+        staff_name = staff_names.get(order.staff_id)
+        deltas += status_deltas(order, order.status, staff_name)
+        events.append(('order_updated', {**order.to_dict(), 'staff_name': staff_name}, order.table_number))
+    apply_deltas(deltas)
+    db.session.commit()
+    broker.publish_many(events)
+
+    for result in results:
+        if result['error'] is None and result['order_id'] not in updated:
+            result['error'] = 'Order status changed meanwhile, please retry'
+        result['ok'] = result['error'] is None
+    return jsonify({'results': results, 'updated': len(updated)})
+
 @routes.route('/orders/<int:order_id>/status', methods=['OPTIONS'])
 def order_status_options(order_id):
     response = jsonify({'message': 'OK'})
@@ -191,13 +771,31 @@ def order_status_options(order_id):
 
 @routes.route('/payments', methods=['GET'])
 def get_payments():
-    payments = Payment.query.all()
-    return jsonify([{
+    try:
+        fields = parse_fields(PAYMENT_FIELDS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    query = Payment.query
+    page = parse_page_args()
+    if page is None:
+        payments = query.all()
+    else:
+        limit, after_id = page
+        payments = query.filter(Payment.id > after_id).order_by(Payment.id).limit(limit).all()
+
+    payments_data = project([{
         "id": payment.id,
         "order_id": payment.order_id,
         "amount": payment.amount,
         "status": payment.status
-    } for payment in payments])
+    } for payment in payments], fields)
+
+    if page is None:
+        return jsonify(payments_data)
+    return jsonify({
+        "payments": payments_data,
+        "next_after_id": payments[-1].id if len(payments) == page[0] else None
+    })
 
 # Process Refund
 @routes.route('/refunds', methods=['POST'])
@@ -212,7 +810,7 @@ def process_refund():
         return jsonify({"error": "Order not found"}), 404
         
     # Check if order is in a refundable state (must be Paid)
-    if order.status != "Paid":
+    if order.status != Order.STATUS_PAID:
         return jsonify({"error": "Order is not in a refundable state"}), 400
         
     # Find the original payment
@@ -229,7 +827,10 @@ def process_refund():
     
     order.status = "Refunded"
     db.session.add(refund)
+    record_status_change(order, Order.STATUS_PAID, order.status,
+                         order.staff.username if order.staff else None)
     db.session.commit()
+    broker.publish('order_refunded', order.to_dict(), table_number=order.table_number)
     
     return jsonify({
         "order_id": order_id,
@@ -256,41 +857,44 @@ def get_order(order_id):
     })
 
 @routes.route('/auth/qr', methods=['POST'])
+@limited('qr')
 def qr_auth():
-    data = request.json
+    data = request.get_json(silent=True) or {}
     table_number = data.get('tableNumber')
-    token = data.get('token')
-    
+
+    # The signature vouches for the table and user ids, so no query is needed
     try:
-        token_parts = token.split('-')
-        if len(token_parts) != 3 or token_parts[0] != str(table_number):
-            return jsonify({"error": "Invalid token"}), 401
-            
-        timestamp = int(token_parts[1])
-        if (time.time() * 1000 - timestamp) > 86400000:  # 24 hours in milliseconds
-            return jsonify({"error": "Token expired"}), 401
-            
-        # Find the table user
-        table_user = User.query.filter_by(table_number=int(table_number)).first()
-        if not table_user:
-            return jsonify({"error": "Table not found"}), 404
-            
-        access_token = create_access_token(
-            identity=table_user.id,  # Use the user ID instead of table number
-            additional_claims={"role": "table", "table_number": table_number}
-        )
-        
-        response = make_response(jsonify({
-            "access_token": access_token,
-            "role": "table",
-            "table_number": table_number
-        }))
-        
-        origin = request.headers.get('Origin')
-        if origin:
-            response.headers.add('Access-Control-Allow-Origin', origin)
-        response.headers.add('Access-Control-Allow-Credentials', 'true')
-        return response
-            
-    except (ValueError, AttributeError):
-        return jsonify({"error": "Invalid token format"}), 401
+        venue, user_id, token_table, nonce = verify_table_token(data.get('token'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 401
+    if str(token_table) != str(table_number):
+        return jsonify({"error": "Invalid token"}), 401
+    # The code was printed for one venue; sign the table in there
+    if venue != current_venue():
+        try:
+            switch_venue(venue)
+        except UnknownVenue:
+            return jsonify({"error": "Unknown venue"}), 404
+    # Tokens for tables deleted (or recreated) since they were issued stop working
+    if table_cache.get(token_table) != user_id:
+        return jsonify({"error": "Table not found"}), 404
+    if replay_cache.record(nonce) > current_app.config['QR_TOKEN_MAX_SCANS']:
+        return jsonify({"error": "QR code has been used too often, ask staff for a new one"}), 401
+
+    access_token = create_access_token(
+        identity=user_id,
+        additional_claims={"role": "table", "table_number": token_table, "venue": venue}
+    )
+
+    response = make_response(jsonify({
+        "access_token": access_token,
+        "role": "table",
+        "table_number": token_table,
+        "venue": venue
+    }))
+
+    origin = request.headers.get('Origin')
+    if origin:
+        response.headers.add('Access-Control-Allow-Origin', origin)
+    response.headers.add('Access-Control-Allow-Credentials', 'true')
+    return response
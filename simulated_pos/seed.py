@@ -0,0 +1,52 @@
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+from models import db, MenuItem, User
+
+def seed_users(accounts, password_hashes=None):
+    """Insert any accounts that don't exist yet in one statement.
+
+    `accounts` is a list of dicts with username, role, table_number and
+    password. Existing rows are found with a single query, and each distinct
+    password is hashed once unless a precomputed hash is supplied in
+    `password_hashes` (password -> hash). Returns the number of rows added.
+    Does not commit.
+    """
+    hashes = dict(password_hashes or {})
+    existing = db.session.query(User.username, User.table_number).all()
+    usernames = {username for username, _ in existing}
+    table_numbers = {table_number for _, table_number in existing if table_number is not None}
+
+    rows = []
+    for account in accounts:
+        if account['username'] in usernames or account.get('table_number') in table_numbers:
+            continue
+        password = account['password']
+        if password not in hashes:
+            hashes[password] = generate_password_hash(password)
+        rows.append({
+            'username': account['username'],
+            'role': account['role'],
+            'table_number': account.get('table_number'),
+            'password_hash': hashes[password]
+        })
+        usernames.add(account['username'])
+
+    if rows:
+        db.session.execute(insert(User), rows)
+    return len(rows)
+
+def seed_menu_items(items):
+    """Insert `items` (dicts of MenuItem columns) if the menu is empty. Does not commit."""
+    if db.session.query(MenuItem.id).first() is not None:
+        return 0
+    db.session.execute(insert(MenuItem), items)
+    return len(items)
+
+def table_accounts(table_numbers, password):
+    """Build seed accounts for tables; `password` may be a string or a function of the number."""
+    return [{
+        'username': f"table{table_number}",
+        'role': User.ROLE_TABLE,
+        'table_number': table_number,
+        'password': password(table_number) if callable(password) else password
+    } for table_number in table_numbers]
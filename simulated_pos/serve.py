@@ -0,0 +1,183 @@
+"""Production entry point: several pre-forked gunicorn workers.
+
+    python serve.py --workers 4 --threads 32 --bind 0.0.0.0:5001
+
+The app is built, the database created and seeded, and every venue's menu and
+identity caches warmed once in the master process; workers are forked from it
+and start serving immediately. Venues added after that are served once the
+server is restarted. A jobs process, forked from the master before any
+worker, moves old closed orders to the archive tables every
+ARCHIVE_INTERVAL_SECONDS and flushes the shared stock counters; the master
+itself runs no threads, as it forks again whenever a worker is replaced.
+SIGTERM drains in-flight requests for --graceful-timeout seconds, and SIGHUP
+reloads the workers one by one.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+
+from gunicorn.app.base import BaseApplication
+from gunicorn.arbiter import Arbiter
+from sqlalchemy.orm import configure_mappers
+
+from app import STARTED_AT, create_app, init_database, create_sample_data
+from cache import menu_cache, identity_cache, table_cache
+from events import brokers, EventRelay
+from archive import Archiver
+from stock import stock_engine, StockFlusher
+from dispatch import dispatcher
+from models import User
+from sharding import DEFAULT_VENUE, venue_router, venue_context
+from metrics import registry
+
+def warm_up(app):
+    """Do everything a worker would otherwise do on its first requests."""
+    with app.app_context():
+        configure_mappers()
+        init_database()
+        users_added, items_added = create_sample_data()
+        router = venue_router()
+        router.freeze()
+        for venue in router.venues():
+            with venue_context(venue):
+                if venue != DEFAULT_VENUE:
+                    init_database()
+                menu_cache.get()
+                identity_cache.warm(User.query)
+                table_cache.all()
+                if app.config['STOCK_WRITE_BEHIND']:
+                    # Apply stock sold before a crash, then start counting from there
+                    stock_engine.resync()
+                dispatcher.load()
+
+                # Cache invalidations and order events have to reach every worker
+                menu_cache.share_across_processes()
+                identity_cache.share_across_processes()
+                table_cache.share_across_processes()
+                stock_engine.share_across_processes()
+        # /metrics is answered by one worker but reports them all
+        registry.share_across_processes()
+        print(f"Seeded {users_added} users and {items_added} menu items; warmed {len(router.venues())} venues; "
+              f"warm-up took {(time.perf_counter() - STARTED_AT) * 1000:.1f} ms")
+        # Connections must not be shared with the children
+        router.dispose()
+
+class Server(BaseApplication):
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+def run_jobs(app, stopping, master_pid):
+    """One archiver and one stock flusher for the whole server, until
+    `stopping` is set or the master goes away."""
+    # Signals are the master's to handle; it sets `stopping` when it is done
+    for signum in (*Arbiter.SIGNALS, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    with app.app_context():
+        venue_router().dispose(close=False)
+
+    Archiver(app).start()
+    stock_flusher = StockFlusher(app)
+    stock_flusher.start()
+    while not stopping.wait(1):
+        if os.getppid() != master_pid:
+            break
+    # Workers have finished; write the last stock counts out
+    stock_flusher.stop()
+
+def when_ready(server):
+    # Runs before the first worker is forked, while the master has no threads.
+    # A bare fork: workers would try to join a multiprocessing.Process on exit
+    server.jobs_stopping = multiprocessing.Event()
+    master_pid = os.getpid()
+    server.jobs_pid = os.fork()
+    if server.jobs_pid == 0:
+        status = 0
+        try:
+            run_jobs(server.app.application, server.jobs_stopping, master_pid)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+def on_exit(server):
+    server.jobs_stopping.set()
+    try:
+        os.waitpid(server.jobs_pid, 0)
+    except ChildProcessError:
+        # Already reaped along with the workers
+        pass
+
+def post_fork(server, worker):
+    app = server.app.application
+    with app.app_context():
+        # Drop any pooled connections inherited from the master without closing them
+        venue_router().dispose(close=False)
+        venues = venue_router().venues()
+    if server.cfg.workers > 1:
+        for venue in venues:
+            broker = brokers.get(venue)
+            broker.relay = EventRelay(broker, app, venue)
+            broker.relay.start()
+
+def post_worker_init(worker):
+    # Gunicorn waits for open requests on SIGTERM, but /events streams never
+    # finish on their own; closing the broker ends them so shutdown stays graceful
+    handle_term = signal.getsignal(signal.SIGTERM)
+
+    def close_streams(signum, frame):
+        for _, broker in brokers.items():
+            broker.close()
+        handle_term(signum, frame)
+
+    signal.signal(signal.SIGTERM, close_streams)
+
+def worker_exit(server, worker):
+    for _, broker in brokers.items():
+        broker.close()
+        if broker.relay is not None:
+            broker.relay.stop()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve the POS backend with pre-forked workers")
+    parser.add_argument('--bind', default=os.environ.get('BIND', '0.0.0.0:5001'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1)))
+    # Every open /events stream holds a thread for as long as the client is
+    # connected; at most half of them stream, the other clients long-poll
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WEB_THREADS', 32)))
+    parser.add_argument('--graceful-timeout', type=int, default=30)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    app = create_app()
+    app.config['EVENTS_MAX_STREAMS'] = min(app.config['EVENTS_MAX_STREAMS'], args.threads // 2)
+    warm_up(app)
+    Server(app, {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'graceful_timeout': args.graceful_timeout,
+        'keepalive': 5,
+        'when_ready': when_ready,
+        'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
+        'on_exit': on_exit,
+    }).run()
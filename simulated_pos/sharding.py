@@ -0,0 +1,203 @@
+"""One database per venue.
+
+The default venue uses SQLALCHEMY_DATABASE_URI, which also holds the venue
+catalog (models.Venue); every other venue has its own database at the
+catalog's `database_url`. A request works on the venue in its token's
+`venue` claim, or the X-Venue header before login, and VenueSession runs its
+statements on that venue's engine, so venues never share a writer lock.
+"""
+from flask import current_app, g, has_app_context, request, jsonify
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from flask_sqlalchemy.session import Session
+from jwt import PyJWTError
+from sqlalchemy import create_engine, select, table, column
+from werkzeug.local import LocalProxy
+from contextlib import contextmanager
+from config import engine_profile, apply_pragmas
+from metrics import instrument_engine
+import os
+import re
+import threading
+
+DEFAULT_VENUE = os.environ.get('DEFAULT_VENUE', 'default')
+VENUE_HEADER = 'X-Venue'
+VENUE_SLUG = re.compile(r'^[a-z0-9][a-z0-9-]{0,39}$')
+
+# Core view of the catalog table, so routing doesn't depend on the models
+venue_table = table('venue', column('slug'), column('database_url'))
+
+class UnknownVenue(LookupError):
+    pass
+
+def current_venue():
+    """The venue the current request or background job works on."""
+    if has_app_context():
+        return g.get('venue') or DEFAULT_VENUE
+    return DEFAULT_VENUE
+
+class VenueRouter:
+    """Engines by venue, each made on first use from the catalog.
+
+    Once frozen (before forking workers) only the venues already loaded are
+    served: their caches and stock counters are the ones shared between
+    workers, so venues added later wait for a restart.
+    """
+
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+        self.frozen = False
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def engine(self, venue):
+        """Return the engine of `venue`, or raise UnknownVenue."""
+        if venue == DEFAULT_VENUE:
+            return self.db.engine
+        engine = self._engines.get(venue)
+        if engine is not None:
+            return engine
+        if self.frozen or not VENUE_SLUG.match(venue):
+            raise UnknownVenue(venue)
+        with self.db.engine.connect() as connection:
+            url = connection.scalar(select(venue_table.c.database_url).where(venue_table.c.slug == venue))
+        if url is None:
+            raise UnknownVenue(venue)
+        return self.add(venue, url)
+
+    def add(self, venue, url):
+        """Make (or return) the engine of `venue` for the database at `url`."""
+        with self._lock:
+            if venue not in self._engines:
+                _, pragmas = engine_profile(self.app.config)
+                engine = create_engine(url, **self.app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+                apply_pragmas(engine, pragmas)
+                instrument_engine(engine)
+                self._engines[venue] = engine
+            return self._engines[venue]
+
+    def discard(self, venue):
+        with self._lock:
+            engine = self._engines.pop(venue, None)
+        if engine is not None:
+            engine.dispose()
+
+    def venues(self):
+        """Every venue this process can serve: all of the catalog, or the loaded ones once frozen."""
+        if self.frozen:
+            return [DEFAULT_VENUE, *self._engines]
+        with self.db.engine.connect() as connection:
+            slugs = connection.scalars(select(venue_table.c.slug).order_by(venue_table.c.slug)).all()
+        return [DEFAULT_VENUE, *slugs]
+
+    def freeze(self):
+        for venue in self.venues():
+            self.engine(venue)
+        self.frozen = True
+
+    def dispose(self, close=True):
+        self.db.engine.dispose(close=close)
+        for engine in list(self._engines.values()):
+            engine.dispose(close=close)
+
+def venue_router():
+    return current_app.extensions['venues']
+
+def venue_engine(venue=None):
+    return venue_router().engine(venue or current_venue())
+
+class VenueSession(Session):
+    """Session that runs every statement on the current venue's engine."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and current_venue() != DEFAULT_VENUE:
+            return venue_engine()
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+@contextmanager
+def venue_context(venue):
+    """Work on `venue` inside the block, e.g. in a background thread.
+
+    The session is closed on the way in and out: it may hold a connection
+    to, and objects from, the other venue's database.
+    """
+    session = current_app.extensions['sqlalchemy'].session
+    previous = g.get('venue')
+    session.remove()
+    g.venue = venue
+    try:
+        yield
+    finally:
+        session.remove()
+        g.venue = previous
+
+def switch_venue(venue):
+    """Move the current request to `venue`, e.g. the one named in a QR token.
+    Must run before the request has used the database."""
+    venue_engine(venue)
+    current_app.extensions['sqlalchemy'].session.remove()
+    g.venue = venue
+
+def token_venue():
+    """The `venue` claim of the request's token, if it has a valid one."""
+    header = request.headers.get('Authorization', '')
+    token = header[7:] if header.startswith('Bearer ') else request.args.get('jwt')
+    if not token:
+        return None
+    try:
+        return decode_token(token).get('venue')
+    except (JWTExtendedException, PyJWTError):
+        return None
+
+class VenueLocal:
+    """One `factory()` object per venue.
+
+    `proxy` stands for the current venue's, so module-level singletons such
+    as the caches keep their names while each venue gets its own.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._instances = {}
+        self._lock = threading.Lock()
+        self.proxy = LocalProxy(self.get)
+        VENUE_LOCALS.append(self)
+
+    def get(self, venue=None):
+        venue = venue or current_venue()
+        instance = self._instances.get(venue)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(venue)
+                if instance is None:
+                    instance = self._instances[venue] = self.factory()
+        return instance
+
+    def items(self):
+        return list(self._instances.items())
+
+    def clear(self):
+        with self._lock:
+            self._instances.clear()
+
+VENUE_LOCALS = []
+
+def init_venues(app, db):
+    """Route every request to its venue's database."""
+    app.extensions['venues'] = VenueRouter(app, db)
+
+    @app.before_request
+    def route_to_venue():
+        # A token's venue wins over the header, so a token can't be used elsewhere
+        venue = token_venue() or request.headers.get(VENUE_HEADER) or DEFAULT_VENUE
+        try:
+            venue_engine(venue)
+        except UnknownVenue:
+            return jsonify({"error": "Unknown venue"}), 404
+        g.venue = venue
+
+    @app.teardown_request
+    def leave_venue(exc):
+        if g.pop('venue', DEFAULT_VENUE) != DEFAULT_VENUE:
+            db.session.remove()
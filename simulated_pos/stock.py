@@ -0,0 +1,316 @@
+from flask import Blueprint, jsonify
+from sqlalchemy import bindparam, delete, event, func, insert, select, update
+from sqlalchemy.orm import Session
+from collections import Counter
+from models import db, MenuItem, StockReservation, User
+from auth import role_required
+from sharding import VenueLocal, venue_context
+import multiprocessing
+import threading
+import time
+
+stock = Blueprint('stock', __name__)
+
+# Counters available for tracked items; plenty for a bar menu
+STOCK_SLOTS = 1024
+
+class StockEngine:
+    """Tracked stock counted in memory, so orders don't all update the same
+    MenuItem rows.
+
+    A reservation takes stock off the counters and adds StockReservation rows
+    to the order's own transaction. Committed sales are therefore never lost
+    if the process dies; flush() folds the journal into menu_item.stock, and
+    loading the counters subtracts whatever is still unflushed. Reservations
+    are confirmed or handed back when the session commits or rolls back.
+    """
+
+    def __init__(self, slots=STOCK_SLOTS):
+        self.slots = slots
+        self._lock = threading.RLock()
+        self._ids = [0] * slots          # menu item id in each slot, 0 if free
+        self._available = [0] * slots
+        self._in_flight = [0] * slots    # reserved by orders not committed yet
+        self._meta = [0, 0, 0, 0]        # loaded flag, version, commits running, reloads running
+        self._index = {}                 # item id -> slot, rebuilt on a miss
+
+    @property
+    def loaded(self):
+        return bool(self._meta[0])
+
+    @property
+    def version(self):
+        return self._meta[1]
+
+    def share_across_processes(self):
+        """Move the counters into shared memory so forked workers reserve
+        against the same numbers. Call before forking."""
+        with self._lock:
+            self._ids = multiprocessing.Array('q', self._ids, lock=False)
+            self._available = multiprocessing.Array('q', self._available, lock=False)
+            self._in_flight = multiprocessing.Array('q', self._in_flight, lock=False)
+            self._meta = multiprocessing.Array('q', self._meta, lock=False)
+            self._lock = multiprocessing.RLock()
+
+    def reset(self):
+        with self._lock:
+            for slot in range(self.slots):
+                self._ids[slot] = self._available[slot] = self._in_flight[slot] = 0
+            self._meta[0] = 0
+            self._meta[1] += 1
+            self._meta[2] = self._meta[3] = 0
+            self._index.clear()
+
+    def load(self, item_ids=None):
+        """Set the counters from the database: stock less unflushed and in-flight
+        reservations. Loads every tracked item unless `item_ids` is given."""
+        journalled = (
+            select(func.coalesce(func.sum(StockReservation.quantity), 0))
+            .where(StockReservation.menu_item_id == MenuItem.id)
+            .scalar_subquery()
+        )
+        query = select(MenuItem.id, MenuItem.stock - journalled).where(
+            MenuItem.track_stock.is_(True), MenuItem.stock.isnot(None)
+        )
+        if item_ids is not None:
+            query = query.where(MenuItem.id.in_(item_ids))
+        with self._lock:
+            for item_id, available in db.session.execute(query):
+                slot = self._slot(item_id)
+                if slot is None:
+                    slot = self._slot(0)
+                    if slot is None:
+                        raise RuntimeError("No free stock counters left")
+                    self._ids[slot] = item_id
+                    self._in_flight[slot] = 0
+                    self._index[item_id] = slot
+                self._available[slot] = available - self._in_flight[slot]
+            self._meta[0] = 1
+            self._meta[1] += 1
+
+    def _slot(self, item_id):
+        # Caller holds the lock
+        slot = self._index.get(item_id)
+        if slot is not None and self._ids[slot] == item_id:
+            return slot
+        for slot in range(self.slots):
+            if self._ids[slot] == item_id:
+                if item_id:
+                    self._index[item_id] = slot
+                return slot
+        return None
+
+    def _slots(self, item_ids):
+        # Caller holds the lock; loads counters for items seen for the first time
+        if not self.loaded:
+            self.load()
+        missing = [item_id for item_id in item_ids if self._slot(item_id) is None]
+        if missing:
+            self.load(missing)
+        return {item_id: self._slot(item_id) for item_id in item_ids}
+
+    def available(self, item_ids):
+        """Return `{item_id: available}` for tracked items."""
+        with self._lock:
+            slots = self._slots(item_ids)
+            return {item_id: self._available[slot] for item_id, slot in slots.items() if slot is not None}
+
+    def snapshot(self):
+        """Return `(version, {item_id: available})` for every loaded item, or None before loading."""
+        with self._lock:
+            if not self.loaded:
+                return None
+            return self.version, {
+                self._ids[slot]: self._available[slot]
+                for slot in range(self.slots) if self._ids[slot]
+            }
+
+    def reserve(self, quantities):
+        """Take `quantities` ({item_id: quantity}) off the counters, all or nothing.
+
+        Returns False, changing nothing, if any item is short. On success the
+        journal rows are added to the current session.
+        """
+        with self._lock:
+            slots = self._slots(quantities)
+            if any(slot is None or self._available[slot] < quantities[item_id]
+                   for item_id, slot in slots.items()):
+                return False
+            for item_id, slot in slots.items():
+                self._available[slot] -= quantities[item_id]
+                self._in_flight[slot] += quantities[item_id]
+            self._meta[1] += 1
+
+        db.session.info.setdefault('stock_reserved', []).append(quantities)
+        db.session.execute(insert(StockReservation), [
+            {'menu_item_id': item_id, 'quantity': quantity} for item_id, quantity in quantities.items()
+        ])
+        return True
+
+    def restock(self, quantities):
+        """Put `quantities` back, e.g. from a cancelled order.
+
+        Negative journal rows are added to the current session; the counters
+        only go up once it commits, so nothing is sold twice if it rolls back.
+        """
+        with self._lock:
+            # Loaded now, so a load after the commit can't count them twice
+            self._slots(quantities)
+        db.session.info.setdefault('stock_restocked', []).append(quantities)
+        db.session.execute(insert(StockReservation), [
+            {'menu_item_id': item_id, 'quantity': -quantity} for item_id, quantity in quantities.items()
+        ])
+
+    def begin_commit(self):
+        """Called before a transaction holding reservations commits. Waits
+        while resync() reads the database, so that no reservation can
+        commit between that read and its confirm()."""
+        while True:
+            with self._lock:
+                if not self._meta[3]:
+                    self._meta[2] += 1
+                    return
+            time.sleep(0.001)
+
+    def end_commit(self):
+        with self._lock:
+            self._meta[2] -= 1
+
+    def confirm(self, quantities):
+        with self._lock:
+            for item_id, slot in self._slots(quantities).items():
+                self._in_flight[slot] -= quantities[item_id]
+
+    def confirm_restock(self, quantities):
+        with self._lock:
+            for item_id, slot in self._slots(quantities).items():
+                self._available[slot] += quantities[item_id]
+            self._meta[1] += 1
+
+    def release(self, quantities):
+        with self._lock:
+            for item_id, slot in self._slots(quantities).items():
+                self._available[slot] += quantities[item_id]
+                self._in_flight[slot] -= quantities[item_id]
+            self._meta[1] += 1
+
+    def flush(self):
+        """Fold the journal into menu_item.stock in one transaction. Safe from
+        any process at any time; returns the number of journal rows applied."""
+        rows = db.session.execute(
+            delete(StockReservation).returning(StockReservation.menu_item_id, StockReservation.quantity)
+        ).all()
+        totals = Counter()
+        for item_id, quantity in rows:
+            totals[item_id] += quantity
+        if totals:
+            table = MenuItem.__table__
+            db.session.execute(
+                update(table)
+                .where(table.c.id == bindparam('item_id'))
+                .values(stock=table.c.stock - bindparam('quantity')),
+                [{'item_id': item_id, 'quantity': quantity} for item_id, quantity in totals.items()]
+            )
+            db.session.info['menu_changed'] = True
+        db.session.commit()
+        return len(rows)
+
+    def resync(self):
+        """Flush, then reload every counter from the database.
+
+        The reload subtracts reservations still in flight, so it waits for
+        reservations already committing to be confirmed, and holds new
+        commits back until it has read the database; otherwise a sale would
+        be counted twice, in the journal and in flight. The flush runs
+        without the lock: an order holding the database write lock may be
+        waiting for it to reserve.
+        """
+        flushed = self.flush()
+        with self._lock:
+            self._meta[3] += 1
+        try:
+            while self._meta[2]:
+                time.sleep(0.001)
+            with self._lock:
+                self.load()
+        finally:
+            with self._lock:
+                self._meta[3] -= 1
+        return flushed
+
+# Each venue counts its own stock; stock_engine is the current venue's
+stock_engines = VenueLocal(StockEngine)
+stock_engine = stock_engines.proxy
+
+class StockFlusher:
+    """Flushes every venue's stock engine each STOCK_FLUSH_INTERVAL_SECONDS in a background thread."""
+
+    def __init__(self, app):
+        self.app = app
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='stock-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread after one last flush."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                stopping = self._stop.wait(self.app.config['STOCK_FLUSH_INTERVAL_SECONDS'])
+                for venue, engine in stock_engines.items():
+                    with venue_context(venue):
+                        try:
+                            engine.flush()
+                        except Exception as e:
+                            db.session.rollback()
+                            print(f"Stock flush failed for {venue}: {str(e)}")
+                if stopping:
+                    return
+
+# Confirm or hand back reservations, and add restocked items to the
+# counters, with the transaction that made them
+@event.listens_for(Session, 'before_commit')
+def begin_stock_commit(session):
+    if ((session.info.get('stock_reserved') or session.info.get('stock_restocked'))
+            and not session.info.get('stock_committing')):
+        stock_engine.begin_commit()
+        session.info['stock_committing'] = True
+
+@event.listens_for(Session, 'after_commit')
+def confirm_stock(session):
+    for quantities in session.info.pop('stock_reserved', ()):
+        stock_engine.confirm(quantities)
+    for quantities in session.info.pop('stock_restocked', ()):
+        stock_engine.confirm_restock(quantities)
+    if session.info.pop('stock_committing', False):
+        stock_engine.end_commit()
+
+# Anything not confirmed when the transaction ends was never committed: it
+# was rolled back, or the session was closed with it unfinished
+@event.listens_for(Session, 'after_transaction_end')
+def release_stock(session, transaction):
+    if transaction.parent is not None:
+        return
+    for quantities in session.info.pop('stock_reserved', ()):
+        stock_engine.release(quantities)
+    session.info.pop('stock_restocked', None)
+    if session.info.pop('stock_committing', False):
+        stock_engine.end_commit()
+
+@stock.route('/stock/resync', methods=['POST'])
+@role_required([User.ROLE_ADMIN])
+def resync_stock():
+    flushed = stock_engine.resync()
+    _, items = stock_engine.snapshot()
+    return jsonify({
+        "flushed": flushed,
+        "stock": {str(item_id): available for item_id, available in sorted(items.items())}
+    })
@@ -1,18 +1,72 @@
 import pytest
-from app import app, db
+from contextlib import contextmanager
+from werkzeug.security import generate_password_hash
+from app import create_app, create_sample_data, init_database, db
+from cache import identity_cache, table_cache
+from idempotency import response_cache
+from qr import replay_cache
+from limits import rate_limiter
+from stock import stock_engine
+from dispatch import dispatcher
+from metrics import QueryCounter
+from sharding import VENUE_LOCALS, venue_router
+
+# Hash the seed passwords once for the whole run
+SEED_PASSWORD_HASHES = {
+    password: generate_password_hash(password)
+    for password in ('admin123', 'staff123', 'table123')
+}
 
 @pytest.fixture
-def application():
-    app.config['TESTING'] = True
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    app.config['JWT_SECRET_KEY'] = 'test-key'
+def application(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'VENUE_DATABASE_URL': f"sqlite:///{tmp_path}/venue-{{venue}}.db",
+        'JWT_SECRET_KEY': 'test-key',
+        'SEED_PASSWORD_HASHES': SEED_PASSWORD_HASHES,
+        # Tests fire requests far faster than any client; test_rate_limits turns them on
+        'RATE_LIMITS': {},
+        'CONCURRENCY_LIMITS': {}
+    })
     
     with app.app_context():
-        db.create_all()
-        # Assume that the database is pre-populated with users
+        init_database()
+        # Pre-populate the database with the sample users and menu
+        create_sample_data()
         yield app
         db.drop_all()
+        identity_cache.clear()
+        table_cache.clear()
+        replay_cache.clear()
+        rate_limiter.clear()
+        response_cache.clear()
+        stock_engine.reset()
+        dispatcher.reset()
+        # Other venues' caches and engines belong to this test's databases
+        for venue_local in VENUE_LOCALS:
+            venue_local.clear()
+        venue_router().dispose()
 
 @pytest.fixture
 def client(application):
-    return application.test_client() 
\ No newline at end of file
+    return application.test_client()
+
+@pytest.fixture
+def query_budget(application):
+    """Fail the test if the block runs more than `max_statements` SQL statements.
+
+        with query_budget(3):
+            client.get('/orders', headers=headers)
+    """
+    @contextmanager
+    def budget(max_statements):
+        with QueryCounter(db.engine) as counter:
+            yield counter
+        if counter.count > max_statements:
+            statements = "\n".join(f"  {number}. {statement}" for number, statement in enumerate(counter.statements, 1))
+            pytest.fail(
+                f"Query budget exceeded: {counter.count} statements, budget {max_statements}\n{statements}",
+                pytrace=False
+            )
+    return budget
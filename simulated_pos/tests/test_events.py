@@ -0,0 +1,108 @@
+from events import EventBroker, EventRelay, broker
+from flask_jwt_extended import create_access_token
+
+def read_events(response, count):
+    """Read `count` SSE messages (skipping the retry hint) from a streamed response"""
+    messages = []
+    chunks = iter(response.response)
+    while len(messages) < count:
+        chunk = next(chunks)
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        if not chunk.startswith('retry:'):
+            messages.append(chunk)
+    response.close()
+    return messages
+
+def test_broker_resume_from_last_event_id():
+    """Test the broker replays only events after the given id"""
+    events_broker = EventBroker(history=3)
+    first = events_broker.publish('order_created', {'id': 1}, table_number=1)
+    events_broker.publish('order_updated', {'id': 1}, table_number=1)
+
+    pending, complete = events_broker.wait(first, timeout=0)
+    assert complete
+    assert [event['type'] for event in pending] == ['order_updated']
+
+    # Older than the buffer: the client must reload
+    for order_id in range(2, 6):
+        events_broker.publish('order_created', {'id': order_id}, table_number=2)
+    pending, complete = events_broker.wait(first, timeout=0)
+    assert not complete
+
+    # Nothing new: returns after the timeout as a heartbeat
+    pending, complete = events_broker.wait(events_broker.last_id, timeout=0.01)
+    assert pending == [] and complete
+
+def test_event_stream_filters_by_table(client, application):
+    """Test tables only receive their own events while staff receive all"""
+    application.config['EVENTS_HEARTBEAT_SECONDS'] = 0.05
+    start = broker.last_id
+    broker.publish('order_created', {'id': 1, 'table_number': 1}, table_number=1)
+    broker.publish('order_created', {'id': 2, 'table_number': 2}, table_number=2)
+
+    table_token = create_access_token(identity='4', additional_claims={'role': 'table', 'table_number': 2})
+    response = client.get(f'/events?jwt={table_token}&last_event_id={start}', buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    messages = read_events(response, 2)
+    assert messages[0].startswith(f"id: {start + 2}\nevent: order_created\n")
+    assert messages[1] == ": heartbeat\n\n"
+
+    staff_token = create_access_token(identity='2', additional_claims={'role': 'staff'})
+    response = client.get('/events',
+        headers={'Authorization': f'Bearer {staff_token}', 'Last-Event-ID': str(start)},
+        buffered=False
+    )
+    messages = read_events(response, 2)
+    assert [message.split('\n')[0] for message in messages] == [f"id: {start + 1}", f"id: {start + 2}"]
+
+def test_relay_shares_events_between_brokers(application):
+    """Test events published by one worker's broker reach every worker through the relay"""
+    brokers = [EventBroker(), EventBroker()]
+    relays = [EventRelay(events_broker, application, poll_interval=0.01) for events_broker in brokers]
+    for events_broker, relay in zip(brokers, relays):
+        events_broker.relay = relay
+        relay.start()
+    try:
+        with application.app_context():
+            event_id = brokers[0].publish('order_created', {'id': 1}, table_number=3)
+        for events_broker in brokers:
+            pending, complete = events_broker.wait(0, timeout=2)
+            assert complete
+            assert [(event['id'], event['type'], event['table_number']) for event in pending] == \
+                [(event_id, 'order_created', 3)]
+
+        # Waiting streams wake up and finish when the broker is closed
+        brokers[1].close()
+        assert brokers[1].wait(event_id, timeout=2) == ([], True)
+    finally:
+        for relay in relays:
+            relay.stop()
+
+def test_streams_past_the_cap_become_long_polls(client, application):
+    """Test clients past EVENTS_MAX_STREAMS get a response that ends, so threads stay free"""
+    application.config.update(EVENTS_MAX_STREAMS=1, EVENTS_LONG_POLL_SECONDS=0.05, EVENTS_HEARTBEAT_SECONDS=0.05)
+    staff_token = create_access_token(identity='2', additional_claims={'role': 'staff'})
+    table_token = create_access_token(identity='4', additional_claims={'role': 'table', 'table_number': 2})
+    start = broker.last_id
+    broker.publish('order_created', {'id': 1, 'table_number': 1}, table_number=1)
+    broker.publish('order_created', {'id': 2, 'table_number': 2}, table_number=2)
+    broker.publish('order_created', {'id': 3, 'table_number': 1}, table_number=1)
+
+    stream = client.get(f'/events?jwt={staff_token}&last_event_id={start + 3}', buffered=False)
+    assert next(iter(stream.response)).startswith(b'retry: 3000')
+
+    # The poll ends after the pending events; skipped ones still move the client's cursor on
+    poll = client.get(f'/events?jwt={table_token}&last_event_id={start}')
+    body = poll.get_data(as_text=True)
+    assert body.startswith('retry: 0\n\n')
+    assert [line for line in body.split('\n') if line.startswith('id: ')] == \
+        [f"id: {start + 2}", f"id: {start + 3}"]
+    # With nothing new it ends after EVENTS_LONG_POLL_SECONDS
+    assert client.get(f'/events?jwt={table_token}&last_event_id={start + 3}').get_data(as_text=True) == 'retry: 0\n\n'
+
+    # Closing the stream frees its place
+    stream.close()
+    response = client.get(f'/events?jwt={table_token}&last_event_id={start + 3}', buffered=False)
+    assert next(iter(response.response)).startswith(b'retry: 3000')
+    response.close()
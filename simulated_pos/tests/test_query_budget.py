@@ -0,0 +1,72 @@
+import pytest
+from datetime import datetime
+from sqlalchemy import insert
+from models import db, User, MenuItem, Order
+from stock import stock_engine
+from flask_jwt_extended import create_access_token
+
+def auth_headers(username):
+    user = User.query.filter_by(username=username).first()
+    token = create_access_token(
+        identity=str(user.id),
+        additional_claims={'role': user.role, 'table_number': user.table_number}
+    )
+    return {'Authorization': f'Bearer {token}'}
+
+def test_get_orders_budget_with_500_orders(client, query_budget):
+    """Test listing 500 orders stays a constant number of queries"""
+    staff = User.query.filter_by(username='staff1').first()
+    table = User.query.filter_by(username='table1').first()
+    now = datetime.utcnow()
+    db.session.execute(insert(Order), [{
+        'user_id': table.id, 'table_number': 1, 'status': 'Accepted', 'total_price': 8.5,
+        'items': [{'id': 1, 'name': 'Mojito', 'price': 8.5, 'quantity': 1}],
+        'staff_id': staff.id, 'created_at': now, 'updated_at': now
+    } for _ in range(500)])
+    db.session.commit()
+    headers = auth_headers('staff1')
+
+    with query_budget(3):
+        response = client.get('/orders', headers=headers)
+    assert len(response.json) == 500
+
+    with query_budget(3):
+        response = client.get('/orders', query_string={'since': ''}, headers=headers)
+    assert len(response.json['orders']) == 500
+
+    with query_budget(2):
+        client.get('/orders', query_string={'limit': 100}, headers=headers)
+
+def test_create_order_budget_with_20_lines(client, query_budget):
+    """Test an order with 20 tracked-stock lines stays a constant number of queries"""
+    items = [
+        MenuItem(name=f'Budget Drink {number}', price=5.0, category='drink', stock=100, track_stock=True)
+        for number in range(20)
+    ]
+    db.session.add_all(items)
+    db.session.commit()
+    # Stock counters are loaded at start-up in production
+    stock_engine.load()
+    lines = [{'id': item.id, 'quantity': 1} for item in items]
+    headers = auth_headers('table1')
+
+    # Two of them number the change for the order feed
+    with query_budget(9):
+        response = client.post('/orders', json={'items': lines}, headers=headers)
+    assert response.status_code == 201
+
+def test_menu_budget(client, query_budget):
+    """Test the menu is read from the database once and then served from cache"""
+    with query_budget(1):
+        client.get('/menu')
+    with query_budget(0):
+        client.get('/menu')
+        client.get('/menu', query_string={'category': 'drink'})
+
+def test_query_budget_reports_statements(client, query_budget):
+    """Test an exceeded budget fails and lists the statements that ran"""
+    with pytest.raises(pytest.fail.Exception) as excinfo:
+        with query_budget(0):
+            User.query.filter_by(username='admin').first()
+    assert 'Query budget exceeded: 1 statements, budget 0' in str(excinfo.value)
+    assert 'FROM user' in str(excinfo.value)
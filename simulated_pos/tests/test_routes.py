@@ -1,23 +1,35 @@
 import pytest
-from app import app, db
-from models import User, MenuItem, Order, Payment
+import gzip
+import json
+import multiprocessing
+import threading
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
+from app import db, create_sample_data, init_database
+from models import User, MenuItem, Order, OrderLine, Payment, StockReservation, IdempotencyKey, ArchivedOrder
+from cache import MenuCache, identity_cache
+from metrics import MetricsRegistry
+from events import broker
+from stock import stock_engine
+from dispatch import dispatcher
+from idempotency import response_cache, CLAIM_TIMEOUT, KEY_TTL
+from limits import concurrency_limiter
+from encoding import orjson
 from flask_jwt_extended import create_access_token
 
-@pytest.fixture
-def application():
-    app.config['TESTING'] = True
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    app.config['JWT_SECRET_KEY'] = 'test-key'
-    
-    with app.app_context():
-        db.create_all()
-        # Assume that the database is pre-populated with users
-        yield app
-        db.drop_all()
-
-@pytest.fixture
-def client(application):
-    return application.test_client()
+def token_for(username):
+    """Access token with the same claims /auth/login issues for a seeded user"""
+    user = User.query.filter_by(username=username).first()
+    return create_access_token(
+        identity=str(user.id),
+        additional_claims={'role': user.role, 'table_number': user.table_number}
+    )
 
 def test_create_order(client):
     """Test order creation by table"""
@@ -41,7 +53,7 @@ def test_create_order(client):
 def test_update_order_status(client):
     """Test order status updates by staff"""
     # Create initial order as table
-    table_token = create_access_token(identity={'id': 3, 'role': 'table'})
+    table_token = token_for('table1')
     response = client.post('/orders',
         json={'items': [{'id': 1, 'quantity': 1}]},
         headers={'Authorization': f'Bearer {table_token}'}
@@ -49,15 +61,16 @@ def test_update_order_status(client):
     order_id = response.json['order_id']
     
     # Login as staff
-    staff_token = create_access_token(identity={'id': 2, 'role': 'staff'})
+    staff_token = token_for('staff1')
     
-    # Update to Preparing
+    # Update to Accepted
     response = client.put(f'/orders/{order_id}/status',
-        json={'status': 'Preparing'},
+        json={'status': 'Accepted'},
         headers={'Authorization': f'Bearer {staff_token}'}
     )
     assert response.status_code == 200
-    assert response.json['status'] == 'Preparing'
+    assert response.json['status'] == 'Accepted'
+    assert response.json['staff_name'] == 'staff1'
     
     # Update to Completed
     response = client.put(f'/orders/{order_id}/status',
@@ -67,10 +80,57 @@ def test_update_order_status(client):
     assert response.status_code == 200
     assert response.json['status'] == 'Completed'
 
+def test_update_order_status_enforces_transitions(client):
+    """Unknown statuses, invalid transitions and lost races are rejected"""
+    table_token = token_for('table1')
+    response = client.post('/orders',
+        json={'items': [{'id': 1, 'quantity': 1}]},
+        headers={'Authorization': f'Bearer {table_token}'}
+    )
+    order_id = response.json['order_id']
+    staff1 = {'Authorization': f"Bearer {token_for('staff1')}"}
+    staff2 = {'Authorization': f"Bearer {token_for('staff2')}"}
+
+    response = client.put(f'/orders/{order_id}/status', json={'status': 'Preparing'}, headers=staff1)
+    assert response.status_code == 400
+    # Tables can't change orders, and refunds have their own endpoint
+    response = client.put(f'/orders/{order_id}/status', json={'status': 'Accepted'},
+                          headers={'Authorization': f'Bearer {table_token}'})
+    assert response.status_code == 403
+    response = client.put(f'/orders/{order_id}/status', json={'status': 'Refunded'}, headers=staff1)
+    assert response.status_code == 400
+    # ...but a table can still cancel its own pending orders
+    other = client.post('/orders', json={'items': [{'id': 1, 'quantity': 1}]},
+                        headers={'Authorization': f'Bearer {table_token}'}).json['order_id']
+    table2 = {'Authorization': f"Bearer {token_for('table2')}"}
+    assert client.post(f'/orders/{other}/cancel', headers=table2).status_code == 404
+    response = client.post(f'/orders/{other}/cancel', headers={'Authorization': f'Bearer {table_token}'})
+    assert response.json['status'] == 'Refunded'
+    response = client.post(f'/orders/{other}/cancel', headers={'Authorization': f'Bearer {table_token}'})
+    assert response.status_code == 409
+
+    response = client.put(f'/orders/{order_id}/status', json={'status': 'Completed'}, headers=staff1)
+    assert response.status_code == 409
+    assert response.json['status'] == 'Pending'
+
+    # Both staff accept the same order; only the first one gets it
+    response = client.put(f'/orders/{order_id}/status', json={'status': 'Accepted'}, headers=staff1)
+    assert response.status_code == 200
+    response = client.put(f'/orders/{order_id}/status', json={'status': 'Accepted'}, headers=staff2)
+    assert response.status_code == 409
+    assert response.json['status'] == 'Accepted'
+
+    with client.application.app_context():
+        order = db.session.get(Order, order_id)
+        assert order.staff_id == 2
+
+    response = client.put('/orders/9999/status', json={'status': 'Accepted'}, headers=staff1)
+    assert response.status_code == 404
+
 def test_process_payment(client):
     """Test payment processing for an order"""
     # Create order as table
-    table_token = create_access_token(identity={'id': 3, 'role': 'table'})
+    table_token = token_for('table1')
     response = client.post('/orders',
         json={'items': [{'id': 1, 'quantity': 1}]},
         headers={'Authorization': f'Bearer {table_token}'}
@@ -88,7 +148,7 @@ def test_process_payment(client):
 def test_process_refund(client):
     """Test refund processing for a paid order"""
     # Create and pay for an order
-    table_token = create_access_token(identity={'id': 3, 'role': 'table'})
+    table_token = token_for('table1')
     response = client.post('/orders',
         json={'items': [{'id': 1, 'quantity': 1}]},
         headers={'Authorization': f'Bearer {table_token}'}
@@ -101,7 +161,7 @@ def test_process_refund(client):
     )
     
     # Process refund as admin
-    admin_token = create_access_token(identity={'id': 1, 'role': 'admin'})
+    admin_token = token_for('admin')
     response = client.post('/refunds',
         json={'order_id': order_id},
         headers={'Authorization': f'Bearer {admin_token}'}
@@ -171,4 +231,1065 @@ def test_create_staff_unauthorized(client):
     )
     
     assert response.status_code == 401  # Unauthorized without token
-'''
\ No newline at end of file
+'''
+def test_orders_since_cursor(client):
+    """Test the incremental order feed only returns changed orders"""
+    table_user = User(username='cursor_table', role='table', table_number=901)
+    item = MenuItem(name='Cursor Tonic', price=3.00, category='drink', track_stock=False)
+    db.session.add_all([table_user, item])
+    db.session.commit()
+
+    token = create_access_token(
+        identity=str(table_user.id),
+        additional_claims={'role': 'table', 'table_number': 901}
+    )
+    headers = {'Authorization': f'Bearer {token}'}
+    client.post('/orders', json={'items': [{'id': item.id, 'quantity': 1}]}, headers=headers)
+
+    # Empty cursor returns everything plus the first cursor
+    response = client.get('/orders', query_string={'since': ''}, headers=headers)
+    assert response.status_code == 200
+    assert len(response.json['orders']) == 1
+    cursor = response.json['next_cursor']
+
+    # Nothing changed since the cursor
+    response = client.get('/orders', query_string={'since': cursor}, headers=headers)
+    assert response.json['orders'] == []
+    assert response.json['next_cursor'] == cursor
+
+    # Only the new order comes back
+    response = client.post('/orders', json={'items': [{'id': item.id, 'quantity': 2}]}, headers=headers)
+    new_order_id = response.json['order_id']
+    response = client.get('/orders', query_string={'since': cursor}, headers=headers)
+    assert [order['id'] for order in response.json['orders']] == [new_order_id]
+    assert response.json['next_cursor'] != cursor
+
+    response = client.get('/orders', query_string={'since': 'garbage'}, headers=headers)
+    assert response.status_code == 400
+
+def test_orders_since_cursor_sees_late_commits(client):
+    """Test a change committed after a poll comes back past that poll's
+    cursor, even though its updated_at is older than the polled change"""
+    table_headers = {'Authorization': f'Bearer {token_for("table1")}'}
+    staff_headers = {'Authorization': f'Bearer {token_for("staff1")}'}
+    first, second = (
+        client.post('/orders', json={'items': [{'id': 1, 'quantity': 1}]}, headers=table_headers).json['order_id']
+        for _ in range(2)
+    )
+    cursor = client.get('/orders', query_string={'since': ''}, headers=staff_headers).json['next_cursor']
+
+    # A writer stamps its change, then waits for the write lock while another commits
+    late = Session(bind=db.session.get_bind())
+    late.get(Order, first).updated_at = datetime.utcnow()
+    client.put(f'/orders/{second}/status', json={'status': 'Accepted'}, headers=staff_headers)
+    response = client.get('/orders', query_string={'since': cursor}, headers=staff_headers)
+    assert [order['id'] for order in response.json['orders']] == [second]
+    cursor = response.json['next_cursor']
+
+    late.commit()
+    late.close()
+    response = client.get('/orders', query_string={'since': cursor}, headers=staff_headers)
+    assert [order['id'] for order in response.json['orders']] == [first]
+
+@pytest.mark.parametrize('write_behind', [True, False])
+def test_concurrent_orders_do_not_oversell(client, application, write_behind):
+    """Test parallel orders for a low-stock item sell exactly the remaining
+    stock, reserved in memory or by conditional UPDATEs on the database"""
+    application.config['STOCK_WRITE_BEHIND'] = write_behind
+    table_user = User(username='rush_table', role='table', table_number=902)
+    item = MenuItem(name='Last Mojitos', price=8.50, category='drink', stock=5, track_stock=True)
+    db.session.add_all([table_user, item])
+    db.session.commit()
+    item_id = item.id
+
+    token = create_access_token(
+        identity=str(table_user.id),
+        additional_claims={'role': 'table', 'table_number': 902}
+    )
+
+    def place_order(_):
+        with application.test_client() as thread_client:
+            response = thread_client.post('/orders',
+                json={'items': [{'id': item_id, 'quantity': 1}]},
+                headers={'Authorization': f'Bearer {token}'}
+            )
+            return response.status_code
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = list(pool.map(place_order, range(12)))
+
+    assert statuses.count(201) == 5
+    assert statuses.count(400) == 7
+    stock_engine.flush()
+    assert db.session.get(MenuItem, item_id).stock == 0
+
+@pytest.mark.parametrize('write_behind', [True, False])
+def test_cancel_order_returns_stock(client, application, write_behind):
+    """Test a table cancelling its pending order puts the stock back, in the
+    counters and in menu_item.stock, and only once the cancel commits"""
+    application.config['STOCK_WRITE_BEHIND'] = write_behind
+    headers = {'Authorization': f'Bearer {token_for("table1")}'}
+    # Gin is the tracked item; the Mojito has no stock to return
+    order_id = client.post('/orders', json={'items': [
+        {'id': 3, 'quantity': 2}, {'id': 1, 'quantity': 1}, {'id': 3, 'quantity': 1}
+    ]}, headers=headers).json['order_id']
+
+    def gin_left():
+        db.session.expire_all()
+        stock_engine.flush()
+        stock = db.session.get(MenuItem, 3).stock
+        if write_behind:
+            assert stock_engine.available([3]) == {3: stock}
+        return stock
+
+    assert gin_left() == 97
+    response = client.post(f'/orders/{order_id}/cancel', headers=headers)
+    assert response.status_code == 200
+    assert gin_left() == 100
+    # Cancelling again returns nothing more
+    assert client.post(f'/orders/{order_id}/cancel', headers=headers).status_code == 409
+    assert gin_left() == 100
+    if write_behind:
+        # A cancel that rolls back returns nothing
+        stock_engine.restock({3: 5})
+        db.session.rollback()
+        assert gin_left() == 100
+
+def test_create_order_rejects_whole_order(client):
+    """Test an order with one short line leaves all stock untouched"""
+    table_user = User(username='short_table', role='table', table_number=903)
+    gin = MenuItem(name='Short Gin', price=7.00, category='drink', stock=10, track_stock=True)
+    vodka = MenuItem(name='Short Vodka', price=8.00, category='drink', stock=1, track_stock=True)
+    db.session.add_all([table_user, gin, vodka])
+    db.session.commit()
+
+    token = create_access_token(
+        identity=str(table_user.id),
+        additional_claims={'role': 'table', 'table_number': 903}
+    )
+    response = client.post('/orders',
+        json={'items': [{'id': gin.id, 'quantity': 2}, {'id': vodka.id, 'quantity': 1}, {'id': vodka.id, 'quantity': 1}]},
+        headers={'Authorization': f'Bearer {token}'}
+    )
+    assert response.status_code == 400
+    db.session.expire_all()
+    assert gin.stock == 10
+    assert vodka.stock == 1
+
+def test_menu_etag_and_filters(client):
+    """Test the cached menu supports conditional GETs and filters"""
+    item = MenuItem(name='Etag Rum', price=9.00, category='drink', stock=1, track_stock=True)
+    service = MenuItem(name='Etag Waiter', price=0.00, category='service', track_stock=False)
+    table_user = User(username='etag_table', role='table', table_number=904)
+    db.session.add_all([item, service, table_user])
+    db.session.commit()
+
+    response = client.get('/menu')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-cache'
+    etag = response.headers['ETag']
+
+    response = client.get('/menu', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    response = client.get('/menu', query_string={'category': 'service'})
+    assert 'Etag Waiter' in [menu_item['name'] for menu_item in response.json]
+    assert {menu_item['category'] for menu_item in response.json} == {'service'}
+
+    # Selling the last one changes the version and drops it from in_stock
+    token = create_access_token(
+        identity=str(table_user.id),
+        additional_claims={'role': 'table', 'table_number': 904}
+    )
+    client.post('/orders',
+        json={'items': [{'id': item.id, 'quantity': 1}]},
+        headers={'Authorization': f'Bearer {token}'}
+    )
+    response = client.get('/menu', headers={'If-None-Match': etag}, query_string={'in_stock': 'true'})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert 'Etag Rum' not in [menu_item['name'] for menu_item in response.json]
+    assert 'Etag Waiter' in [menu_item['name'] for menu_item in response.json]
+
+def test_orders_and_payments_keyset_pagination(client):
+    """Test limit/after_id pages through orders and payments in id order"""
+    staff = User(username='page_staff', role='staff')
+    db.session.add(staff)
+    db.session.commit()
+    orders = [
+        Order(user_id=staff.id, table_number=905, items=[], total_price=5.0, staff_id=staff.id)
+        for _ in range(5)
+    ]
+    db.session.add_all(orders)
+    db.session.commit()
+    db.session.add_all([Payment(order_id=order.id, amount=5.0, status='Success') for order in orders])
+    db.session.commit()
+
+    token = create_access_token(identity=str(staff.id), additional_claims={'role': 'staff'})
+    headers = {'Authorization': f'Bearer {token}'}
+
+    seen = []
+    after_id = orders[0].id - 1
+    while after_id is not None:
+        response = client.get('/orders', query_string={'limit': 2, 'after_id': after_id}, headers=headers)
+        assert response.status_code == 200
+        assert len(response.json['orders']) <= 2
+        seen += [order['id'] for order in response.json['orders']]
+        after_id = response.json['next_after_id']
+    assert seen == [order.id for order in orders]
+    assert response.json['orders'][-1]['staff_name'] == 'page_staff'
+
+    first_payment_id = Payment.query.filter_by(order_id=orders[0].id).first().id
+    response = client.get('/payments', query_string={'limit': 3, 'after_id': first_payment_id - 1})
+    assert len(response.json['payments']) == 3
+    response = client.get('/payments', query_string={'limit': 3, 'after_id': response.json['next_after_id']})
+    assert len(response.json['payments']) == 2
+    assert response.json['next_after_id'] is None
+
+def test_sales_reports_track_orders_and_refunds(client):
+    """Test rollups follow order creation, acceptance and refunds, and match a rebuild"""
+    table_user = User(username='report_table', role='table', table_number=906)
+    staff = User(username='report_staff', role='staff')
+    mojito = MenuItem(name='Report Mojito', price=8.50, category='report-drink', stock=50, track_stock=True)
+    waiter = MenuItem(name='Report Waiter', price=0.00, category='report-service', track_stock=False)
+    db.session.add_all([table_user, staff, mojito, waiter])
+    db.session.commit()
+
+    table_headers = {'Authorization': 'Bearer ' + create_access_token(
+        identity=str(table_user.id), additional_claims={'role': 'table', 'table_number': 906})}
+    staff_headers = {'Authorization': 'Bearer ' + create_access_token(
+        identity=str(staff.id), additional_claims={'role': 'staff'})}
+    admin_headers = {'Authorization': 'Bearer ' + create_access_token(
+        identity='1', additional_claims={'role': 'admin'})}
+
+    first = client.post('/orders', headers=table_headers,
+        json={'items': [{'id': mojito.id, 'quantity': 2}, {'id': waiter.id, 'quantity': 1}]}).json['order_id']
+    second = client.post('/orders', headers=table_headers,
+        json={'items': [{'id': mojito.id, 'quantity': 1}]}).json['order_id']
+
+    client.put(f'/orders/{first}/status', json={'status': 'Accepted'}, headers=staff_headers)
+    client.post('/payments', json={'order_id': second, 'amount': 8.50}, headers=table_headers)
+    response = client.post('/refunds', json={'order_id': second}, headers=admin_headers)
+    assert response.status_code == 200
+
+    def report(by):
+        response = client.get('/reports/sales', query_string={'by': by}, headers=admin_headers)
+        assert response.status_code == 200
+        return {row['label']: row for row in response.json['rows']}
+
+    items = report('item')
+    assert items['Report Mojito']['quantity'] == 2
+    assert items['Report Mojito']['revenue'] == 17.00
+    assert items['Report Mojito']['refunded'] == 8.50
+    assert report('category')['report-service']['order_count'] == 1
+    assert report('staff')['report_staff']['revenue'] == 17.00
+    assert sum(row['revenue'] for row in report('hour').values()) >= 17.00
+
+    # Service requests assigned to staff but cancelled, or paid and completed,
+    # without anyone accepting them don't count towards the staff member
+    client.post('/dispatch/shift', headers=staff_headers)
+    cancelled, paid = (client.post('/orders', headers=table_headers,
+        json={'items': [{'id': 5, 'quantity': 1}, {'id': mojito.id, 'quantity': 1}]}).json['order_id']
+        for _ in range(2))
+    assert db.session.get(Order, cancelled).staff_id == staff.id
+    assert client.post(f'/orders/{cancelled}/cancel', headers=table_headers).status_code == 200
+    client.post('/payments', json={'order_id': paid, 'amount': 8.50}, headers=table_headers)
+    assert client.put(f'/orders/{paid}/status', json={'status': 'Completed'}, headers=staff_headers).status_code == 200
+    staff_row = report('staff')['report_staff']
+    assert (staff_row['order_count'], staff_row['revenue'], staff_row['completed_count']) == (1, 17.00, 0)
+
+    before = {by: report(by) for by in ('item', 'category', 'hour', 'staff')}
+    response = client.post('/reports/rebuild', headers=admin_headers)
+    assert response.status_code == 200
+    assert {by: report(by) for by in ('item', 'category', 'hour', 'staff')} == before
+
+    response = client.get('/reports/sales', query_string={'by': 'item'}, headers=staff_headers)
+    assert response.status_code == 403
+
+def test_identity_cache_skips_database(client):
+    """Test repeated authenticated requests resolve the user from the cache"""
+    staff = User(username='cached_staff', role='staff')
+    db.session.add(staff)
+    db.session.commit()
+
+    cached = identity_cache.get(staff.id)
+    assert cached.username == 'cached_staff'
+
+    # The cached entry survives the row changing until it is invalidated
+    staff.username = 'renamed_staff'
+    db.session.commit()
+    assert identity_cache.get(staff.id).username == 'cached_staff'
+    identity_cache.invalidate(staff.id)
+    assert identity_cache.get(staff.id).username == 'renamed_staff'
+
+    # Deleted tables are invalidated and their tokens rejected
+    admin = User(username='cache_admin', role='admin')
+    db.session.add(admin)
+    db.session.commit()
+    admin_headers = {'Authorization': 'Bearer ' + create_access_token(
+        identity=str(admin.id), additional_claims={'role': 'admin'})}
+    client.post('/auth/tables', json={'table_number': 907}, headers=admin_headers)
+    table_user = User.query.filter_by(table_number=907).first()
+    table_headers = {'Authorization': 'Bearer ' + create_access_token(
+        identity=str(table_user.id), additional_claims={'role': 'table', 'table_number': 907})}
+    assert client.get('/orders', headers=table_headers).status_code == 200
+
+    client.delete('/auth/tables/907', headers=admin_headers)
+    assert client.get('/orders', headers=table_headers).status_code == 401
+
+def test_bulk_seeding_is_fast_and_idempotent(client):
+    """Test seeding a 200-table layout is quick and safe to repeat"""
+    hashes = {password: generate_password_hash(password) for password in ('admin123', 'staff123', 'table123')}
+
+    # The fixture already seeded the default layout of five tables
+    started = time.perf_counter()
+    users_added, items_added = create_sample_data(table_count=200, password_hashes=hashes)
+    assert time.perf_counter() - started < 1.0
+    assert users_added == 195
+    assert items_added == 0
+    assert User.query.filter_by(role='table').count() == 200
+
+    assert create_sample_data(table_count=200, password_hashes=hashes) == (0, 0)
+
+    response = client.post('/auth/login', json={'username': 'table200', 'password': 'table123'})
+    assert response.status_code == 200
+    assert response.json['table_number'] == 200
+
+def test_sqlite_engine_profile(client):
+    """Test the sqlite profile tunes every connection"""
+    assert db.session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+    assert db.session.execute(text('PRAGMA synchronous')).scalar() == 1  # NORMAL
+    assert db.session.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+    assert db.session.execute(text('PRAGMA foreign_keys')).scalar() == 1
+
+    # With foreign keys on, a table with orders is kept
+    client.post('/orders',
+        json={'items': [{'id': 1, 'quantity': 1}]},
+        headers={'Authorization': f"Bearer {token_for('table1')}"}
+    )
+    response = client.delete('/auth/tables/1', headers={'Authorization': f"Bearer {token_for('admin')}"})
+    assert response.status_code == 409
+
+def test_metrics_and_server_timing(client):
+    """Test requests are timed, their SQL counted and exposed on /metrics"""
+    response = client.get('/orders', headers={'Authorization': f"Bearer {token_for('staff1')}"})
+    assert response.status_code == 200
+    assert 'db;dur=' in response.headers['Server-Timing']
+    assert 'queries' in response.headers['Server-Timing']
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert '# TYPE http_request_duration_seconds histogram' in body
+    assert 'http_request_duration_seconds_count{endpoint="routes.get_orders",method="GET",status="200"}' in body
+    assert 'http_request_sql_statements_bucket{endpoint="routes.get_orders",le="+Inf"}' in body
+
+def test_metrics_add_up_across_forked_workers():
+    """Test /metrics in any worker process reports every worker's requests"""
+    registry = MetricsRegistry()
+    registry.counter('test_requests_total', 'Test counter.')
+    registry.histogram('test_seconds', 'Test histogram.', (0.1, 1.0))
+    registry.increment('test_requests_total', {'endpoint': 'menu'})
+    registry.share_across_processes()
+
+    def handle_requests():
+        registry.increment('test_requests_total', {'endpoint': 'menu'}, 2)
+        registry.observe('test_seconds', {'endpoint': 'menu'}, 0.5)
+
+    workers = [multiprocessing.get_context('fork').Process(target=handle_requests) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert [worker.exitcode for worker in workers] == [0, 0, 0]
+
+    body = registry.render()
+    assert 'test_requests_total{endpoint="menu"} 7' in body
+    assert 'test_seconds_bucket{endpoint="menu",le="0.1"} 0' in body
+    assert 'test_seconds_bucket{endpoint="menu",le="1"} 3' in body
+    assert 'test_seconds_count{endpoint="menu"} 3' in body
+    assert 'test_seconds_sum{endpoint="menu"} 1.500000' in body
+
+def test_menu_cache_invalidation_reaches_forked_workers(application):
+    """Test a menu change in one worker process invalidates the others' copies"""
+    cache = MenuCache()
+    cache.share_across_processes()
+    with application.app_context():
+        etag, _ = cache.get()
+
+        worker = multiprocessing.get_context('fork').Process(target=cache.invalidate)
+        worker.start()
+        worker.join()
+
+        new_etag, _ = cache.get()
+        assert worker.exitcode == 0
+        assert new_etag != etag
+
+def test_idempotency_key_replays_order_and_payment(client, query_budget):
+    """Test retried requests with the same Idempotency-Key return the original response"""
+    headers = {'Authorization': f'Bearer {token_for("table1")}', 'Idempotency-Key': 'order-1'}
+    body = {'items': [{'id': 1, 'quantity': 2}]}
+
+    first = client.post('/orders', json=body, headers=headers)
+    assert first.status_code == 201
+    retry = client.post('/orders', json=body, headers=headers)
+    assert retry.status_code == 201
+    assert retry.json == first.json
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert Order.query.count() == 1
+    stock_engine.flush()
+    assert db.session.get(MenuItem, 1).stock == 98
+
+    # Same key for a different request is rejected
+    response = client.post('/orders', json={'items': [{'id': 2, 'quantity': 1}]}, headers=headers)
+    assert response.status_code == 422
+
+    order_id = first.json['order_id']
+    payment = {'order_id': order_id, 'amount': 17.00}
+    first = client.post('/payments', json=payment, headers={'Idempotency-Key': 'pay-1'})
+    assert first.status_code == 200
+
+    # A retry that lands on another worker is answered from the table in one query
+    response_cache.clear()
+    with query_budget(1):
+        retry = client.post('/payments', json=payment, headers={'Idempotency-Key': 'pay-1'})
+    assert retry.status_code == 200
+    assert retry.json == first.json
+    assert Payment.query.filter_by(order_id=order_id).count() == 1
+
+    # Without a key the duplicate is still refused by the handler
+    response = client.post('/payments', json=payment)
+    assert response.status_code == 400
+
+def test_concurrent_payments_pay_once(client, application):
+    """Test a payment that passed its checks can't pay an order already paid or accepted meanwhile"""
+    table = {'Authorization': f'Bearer {token_for("table1")}'}
+    staff = {'Authorization': f'Bearer {token_for("staff1")}'}
+
+    def place_order():
+        return client.post('/orders', json={'items': [{'id': 1, 'quantity': 1}]}, headers=table).json['order_id']
+
+    def before_payment_check(callback):
+        # Runs `callback` once each payment has checked for an earlier one, the last check
+        checked = set()
+
+        def listener(state):
+            if state.is_select and any(mapper.class_ is Payment for mapper in state.all_mappers) \
+                    and threading.get_ident() not in checked:
+                checked.add(threading.get_ident())
+                result = state.invoke_statement()
+                callback()
+                return result
+        event.listen(Session, 'do_orm_execute', listener)
+        return lambda: event.remove(Session, 'do_orm_execute', listener)
+
+    # Two devices at the table pay at once, each with its own key
+    order_id = place_order()
+    barrier = threading.Barrier(4, timeout=5)
+    remove = before_payment_check(barrier.wait)
+
+    def pay(n):
+        with application.test_client() as thread_client:
+            return thread_client.post('/payments', json={'order_id': order_id, 'amount': 8.50},
+                                      headers={**table, 'Idempotency-Key': f'pay-{n}'}).status_code
+    try:
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            statuses = sorted(pool.map(pay, range(4)))
+    finally:
+        remove()
+    assert statuses == [200, 409, 409, 409]
+    assert Payment.query.filter_by(order_id=order_id).count() == 1
+
+    # Staff accept the order while the payment is being processed
+    order_id = place_order()
+
+    def accept():
+        with application.test_client() as thread_client:
+            thread_client.put(f'/orders/{order_id}/status', json={'status': 'Accepted'}, headers=staff)
+
+    def accept_meanwhile():
+        thread = threading.Thread(target=accept)
+        thread.start()
+        thread.join()
+    remove = before_payment_check(accept_meanwhile)
+    try:
+        response = client.post('/payments', json={'order_id': order_id, 'amount': 8.50}, headers=table)
+    finally:
+        remove()
+    assert response.status_code == 409
+    assert response.json['status'] == 'Accepted'
+    assert Payment.query.filter_by(order_id=order_id).count() == 0
+
+def test_abandoned_and_expired_idempotency_keys_are_reclaimed(client):
+    """Test a key left without a response, or past its TTL, can be used again"""
+    headers = {'Authorization': f'Bearer {token_for("table1")}', 'Idempotency-Key': 'order-1'}
+    body = {'items': [{'id': 1, 'quantity': 1}]}
+    assert client.post('/orders', json=body, headers=headers).status_code == 201
+
+    def rewind_key(age, completed):
+        # What a worker that died before storing the response leaves behind
+        values = {'created_at': datetime.utcnow() - age}
+        if not completed:
+            values['status_code'] = None
+        db.session.execute(db.update(IdempotencyKey).values(**values))
+        db.session.commit()
+        response_cache.clear()
+
+    # A claim still within its timeout is taken to be running
+    rewind_key(timedelta(seconds=5), completed=False)
+    assert client.post('/orders', json=body, headers=headers).status_code == 409
+
+    # An abandoned claim is taken over, and the retry runs
+    rewind_key(CLAIM_TIMEOUT + timedelta(seconds=1), completed=False)
+    response = client.post('/orders', json=body, headers=headers)
+    assert response.status_code == 201
+    assert 'Idempotent-Replayed' not in response.headers
+    assert client.post('/orders', json=body, headers=headers).headers['Idempotent-Replayed'] == 'true'
+
+    # An expired key is a new request, even with a different body
+    rewind_key(KEY_TTL, completed=True)
+    response = client.post('/orders', json={'items': [{'id': 2, 'quantity': 1}]}, headers=headers)
+    assert response.status_code == 201
+    assert 'Idempotent-Replayed' not in response.headers
+    assert Order.query.count() == 3
+    assert IdempotencyKey.query.count() == 1
+
+def test_bulk_order_status_update(client, query_budget):
+    """Test staff can accept and complete several orders in one request"""
+    table_headers = {'Authorization': f'Bearer {token_for("table1")}'}
+    order_ids = [
+        client.post('/orders', json={'items': [{'id': 1, 'quantity': 1}]}, headers=table_headers).json['order_id']
+        for _ in range(4)
+    ]
+    staff_headers = {'Authorization': f'Bearer {token_for("staff1")}'}
+
+    start = broker.last_id
+    # Staff lookup, orders, one UPDATE per status, rollups, change numbering
+    with query_budget(7):
+        response = client.put('/orders/status', headers=staff_headers, json={'updates': [
+            {'order_id': order_ids[0], 'status': 'Accepted'},
+            {'order_id': order_ids[1], 'status': 'Accepted'},
+            {'order_id': order_ids[2], 'status': 'Completed'},
+            {'order_id': 9999, 'status': 'Accepted'},
+            {'order_id': order_ids[3], 'status': 'Refunded'},
+        ]})
+    assert response.status_code == 200
+    assert response.json['updated'] == 2
+    assert [result['ok'] for result in response.json['results']] == [True, True, False, False, False]
+    assert response.json['results'][2]['error'] == 'Cannot change order from Pending to Completed'
+    assert response.json['results'][4]['error'] == 'Refunds go through POST /refunds'
+
+    pending, _ = broker.wait(start, timeout=0)
+    assert sorted(event['data']['id'] for event in pending) == sorted([order_ids[0], order_ids[1]])
+    assert all(event['data']['staff_name'] == 'staff1' for event in pending if event['data']['status'] == 'Accepted')
+
+    response = client.put('/orders/status', headers=staff_headers, json={'updates': [
+        {'order_id': order_id, 'status': 'Completed'} for order_id in order_ids[:2]
+    ]})
+    assert response.json['updated'] == 2
+    db.session.expire_all()
+    orders = [db.session.get(Order, order_id) for order_id in order_ids]
+    assert [order.status for order in orders] == ['Completed', 'Completed', 'Pending', 'Pending']
+    assert orders[0].staff_id == 2
+
+    response = client.get('/reports/sales?by=staff', headers={'Authorization': f'Bearer {token_for("admin")}'})
+    staff_row = response.json['rows'][0]
+    assert staff_row['order_count'] == 2 and staff_row['completed_count'] == 2
+
+    response = client.put('/orders/status', headers=table_headers, json={'updates': []})
+    assert response.status_code == 403
+
+def test_offline_order_batch(client, query_budget, monkeypatch):
+    """Test a table can upload its offline queue in one request and safely retry it"""
+    headers = {'Authorization': f'Bearer {token_for("table2")}'}
+    batch = {'orders': [
+        {'client_id': 'q-2', 'created_at': '2099-01-01T00:00:00', 'items': [{'id': 1, 'quantity': 60}]},
+        {'client_id': 'q-1', 'created_at': datetime.utcnow().isoformat(), 'items': [{'id': 1, 'quantity': 50}]},
+        {'client_id': 'q-3', 'items': [{'id': 2, 'quantity': 1}, {'id': 5, 'quantity': 1}]},
+        {'client_id': 'q-3', 'items': [{'id': 2, 'quantity': 1}]},
+        {'client_id': 'q-4', 'items': [{'id': 2, 'quantity': 0}]},
+    ]}
+
+    # Identity, duplicates, menu, stock, one INSERT per order, lines, rollups,
+    # client ids, change numbering
+    stock_engine.load()
+    dispatcher.load()
+    with query_budget(11):
+        response = client.post('/orders/batch', json=batch, headers=headers)
+    assert response.status_code == 200
+    results = response.json['results']
+    assert response.json['created'] == 2
+    # The order queued first gets the stock; the future timestamp counts as now
+    assert results[0]['error'] == 'Not enough stock for Mojito. Available: 50'
+    assert results[1]['ok'] and results[2]['ok']
+    assert results[3]['error'] == 'Duplicate client_id'
+    assert results[4]['error'] == 'Invalid quantity for item 2'
+    stock_engine.flush()
+    assert db.session.get(MenuItem, 1).stock == 50
+    order = db.session.get(Order, results[2]['order_id'])
+    assert order.table_number == 2 and order.is_service
+
+    # Re-uploading the queue creates nothing new
+    response = client.post('/orders/batch', json=batch, headers=headers)
+    assert response.json['created'] == 0
+    assert [result.get('order_id') for result in response.json['results'][1:3]] == \
+        [results[1]['order_id'], results[2]['order_id']]
+    assert all(result['duplicate'] for result in response.json['results'][1:3])
+    assert Order.query.count() == 2
+
+    # A failing write hands the reserved stock back
+    def locked(deltas):
+        raise OperationalError('UPDATE sales_rollup', {}, Exception('database is locked'))
+    monkeypatch.setattr('routes.apply_deltas', locked)
+    available = stock_engine.available([2])
+    response = client.post('/orders/batch', json={'orders': [
+        {'client_id': 'q-5', 'items': [{'id': 2, 'quantity': 3}]}
+    ]}, headers=headers)
+    assert response.status_code == 500
+    assert stock_engine.available([2]) == available
+
+def test_archive_moves_old_closed_orders(client):
+    """Test old closed orders leave the live tables but stay in history and reports"""
+    table_headers = {'Authorization': f'Bearer {token_for("table3")}'}
+    staff_headers = {'Authorization': f'Bearer {token_for("staff1")}'}
+    admin_headers = {'Authorization': f'Bearer {token_for("admin")}'}
+    order_ids = [
+        client.post('/orders', json={'items': [{'id': 2, 'quantity': 1}]}, headers=table_headers).json['order_id']
+        for _ in range(3)
+    ]
+    client.post('/payments', json={'order_id': order_ids[0], 'amount': 8.00})
+    client.put(f'/orders/{order_ids[0]}/status', json={'status': 'Completed'}, headers=staff_headers)
+    client.post('/payments', json={'order_id': order_ids[1], 'amount': 8.00})
+    client.post('/refunds', json={'order_id': order_ids[1]}, headers=admin_headers)
+    # The third order stays open; only closed orders are archived
+    Order.query.update({'updated_at': datetime.utcnow() - timedelta(days=30)})
+    db.session.commit()
+    before = client.get('/reports/sales?by=item', headers=admin_headers).json['rows']
+
+    response = client.post('/archive/run', json={'older_than_days': 7}, headers=admin_headers)
+    assert response.json == {'archived': 2}
+    assert [order['id'] for order in client.get('/orders', headers=staff_headers).json] == [order_ids[2]]
+    assert Payment.query.count() == 0
+
+    response = client.get('/orders/history?table_number=3', headers=staff_headers)
+    history = response.json['orders']
+    assert [order['id'] for order in history] == [order_ids[1], order_ids[0]]
+    assert history[1]['payments'][0]['amount'] == 8.00
+    assert client.get('/orders/history', headers=table_headers).status_code == 403
+
+    # Rebuilding the rollups still counts archived orders
+    client.post('/reports/rebuild', headers=admin_headers)
+    assert client.get('/reports/sales?by=item', headers=admin_headers).json['rows'] == before
+
+def test_streaming_exports(client, monkeypatch):
+    """Test exports stream live and archived rows in chunks as CSV and NDJSON"""
+    monkeypatch.setattr('exports.EXPORT_CHUNK_SIZE', 2)
+    table_headers = {'Authorization': f'Bearer {token_for("table1")}'}
+    admin_headers = {'Authorization': f'Bearer {token_for("admin")}'}
+    order_ids = [
+        client.post('/orders', json={'items': [{'id': 3, 'quantity': 2}]}, headers=table_headers).json['order_id']
+        for _ in range(5)
+    ]
+    client.post('/payments', json={'order_id': order_ids[0], 'amount': 14.00})
+    client.put(f'/orders/{order_ids[0]}/status', json={'status': 'Completed'}, headers=admin_headers)
+    client.post('/archive/run', json={'older_than_days': 0}, headers=admin_headers)
+
+    response = client.get('/exports/orders', headers=admin_headers, buffered=False)
+    assert response.mimetype == 'text/csv'
+    chunks = [chunk.decode() for chunk in response.response]
+    response.close()
+    # Header first, then one chunk per fetch of two rows
+    assert chunks[0] == 'id,table_number,user_id,staff_id,status,is_service,total_price,created_at,updated_at\r\n'
+    rows = ''.join(chunks[1:]).splitlines()
+    assert [int(row.split(',')[0]) for row in rows] == order_ids
+    assert len(chunks) == 4
+
+    today = datetime.utcnow().date()
+    response = client.get(
+        f'/exports/payments?format=ndjson&from={today.isoformat()}&to={(today + timedelta(days=1)).isoformat()}',
+        headers=admin_headers
+    )
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.headers['Content-Disposition'].endswith(f'payments-{today.isoformat()}-{(today + timedelta(days=1)).isoformat()}.ndjson"')
+    payments = [json.loads(line) for line in response.text.splitlines()]
+    assert [(payment['order_id'], payment['amount']) for payment in payments] == [(order_ids[0], 14.00)]
+
+    response = client.get('/exports/order-lines?format=ndjson&to=2000-01-01', headers=admin_headers)
+    assert response.text == ''
+    assert client.get('/exports/orders', headers=table_headers).status_code == 403
+
+def test_write_behind_stock(client):
+    """Test stock is reserved in memory, journalled, flushed and recovered after a crash"""
+    headers = {'Authorization': f'Bearer {token_for("table4")}'}
+    admin_headers = {'Authorization': f'Bearer {token_for("admin")}'}
+
+    response = client.post('/orders', json={'items': [{'id': 2, 'quantity': 30}]}, headers=headers)
+    assert response.status_code == 201
+    assert stock_engine.available([2]) == {2: 70}
+    # The row is untouched until the flush; the sale is in the journal
+    assert db.session.get(MenuItem, 2).stock == 100
+    assert [(row.menu_item_id, row.quantity) for row in StockReservation.query] == [(2, 30)]
+    menu = {item['id']: item for item in client.get('/menu').json}
+    assert menu[2]['stock'] == 70
+
+    # A rolled back reservation is handed back
+    assert stock_engine.reserve({2: 5})
+    db.session.rollback()
+    assert stock_engine.available([2]) == {2: 70}
+    # ...and so is one whose session is closed without a rollback
+    assert stock_engine.reserve({2: 5})
+    db.session.close()
+    assert stock_engine.available([2]) == {2: 70}
+
+    # Losing the counters loses nothing: they are rebuilt from stock and journal
+    stock_engine.reset()
+    assert stock_engine.available([2]) == {2: 70}
+    response = client.post('/orders', json={'items': [{'id': 2, 'quantity': 71}]}, headers=headers)
+    assert response.json['error'] == 'Not enough stock for Vodka. Available: 70'
+
+    assert stock_engine.flush() == 1
+    db.session.expire_all()
+    assert db.session.get(MenuItem, 2).stock == 70
+    assert StockReservation.query.count() == 0
+
+    # Stock changed behind the engine's back is picked up by a resync
+    db.session.get(MenuItem, 2).stock = 90
+    db.session.commit()
+    response = client.post('/stock/resync', headers=admin_headers)
+    assert response.json == {'flushed': 0, 'stock': {'1': 100, '2': 90, '3': 100}}
+    assert client.post('/stock/resync', headers=headers).status_code == 403
+
+def test_resync_during_commit_counts_sales_once(client):
+    """Test a resync racing an order's commit neither loses nor double counts its stock"""
+    application = client.application
+    resyncs = []
+
+    def resync_in_commit(session):
+        # Runs after the journal rows are committed, before they are confirmed
+        if resyncs:
+            return
+        def run():
+            with application.app_context():
+                stock_engine.resync()
+        resyncs.append(threading.Thread(target=run))
+        resyncs[0].start()
+        time.sleep(0.1)
+
+    assert stock_engine.reserve({2: 3})
+    event.listen(Session, 'after_commit', resync_in_commit, insert=True)
+    try:
+        db.session.commit()
+    finally:
+        event.remove(Session, 'after_commit', resync_in_commit)
+    resyncs[0].join()
+    assert stock_engine.available([2]) == {2: 97}
+
+def test_resync_flush_does_not_block_reservations(client):
+    """Test an order holding the write lock can still reserve and commit while
+    a resync's flush waits for that lock"""
+    application = client.application
+    engine = db.session.get_bind()
+    flushing = threading.Event()
+    results = []
+
+    def flush_started(connection, cursor, statement, parameters, context, executemany):
+        if statement.startswith('DELETE FROM stock_reservation'):
+            flushing.set()
+
+    def run():
+        with application.app_context():
+            try:
+                results.append(stock_engine.resync())
+            except OperationalError as e:
+                results.append(e)
+
+    stock_engine.load()
+    # The order's transaction already holds the write lock when it reserves
+    db.session.get(MenuItem, 1).description = 'House special'
+    db.session.flush()
+    event.listen(engine, 'before_cursor_execute', flush_started)
+    resync = threading.Thread(target=run)
+    try:
+        resync.start()
+        assert flushing.wait(5)
+        time.sleep(0.05)
+        assert stock_engine.reserve({3: 2})
+        db.session.commit()
+    finally:
+        resync.join()
+        event.remove(engine, 'before_cursor_execute', flush_started)
+    assert results == [1]
+    assert stock_engine.available([3]) == {3: 98}
+
+def test_service_request_dispatch(client):
+    """Test service requests are spread over staff on shift and queued by age and type"""
+    table = {'Authorization': f'Bearer {token_for("table1")}'}
+    staff1 = {'Authorization': f'Bearer {token_for("staff1")}'}
+    staff2 = {'Authorization': f'Bearer {token_for("staff2")}'}
+
+    def request_service(item_id):
+        return client.post('/orders', json={'items': [{'id': item_id, 'quantity': 1}]}, headers=table).json['order_id']
+
+    # Nobody on shift yet: the request waits unassigned until someone starts
+    glasses = request_service(4)
+    response = client.post('/dispatch/shift', headers=staff1)
+    assert response.json['reassigned'] == 1
+    assert [entry['order_id'] for entry in response.json['requests']] == [glasses]
+    client.post('/dispatch/shift', headers=staff2)
+
+    # Least loaded first, ties to whoever was assigned longest ago
+    waiter = request_service(5)
+    bottle = request_service(6)
+    assert db.session.get(Order, waiter).staff_id == 3
+    response = client.get('/dispatch/queue', headers=staff1)
+    assert response.json['on_shift']
+    # Bottle Show Service jumps ahead of the slightly older Empty Glasses
+    assert [entry['order_id'] for entry in response.json['requests']] == [bottle, glasses]
+
+    # Accepting takes the request off the queue and counts its acknowledge time
+    client.put(f'/orders/{waiter}/status', json={'status': 'Accepted'}, headers=staff2)
+    response = client.get('/dispatch/stats', headers=staff1)
+    assert response.json['pending'] == 2
+    assert response.json['ack_seconds']['count'] == 1
+    assert [staff['acknowledged'] for staff in response.json['staff']] == [0, 1]
+    assert [staff['staff_name'] for staff in response.json['staff']] == ['staff1', 'staff2']
+
+    # Going off shift hands the remaining requests to whoever is still on
+    response = client.delete('/dispatch/shift', headers=staff1)
+    assert response.json['reassigned'] == 2
+    response = client.get('/dispatch/queue', headers=staff2)
+    assert [entry['order_id'] for entry in response.json['requests']] == [bottle, glasses]
+    assert db.session.get(Order, glasses).staff_id == 3
+
+    # Paying for a request settles it as well
+    response = client.post('/payments', json={'order_id': bottle, 'amount': 0}, headers=table)
+    assert response.status_code == 200
+    assert [entry['order_id'] for entry in dispatcher.queue(3)] == [glasses]
+
+    # The queues survive a reload from the database
+    dispatcher.reset()
+    assert [entry['order_id'] for entry in dispatcher.queue(3)] == [glasses]
+
+def test_signed_qr_tokens(client, query_budget):
+    """Test QR tokens are issued in bulk by the admin and verified without the database"""
+    admin = {'Authorization': f'Bearer {token_for("admin")}'}
+    response = client.post('/auth/tables/qr-tokens', json={'tables': [1, 2]}, headers=admin)
+    assert response.status_code == 200
+    tokens = {entry['table_number']: entry['token'] for entry in response.json['tokens']}
+    assert set(tokens) == {1, 2}
+    response = client.post('/auth/tables/qr-tokens', json={'tables': [99]}, headers=admin)
+    assert response.status_code == 404
+    response = client.post('/auth/tables/qr-tokens', headers={'Authorization': f'Bearer {token_for("staff1")}'})
+    assert response.status_code == 403
+
+    with query_budget(0):
+        response = client.post('/auth/qr', json={'tableNumber': '1', 'token': tokens[1]})
+    assert response.status_code == 200
+    assert response.json['table_number'] == 1
+    headers = {'Authorization': f"Bearer {response.json['access_token']}"}
+    assert client.get('/orders', headers=headers).status_code == 200
+
+    # Another table's code, a forged signature and the old client-made format all fail
+    assert client.post('/auth/qr', json={'tableNumber': 2, 'token': tokens[1]}).status_code == 401
+    forged = tokens[2][:-1] + ('0' if tokens[2][-1] != '0' else '1')
+    assert client.post('/auth/qr', json={'tableNumber': 2, 'token': forged}).status_code == 401
+    assert client.post('/auth/qr', json={'tableNumber': 2, 'token': '2-1700000000000-abc123'}).status_code == 401
+
+    # Each code only admits so many scans
+    client.application.config['QR_TOKEN_MAX_SCANS'] = 2
+    assert client.post('/auth/qr', json={'tableNumber': 2, 'token': tokens[2]}).status_code == 200
+    assert client.post('/auth/qr', json={'tableNumber': 2, 'token': tokens[2]}).status_code == 200
+    assert client.post('/auth/qr', json={'tableNumber': 2, 'token': tokens[2]}).status_code == 401
+
+def test_rate_limits_and_load_shedding(client):
+    """Test clients and tables over their budget get 429, and full slow paths 503"""
+    client.application.config['RATE_LIMITS'] = {
+        'login': {'client': (0.01, 2)},
+        'orders': {'table': (0.01, 1)},
+    }
+    client.application.config['CONCURRENCY_LIMITS'] = {'writes': 1}
+
+    credentials = {'username': 'staff1', 'password': 'staff123'}
+    assert client.post('/auth/login', json=credentials).status_code == 200
+    assert client.post('/auth/login', json=credentials).status_code == 200
+    response = client.post('/auth/login', json=credentials)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 1
+
+    # Tables are limited separately from each other
+    order = {'items': [{'id': 1, 'quantity': 1}]}
+    table1 = {'Authorization': f'Bearer {token_for("table1")}'}
+    table2 = {'Authorization': f'Bearer {token_for("table2")}'}
+    assert client.post('/orders', json=order, headers=table1).status_code == 201
+    assert client.post('/orders', json=order, headers=table1).status_code == 429
+    assert client.post('/orders', json=order, headers=table2).status_code == 201
+
+    # Signed-in callers sharing an address, e.g. behind the venue's NAT, get a bucket each
+    client.application.config['RATE_LIMITS'] = {'orders': {'client': (0.01, 1)}}
+    assert client.post('/orders', json=order, headers=table1).status_code == 201
+    assert client.post('/orders', json=order, headers=table1).status_code == 429
+    assert client.post('/orders', json=order, headers=table2).status_code == 201
+
+    # With every write slot taken the request is turned away, not queued
+    client.application.config['RATE_LIMITS'] = {}
+    assert concurrency_limiter.acquire('writes', 1)
+    try:
+        response = client.post('/orders', json=order, headers=table2)
+    finally:
+        concurrency_limiter.release('writes')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert client.post('/orders', json=order, headers=table2).status_code == 201
+
+    metrics = client.get('/metrics').get_data(as_text=True)
+    assert 'http_requests_rejected_total{endpoint="auth.login",reason="rate_client"} 1' in metrics
+    assert 'http_requests_rejected_total{endpoint="routes.create_order",reason="rate_table"} 1' in metrics
+    assert 'http_requests_rejected_total{endpoint="routes.create_order",reason="rate_client"} 1' in metrics
+    assert 'http_requests_rejected_total{endpoint="routes.create_order",reason="overloaded_writes"} 1' in metrics
+
+def test_field_projection_and_compression(client):
+    """Test list endpoints honour ?fields= and large responses are compressed"""
+    assert type(client.application.json).__name__ == ('OrjsonProvider' if orjson else 'DefaultJSONProvider')
+    table = {'Authorization': f'Bearer {token_for("table1")}'}
+    staff = {'Authorization': f'Bearer {token_for("staff1")}'}
+    for _ in range(20):
+        client.post('/orders', json={'items': [{'id': 1, 'quantity': 1}, {'id': 2, 'quantity': 1}]}, headers=table)
+
+    response = client.get('/orders?fields=id,status', headers=staff)
+    assert response.json[0] == {'id': 1, 'status': 'Pending'}
+    response = client.get('/orders?limit=5&fields=id', headers=staff)
+    assert response.json['orders'] == [{'id': order_id} for order_id in range(1, 6)]
+    response = client.get('/orders?fields=id,password', headers=staff)
+    assert response.status_code == 400
+    assert response.json['error'] == 'Unknown fields: password'
+    response = client.get('/menu?fields=name,price')
+    assert response.json[0] == {'name': 'Mojito', 'price': 8.5}
+
+    # Compressed only when asked for and worth it
+    response = client.get('/orders', headers={**staff, 'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert json.loads(gzip.decompress(response.data))[0]['id'] == 1
+    assert 'Content-Encoding' not in client.get('/orders', headers=staff).headers
+    response = client.get('/orders?fields=id&limit=1', headers={**staff, 'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+
+    # A compressed menu gets a weak ETag, which still revalidates
+    client.application.config['COMPRESS_MIN_SIZE'] = 100
+    response = client.get('/menu', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'].startswith('W/')
+    response = client.get('/menu', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+def test_venues_have_their_own_databases(client):
+    """Test a new venue gets its own seeded database and requests are routed to it by token"""
+    admin = {'Authorization': f'Bearer {token_for("admin")}'}
+    response = client.post('/venues', json={'slug': 'harbour', 'name': 'Harbour Bar', 'tables': 2}, headers=admin)
+    assert response.status_code == 201
+    assert response.json['users_added'] == 5
+    assert client.post('/venues', json={'slug': 'harbour', 'name': 'Again'}, headers=admin).status_code == 409
+    assert client.post('/venues', json={'slug': 'Bad Slug', 'name': 'X'}, headers=admin).status_code == 400
+    staff = {'Authorization': f'Bearer {token_for("staff1")}'}
+    assert client.post('/venues', json={'slug': 'other', 'name': 'X'}, headers=staff).status_code == 403
+    assert [venue['slug'] for venue in client.get('/venues', headers=admin).json['venues']] == ['harbour']
+
+    # Logging in picks the venue from the header; from then on the token carries it
+    assert client.post('/auth/login', json={'username': 'table5', 'password': 'table123'},
+                       headers={'X-Venue': 'harbour'}).status_code == 401
+    response = client.post('/auth/login', json={'username': 'table1', 'password': 'table123'},
+                           headers={'X-Venue': 'harbour'})
+    assert response.json['venue'] == 'harbour'
+    harbour = {'Authorization': f"Bearer {response.json['access_token']}", 'X-Venue': 'default'}
+    response = client.post('/orders', json={'items': [{'id': 1, 'quantity': 2}]}, headers=harbour)
+    assert response.status_code == 201
+    assert client.get('/menu', headers={'X-Venue': 'harbour'}).json[0]['stock'] == 98
+    assert client.get('/menu').json[0]['stock'] == 100
+    assert client.get('/menu', headers={'X-Venue': 'nowhere'}).status_code == 404
+
+    # Admins of a venue only see its orders, and can't manage venues
+    response = client.post('/auth/login', json={'username': 'admin', 'password': 'admin123'},
+                           headers={'X-Venue': 'harbour'})
+    harbour_admin = {'Authorization': f"Bearer {response.json['access_token']}"}
+    assert [order['table_number'] for order in client.get('/orders', headers=harbour_admin).json] == [1]
+    assert client.get('/orders', headers=admin).json == []
+    assert client.get('/venues', headers=harbour_admin).status_code == 403
+    assert Order.query.count() == 0
+
+    # QR codes carry the venue they were printed for
+    response = client.post('/auth/tables/qr-tokens', json={'tables': [2]}, headers=harbour_admin)
+    token = response.json['tokens'][0]['token']
+    response = client.post('/auth/qr', json={'tableNumber': 2, 'token': token})
+    assert response.json['venue'] == 'harbour'
+    assert client.get('/orders', headers={'Authorization': f"Bearer {response.json['access_token']}"}).json == []
+
+def test_init_database_adds_new_columns(client):
+    """Test databases created before a column existed get it, filled with its default"""
+    db.session.execute(text('ALTER TABLE "order" DROP COLUMN venue'))
+    db.session.commit()
+    db.session.execute(text('INSERT INTO "order" (user_id, table_number, status) VALUES (4, 1, \'Pending\')'))
+    db.session.commit()
+    init_database()
+    assert db.session.execute(text('SELECT venue FROM "order"')).scalars().all() == ['default']
+
+def test_archived_order_ids_are_not_reused(client):
+    """Test orders placed after the newest one was archived get new ids"""
+    table_headers = {'Authorization': f'Bearer {token_for("table1")}'}
+    admin_headers = {'Authorization': f'Bearer {token_for("admin")}'}
+    order_id = client.post('/orders', json={'items': [{'id': 2, 'quantity': 1}]}, headers=table_headers).json['order_id']
+    client.post('/payments', json={'order_id': order_id, 'amount': 8.00}, headers=table_headers)
+    client.post('/refunds', json={'order_id': order_id}, headers=admin_headers)
+    Order.query.update({'updated_at': datetime.utcnow() - timedelta(days=30)})
+    db.session.commit()
+    assert client.post('/archive/run', json={'older_than_days': 7}, headers=admin_headers).json == {'archived': 1}
+
+    new_id = client.post('/orders', json={'items': [{'id': 2, 'quantity': 1}]}, headers=table_headers).json['order_id']
+    assert new_id > order_id
+    client.post('/payments', json={'order_id': new_id, 'amount': 8.00}, headers=table_headers)
+    client.post('/refunds', json={'order_id': new_id}, headers=admin_headers)
+    Order.query.update({'updated_at': datetime.utcnow() - timedelta(days=30)})
+    db.session.commit()
+    assert client.post('/archive/run', json={'older_than_days': 7}, headers=admin_headers).json == {'archived': 1}
+    history = client.get('/orders/history', headers=admin_headers).json['orders']
+    assert [order['id'] for order in history] == [new_id, order_id]
+
+def test_tables_made_without_autoincrement_are_rebuilt(client):
+    """Test a database from before AUTOINCREMENT stops reusing archived ids once
+    init_database runs, and orders that already got a reused id stay live"""
+    table_headers = {'Authorization': f'Bearer {token_for("table1")}'}
+    admin_headers = {'Authorization': f'Bearer {token_for("admin")}'}
+    db.session.remove()
+    with db.engine.begin() as connection:
+        for model in (OrderLine, Payment, Order):
+            model.__table__.drop(connection)
+        for model in (Order, OrderLine, Payment):
+            connection.exec_driver_sql(str(CreateTable(model.__table__).compile(db.engine)).replace(' AUTOINCREMENT', ''))
+
+    def closed_order():
+        order_id = client.post('/orders', json={'items': [{'id': 2, 'quantity': 1}]}, headers=table_headers).json['order_id']
+        client.post('/payments', json={'order_id': order_id, 'amount': 8.00}, headers=table_headers)
+        client.post('/refunds', json={'order_id': order_id}, headers=admin_headers)
+        Order.query.update({'updated_at': datetime.utcnow() - timedelta(days=30)})
+        db.session.commit()
+        return order_id
+
+    def archive():
+        return client.post('/archive/run', json={'older_than_days': 7}, headers=admin_headers).json['archived']
+
+    archived_id = closed_order()
+    assert archive() == 1
+    # The old tables hand the archived order's id, line id and payment ids out again
+    reused_id = closed_order()
+    assert reused_id == archived_id
+    closed_order()
+    assert archive() == 1
+    assert db.session.get(Order, reused_id) is not None
+
+    init_database()
+    with db.engine.connect() as connection:
+        assert 'AUTOINCREMENT' in connection.scalar(text("SELECT sql FROM sqlite_master WHERE name = 'order'"))
+        assert connection.exec_driver_sql('PRAGMA foreign_key_check').all() == []
+    new_id = closed_order()
+    assert new_id > db.session.query(db.func.max(ArchivedOrder.id)).scalar()
+    assert archive() == 1
+    assert [order.id for order in Order.query] == [reused_id]
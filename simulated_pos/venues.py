@@ -0,0 +1,81 @@
+from flask import Blueprint, current_app, request, jsonify
+from sqlalchemy.exc import IntegrityError
+from models import db, Venue, User
+from auth import role_required
+from sharding import DEFAULT_VENUE, VENUE_SLUG, current_venue, venue_router, venue_context
+import os
+
+venues = Blueprint('venues', __name__)
+
+# Most table accounts seeded for a new venue
+MAX_VENUE_TABLES = 500
+
+def venue_admin_only():
+    # The catalog lives in the default venue's database, so only its admins manage venues
+    if current_venue() != DEFAULT_VENUE:
+        return jsonify({"error": "Venues are managed by the default venue's admins"}), 403
+    return None
+
+@venues.route('/venues', methods=['GET'])
+@role_required([User.ROLE_ADMIN])
+def list_venues():
+    refused = venue_admin_only()
+    if refused:
+        return refused
+    router = venue_router()
+    catalog = [venue.to_dict() for venue in Venue.query.order_by(Venue.slug)]
+    for venue in catalog:
+        venue['served'] = not router.frozen or venue['slug'] in router.venues()
+    return jsonify({'default': DEFAULT_VENUE, 'venues': catalog})
+
+@venues.route('/venues', methods=['POST'])
+@role_required([User.ROLE_ADMIN])
+def create_venue():
+    """Add a venue: create its database, seeded like a fresh install with
+    `tables` table accounts, then list it in the catalog."""
+    refused = venue_admin_only()
+    if refused:
+        return refused
+    # Avoids a circular import; app imports this blueprint
+    from app import init_database, create_sample_data
+
+    data = request.get_json(silent=True) or {}
+    slug, name = data.get('slug'), data.get('name')
+    if not isinstance(slug, str) or not VENUE_SLUG.match(slug):
+        return jsonify({"error": "slug must be 1-40 lowercase letters, digits or dashes"}), 400
+    if not isinstance(name, str) or not name.strip():
+        return jsonify({"error": "name is required"}), 400
+    table_count = data.get('tables', 5)
+    if not isinstance(table_count, int) or not 0 <= table_count <= MAX_VENUE_TABLES:
+        return jsonify({"error": f"tables must be between 0 and {MAX_VENUE_TABLES}"}), 400
+    if slug == DEFAULT_VENUE or db.session.get(Venue, slug) is not None:
+        return jsonify({"error": "Venue already exists"}), 409
+
+    os.makedirs(current_app.instance_path, exist_ok=True)
+    url = current_app.config['VENUE_DATABASE_URL'].format(venue=slug, instance=current_app.instance_path)
+    router = venue_router()
+    router.add(slug, url)
+    try:
+        with venue_context(slug):
+            init_database()
+            users_added, items_added = create_sample_data(table_count)
+        db.session.add(Venue(slug=slug, name=name.strip(), database_url=url))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        router.discard(slug)
+        return jsonify({"error": "Venue already exists"}), 409
+    except Exception as e:
+        db.session.rollback()
+        router.discard(slug)
+        return jsonify({"error": str(e)}), 500
+    if router.frozen:
+        # Workers only share the caches of venues loaded before they forked
+        router.discard(slug)
+
+    return jsonify({
+        **db.session.get(Venue, slug).to_dict(),
+        'served': not router.frozen,
+        'users_added': users_added,
+        'items_added': items_added
+    }), 201